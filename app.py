@@ -1,17 +1,24 @@
 # app.py
 
+import os
 from flask import Flask
+from werkzeug.middleware.proxy_fix import ProxyFix
 from lucidserver.endpoints import register_endpoints
 from agentlogger import print_header
 
 app = Flask(__name__)
 
+# Heroku's router terminates TLS, so trust the X-Forwarded-* headers of that many
+# proxies to see the scheme and host clients used, e.g. in image URLs
+proxy_count = int(os.environ.get("PROXY_COUNT", 1))
+if proxy_count:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxy_count, x_proto=proxy_count, x_host=proxy_count)
+
 print_header("LUCID JOURNAL", font="slant", color="cyan")
 
 # Register the endpoints with the app
 register_endpoints(app)
 
 if __name__ == "__main__":
-    import os
     port = int(os.environ.get("PORT", 5000))
     app.run(host='0.0.0.0', port=port)
\ No newline at end of file
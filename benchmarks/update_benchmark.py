@@ -0,0 +1,202 @@
+"""Per-update cost of saving an analysis on a dream, before and after patch updates.
+
+Runs against an in-memory Chroma collection whose embedding function counts
+the documents it embeds and sleeps --embed-ms per document, standing in for
+an embedding model or API. Three ways of saving an analysis are compared:
+
+    full-record     metadata and document rewritten, as backends that replace the whole record do
+    full-metadata   every metadata field sent back through update_memory, the previous behaviour
+    patch           patch_dream, only the changed field is sent
+
+Usage, from the repository root:
+    python -m benchmarks.update_benchmark --dreams 200 --updates 200 --embed-ms 20
+    python benchmarks/update_benchmark.py --dreams 200 --updates 200 --embed-ms 20
+"""
+import os
+import sys
+
+# Run as a script only benchmarks/ is on the path, lucidserver lives next to it
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import io
+import time
+import uuid
+import hashlib
+import argparse
+import contextlib
+import chromadb
+import numpy as np
+import agentlogger.main
+import agentmemory.main
+from chromadb import EmbeddingFunction
+from agentmemory import update_memory
+from lucidserver.memories import get_dream, patch_dream
+from lucidserver.memories.main import dream_cache
+
+EMBEDDING_WIDTH = 64
+
+
+class CountingEmbeddingFunction(EmbeddingFunction):
+    """Hashed bag of words embeddings that count and delay each embedded document."""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.embedded = 0
+
+    def __call__(self, input):
+        self.embedded += len(input)
+        time.sleep(self.delay * len(input))
+        embeddings = []
+        for document in input:
+            vector = np.zeros(EMBEDDING_WIDTH, dtype=np.float32)
+            for word in document.lower().split():
+                digest = hashlib.blake2b(word.encode("utf-8"), digest_size=4).digest()
+                vector[int.from_bytes(digest, "little") % EMBEDDING_WIDTH] += 1.0
+            embeddings.append(vector / (np.linalg.norm(vector) or 1.0))
+        return embeddings
+
+    @staticmethod
+    def name():
+        return "counting"
+
+    def get_config(self):
+        return {}
+
+    @staticmethod
+    def build_from_config(config):
+        return CountingEmbeddingFunction()
+
+
+class CountingCollection:
+    """Wraps a Chroma collection, counting the metadata fields each update writes."""
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.fields_written = 0
+
+    def update(self, ids, documents=None, metadatas=None, embeddings=None):
+        self.fields_written += sum(len(metadata) for metadata in metadatas or [])
+        return self.collection.update(ids=ids, documents=documents, metadatas=metadatas, embeddings=embeddings)
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+
+class BenchmarkClient:
+    """Stands in for agentmemory's client, serving one in-memory collection."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def get_or_create_collection(self, category, metadata=None):
+        return self.collection
+
+
+def seed_dreams(collection, count):
+    ids = [str(uuid.uuid4()) for _ in range(count)]
+    metadatas = []
+    documents = []
+    for i in range(count):
+        title = f"Dream {i}"
+        entry = f"I was flying over a city of glass, dream number {i}, and the streets were rivers."
+        metadatas.append({
+            "title": title,
+            "date": "2023-05-01",
+            "entry": entry,
+            "useremail": "benchmark@example.com",
+            "symbols": "flying, glass, rivers",
+            "lucidity": 3,
+            "characters": "a stranger",
+            "emotions": "wonder",
+            "setting": "a city of glass",
+            "created_at": time.time(),
+            "updated_at": time.time(),
+        })
+        documents.append(f"{title}\n{entry}")
+    collection.add(ids=ids, documents=documents, metadatas=metadatas)
+    return ids
+
+
+def full_record_update(dream_id, analysis):
+    dream = get_dream(dream_id)
+    metadata = {key: value for key, value in dream["metadata"].items() if value is not None}
+    metadata["analysis"] = analysis
+    update_memory("dreams", dream_id, text=dream["document"], metadata=metadata)
+    dream["metadata"]["analysis"] = analysis
+    dream_cache.set(dream_id, dream)
+
+
+def full_metadata_update(dream_id, analysis):
+    dream = get_dream(dream_id)
+    metadata = {key: value for key, value in dream["metadata"].items() if value is not None}
+    metadata["analysis"] = analysis
+    update_memory("dreams", dream_id, metadata=metadata)
+    dream["metadata"]["analysis"] = analysis
+    dream_cache.set(dream_id, dream)
+
+
+def patch_update(dream_id, analysis):
+    patch_dream(dream_id, {"analysis": analysis})
+
+
+STRATEGIES = {
+    "full-record": full_record_update,
+    "full-metadata": full_metadata_update,
+    "patch": patch_update,
+}
+
+
+def run(strategy, dreams, updates, embed_ms):
+    embedding_function = CountingEmbeddingFunction(delay=embed_ms / 1000)
+    client = chromadb.EphemeralClient()
+    collection = client.create_collection(
+        f"dreams-{uuid.uuid4().hex[:8]}", embedding_function=embedding_function
+    )
+    ids = seed_dreams(collection, dreams)
+    collection = CountingCollection(collection)
+    agentmemory.main.get_client = lambda: BenchmarkClient(collection)
+    dream_cache.clear()
+
+    # Warm the dream cache, so every strategy starts from cached reads
+    for dream_id in ids:
+        get_dream(dream_id)
+    embedding_function.embedded = 0
+
+    update = STRATEGIES[strategy]
+    started = time.perf_counter()
+    for i in range(updates):
+        update(ids[i % len(ids)], f"Analysis {i}: the glass city stands for clarity.")
+    elapsed = time.perf_counter() - started
+
+    return {
+        "strategy": strategy,
+        "updates": updates,
+        "ms_per_update": elapsed * 1000 / updates,
+        "embedded": embedding_function.embedded,
+        "fields_per_update": collection.fields_written / updates,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dreams", type=int, default=200, help="dreams in the collection")
+    parser.add_argument("--updates", type=int, default=200, help="updates timed per strategy")
+    parser.add_argument("--embed-ms", type=float, default=20.0, help="simulated milliseconds per embedded document")
+    args = parser.parse_args()
+
+    # Printing log panels would dominate the timings
+    agentlogger.main.console.quiet = True
+
+    print(f"{'strategy':<15}{'updates':>10}{'ms/update':>12}{'embedded':>10}{'fields/update':>15}")
+    for strategy in STRATEGIES:
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = run(strategy, args.dreams, args.updates, args.embed_ms)
+        print(
+            f"{result['strategy']:<15}{result['updates']:>10}"
+            f"{result['ms_per_update']:>12.2f}{result['embedded']:>10}"
+            f"{result['fields_per_update']:>15.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
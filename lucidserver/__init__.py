@@ -1,3 +1,11 @@
+from .cache import *
+from .jobs import *
+from .resilience import *
+from .http import *
+from .history import *
+from .images import *
+from .vectors import *
 from .actions import *
+from .exports import *
 from .endpoints import *
 from .memories import *
\ No newline at end of file
@@ -1,6 +1,8 @@
 from .main import (
+    ANALYSIS_MODEL,
     get_image_summary,
     generate_dream_analysis,
+    stream_dream_analysis_text,
     generate_dream_image,
     discuss_emotions_function,
     predict_future_function,
@@ -9,13 +11,21 @@ from .main import (
     analyze_dream_signs_function,
     track_lucidity_progress_function,
     regular_chat,
+    stream_regular_chat,
     call_function_by_name,
     search_chat_with_dreams,
+    stream_search_chat_with_dreams,
+    get_openai_breaker_stats,
+    get_coalescing_stats,
+    get_chat_session_stats,
+    get_rate_limit_stats,
 )
 
 __all__ = [
+    "ANALYSIS_MODEL",
     "get_image_summary",
     "generate_dream_analysis",
+    "stream_dream_analysis_text",
     "generate_dream_image",
     "discuss_emotions_function",
     "predict_future_function",
@@ -24,6 +34,12 @@ __all__ = [
     "analyze_dream_signs_function",
     "track_lucidity_progress_function",
     "regular_chat",
+    "stream_regular_chat",
     "call_function_by_name",
     "search_chat_with_dreams",
+    "stream_search_chat_with_dreams",
+    "get_openai_breaker_stats",
+    "get_coalescing_stats",
+    "get_chat_session_stats",
+    "get_rate_limit_stats",
 ]
\ No newline at end of file
@@ -1,8 +1,11 @@
 from agentlogger import log
-import requests
+import os
 import json
+import openai
+import requests
 import configparser
 import random
+import threading
 
 from easycompletion import (
     compose_function,
@@ -11,6 +14,24 @@ from easycompletion import (
     chat_completion,
     count_tokens,
 )
+from lucidserver.resilience import (
+    CircuitBreaker,
+    RetryPolicy,
+    UpstreamError,
+    CircuitOpenError,
+    RateLimitedError,
+    RateLimiter,
+    PriorityGate,
+    BACKGROUND,
+    call_with_retries,
+    calling_as,
+    current_caller,
+    is_retryable_status,
+)
+from lucidserver.http import get_http_client
+from lucidserver.cache import SingleFlight
+from lucidserver.history import ChatHistory, create_session_store
+from lucidserver.jobs import job_queue, QueueFullError
 
 # Read config.ini file
 config = configparser.ConfigParser()
@@ -19,15 +40,229 @@ config.read("lucidserver/actions/config.ini")
 # Get the API key from the config file
 openai_api_key = config.get("openai", "api_key")
 
-# This dictionary will store the message history for each user
-message_histories = {}
+# Model used for dream analyses, also part of the analysis cache key
+ANALYSIS_MODEL = "gpt-3.5-turbo"
+
+# Model used for chat and dream search chat
+CHAT_MODEL = "gpt-3.5-turbo-16k"
+
+# Model the images API uses by default, the key of its rate limits
+IMAGE_MODEL = "dall-e-2"
+
+# Conversation state of each user, see ChatHistory; in this process or shared with other workers
+chat_sessions = create_session_store()
+
+# Circuit breakers shared by every call to the OpenAI APIs, so a failing upstream fails fast
+completion_breaker = CircuitBreaker(
+    "openai-completions",
+    failure_threshold=int(os.environ.get("OPENAI_BREAKER_THRESHOLD", 5)),
+    reset_timeout=float(os.environ.get("OPENAI_BREAKER_RESET", 30)),
+)
+image_breaker = CircuitBreaker(
+    "openai-images",
+    failure_threshold=int(os.environ.get("OPENAI_BREAKER_THRESHOLD", 5)),
+    reset_timeout=float(os.environ.get("OPENAI_BREAKER_RESET", 30)),
+)
+# Pooled connections to the OpenAI API; image generation can take a while to respond
+openai_http = get_http_client(
+    "openai",
+    connect_timeout=float(os.environ.get("OPENAI_CONNECT_TIMEOUT", 5)),
+    read_timeout=float(os.environ.get("OPENAI_READ_TIMEOUT", 120)),
+)
+openai_retry_policy = RetryPolicy(
+    max_attempts=int(os.environ.get("OPENAI_MAX_ATTEMPTS", 4)),
+    deadline=float(os.environ.get("OPENAI_RETRY_DEADLINE", 60)),
+)
+
+# Per-user limits in front of each OpenAI model, so one user can't use up the organization's quota
+user_completion_limiter = RateLimiter(
+    "openai-completions-per-user",
+    rate=float(os.environ.get("USER_COMPLETIONS_PER_MINUTE", 30)) / 60,
+    burst=int(os.environ.get("USER_COMPLETIONS_BURST", 10)),
+)
+user_image_limiter = RateLimiter(
+    "openai-images-per-user",
+    rate=float(os.environ.get("USER_IMAGES_PER_MINUTE", 5)) / 60,
+    burst=int(os.environ.get("USER_IMAGES_BURST", 3)),
+)
+# Organization-wide calls per minute of each OpenAI model
+OPENAI_COMPLETIONS_PER_MINUTE = float(os.environ.get("OPENAI_COMPLETIONS_PER_MINUTE", 3500))
+OPENAI_IMAGES_PER_MINUTE = float(os.environ.get("OPENAI_IMAGES_PER_MINUTE", 50))
+# How long calls wait for capacity before failing with RateLimitedError
+INTERACTIVE_MAX_WAIT = float(os.environ.get("RATE_LIMIT_INTERACTIVE_WAIT", 5))
+BACKGROUND_MAX_WAIT = float(os.environ.get("RATE_LIMIT_BACKGROUND_WAIT", 60))
+
+# Organization-wide gate of each model, created on first use
+openai_gates = {}
+openai_gates_lock = threading.Lock()
+
+# OpenAI client errors worth retrying when calling the SDK directly
+RETRYABLE_OPENAI_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.APIConnectionError,
+    openai.error.Timeout,
+    openai.error.ServiceUnavailableError,
+    openai.error.TryAgain,
+)
+
+# easycompletion errors caused by the request itself, retrying them cannot help
+NON_RETRYABLE_COMPLETION_ERRORS = (
+    "Message too long",
+    "functions is required",
+    "functions must be a list of functions or a single function",
+    "text is required",
+    "Function names must be unique",
+    "function_call had an invalid name",
+)
+
+
+def get_openai_gate(model):
+    """Return the organization-wide PriorityGate of an OpenAI model."""
+    with openai_gates_lock:
+        gate = openai_gates.get(model)
+        if gate is None:
+            per_minute = OPENAI_IMAGES_PER_MINUTE if model == IMAGE_MODEL else OPENAI_COMPLETIONS_PER_MINUTE
+            # Allow bursts of up to ten seconds' worth of calls
+            gate = PriorityGate(f"openai-{model}", rate=per_minute / 60, burst=max(1, int(per_minute / 6)))
+            openai_gates[model] = gate
+        return gate
+
+
+def admit_openai_call(model):
+    """Wait for capacity to call an OpenAI model for the current caller, see calling_as.
+
+    Interactive callers over their own limit are refused straight away and wait
+    at most INTERACTIVE_MAX_WAIT for the organization's limit. Background callers
+    wait up to BACKGROUND_MAX_WAIT for both, behind interactive ones.
+    A call the organization's limit refuses is given back to the user's.
+
+    Args:
+        model (str): The model about to be called.
+
+    Raises:
+        RateLimitedError: If the call may not be made now.
+    """
+    user, priority = current_caller()
+    background = priority >= BACKGROUND
+    max_wait = BACKGROUND_MAX_WAIT if background else INTERACTIVE_MAX_WAIT
+    if user is None:
+        get_openai_gate(model).acquire(priority, max_wait=max_wait)
+        return
+    limiter = user_image_limiter if model == IMAGE_MODEL else user_completion_limiter
+    limiter.acquire((user, model), max_wait=max_wait if background else 0)
+    try:
+        get_openai_gate(model).acquire(priority, max_wait=max_wait)
+    except RateLimitedError:
+        # The call is not made, so it doesn't count against the user
+        limiter.release((user, model))
+        raise
+
+
+def get_rate_limit_stats():
+    """Return the counters of the per-user and organization-wide OpenAI rate limits."""
+    with openai_gates_lock:
+        gates = dict(openai_gates)
+    return {
+        "per_user": {
+            "completions": user_completion_limiter.stats(),
+            "images": user_image_limiter.stats(),
+        },
+        "models": {model: gate.stats() for model, gate in gates.items()},
+    }
+
+
+def checked_completion(completion, **kwargs):
+    """Make a single easycompletion call and raise UpstreamError if it reports an error."""
+    response = completion(model_failure_retries=1, **kwargs)
+    error = response.get("error")
+    if error:
+        retryable = not str(error).startswith(NON_RETRYABLE_COMPLETION_ERRORS)
+        raise UpstreamError(f"OpenAI completion failed: {error}", retryable=retryable)
+    return response
+
+
+def openai_completion(completion, max_attempts=None, **kwargs):
+    """Call an easycompletion function with backoff, jitter, a deadline and the completions circuit breaker.
+
+    Args:
+        completion (callable): text_completion, chat_completion or function_completion.
+        max_attempts (int, optional): Overrides the default number of attempts. Defaults to None.
+        **kwargs: Arguments for the completion function.
+
+    Returns:
+        dict: The successful completion response.
+
+    Raises:
+        RateLimitedError: If the caller is over its rate limit, see admit_openai_call.
+        UpstreamError: If every attempt failed or the circuit is open.
+    """
+    admit_openai_call(kwargs.get("model", ANALYSIS_MODEL))
+    return call_with_retries(
+        checked_completion,
+        completion,
+        breaker=completion_breaker,
+        policy=openai_retry_policy,
+        max_attempts=max_attempts,
+        **kwargs,
+    )
+
+
+def post_image_generation(data):
+    """POST a single request to the OpenAI images API and return its JSON body.
+
+    Raises:
+        UpstreamError: On an error status or a response without image data.
+    """
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {openai_api_key}",
+    }
+    response = openai_http.post(
+        "https://api.openai.com/v1/images/generations",
+        data=json.dumps(data),
+        headers=headers,
+    )
+    if response.status_code >= 400:
+        retry_after = response.headers.get("Retry-After")
+        raise UpstreamError(
+            f"OpenAI images API returned {response.status_code}: {response.text}",
+            retryable=is_retryable_status(response.status_code),
+            retry_after=float(retry_after) if retry_after and retry_after.isdigit() else None,
+        )
+    response_data = response.json()
+    if not response_data.get("data"):
+        raise UpstreamError(f"No data in OpenAI images response: {response_data}", retryable=False)
+    return response_data
+
+
+# Identical requests in flight at the same time share one upstream call. The
+# leader's rate limit and a breaker that opened before its call say nothing
+# about the other callers, who make the call themselves instead.
+CALLER_ERRORS = (RateLimitedError, CircuitOpenError)
+image_summary_flights = SingleFlight("image_summary", private_errors=CALLER_ERRORS)
+analysis_flights = SingleFlight("analysis", private_errors=CALLER_ERRORS)
+image_flights = SingleFlight("image", private_errors=CALLER_ERRORS)
+
+
+def get_coalescing_stats():
+    """Return how many OpenAI calls were saved by coalescing identical in-flight requests."""
+    return {flight.name: flight.stats() for flight in (image_summary_flights, analysis_flights, image_flights)}
+
+
+def get_openai_breaker_stats():
+    """Return the state of the OpenAI circuit breakers."""
+    return {
+        "completions": completion_breaker.stats(),
+        "images": image_breaker.stats(),
+    }
 
 
 # ANALYSIS AND IMAGE GENERATION FUNCTIONS
-def get_image_summary(dream_entry):
+def request_image_summary(dream_entry):
     try:
         log(f"Generating summary for dream entry: {dream_entry}", type="info")
-        response = text_completion(
+        response = openai_completion(
+            text_completion,
             text=f"Awaken to the depths of your subconscious, where dreams transcend reality. Describe the enigmatic tale of your nocturnal journey, where the ethereal dance of {dream_entry} beguiles the senses. Condense this profound experience into a succinct prompt, grounding the essence of your dream in the realms of research, literature, science, mysticism, and ancient wisdom. This prompt will guide the DALLE AI image generation tool by OpenAI, all in under 100 characters.",
             model="gpt-3.5-turbo",
             api_key=openai_api_key,
@@ -35,102 +270,237 @@ def get_image_summary(dream_entry):
 
         log(f"Dream summary response: {response}", type="info")
 
-        if "error" in response and response["error"] is not None:
-            log(f"Error from GPT-4: {response['error']}",
-                type="error", color="red")
-
         if "text" in response:
             return response["text"]
         else:
             log("Error: Unable to generate a summary.", type="error", color="red")
             return "Error: Unable to generate a summary."
+    except RateLimitedError:
+        raise
     except Exception as e:
         log(f"Error generating Dream summary: {e}", type="error", color="red")
         return "Error: Unable to generate a summary."
 
 
-def generate_dream_analysis(prompt, system_content, intelligence_level='general'):
+def get_image_summary(dream_entry):
+    """Summarize a dream entry into an image prompt, sharing the call with identical requests in flight."""
+    return image_summary_flights.do(dream_entry, request_image_summary, dream_entry)
+
+
+def build_dream_analysis_context(prompt, intelligence_level='general'):
+    """Build the analysis prompt for a dream entry at the given intelligence level."""
+    # Base Context Information
+    base_context = """
+    You are a Dream Analyst AI, equipped with knowledge in psychology, philosophy, literature, science, mysticism, and ancient wisdom.
+    """
+
+    # Framework for Analysis
+    framework = f"""
+    You must analyze the dream within the following framework:
+    1: Psychological Underpinnings: Examine the dream through the lens of psychology.
+    2: Philosophical Context: Evaluate the dream's implications on existential questions.
+    3: Literary Narratives: Compare the dream to any well-known stories or myths.
+    4: Scientific Facts: What do the latest scientific studies say about such dreams?
+    5: Mystical Interpretations: Are there any mystical or spiritual aspects to consider?
+    6: Ancient Wisdom: How would this dream be interpreted in ancient cultures?
+    7: Physiological Meanings: What physiological factors might contribute to such dreams?
+    """
+
+    # Character Limit Based on Intelligence Level
+    char_limit = {
+        'simplified': 150,
+        'general': 300,
+        'detailed': 400,
+        'expert': 500,
+        'research': 600,
+    }
+
+    # Intelligence Level Instruction and Context
+    if intelligence_level == 'simplified':
+        context = f"{base_context} Your task is to provide a simplified, jargon-free explanation of the dream. You are addressing an individual who prefers straightforward and easy-to-understand interpretations. Explain it to them like they are 10. The dream is as follows: {prompt} {framework} Your analysis should be up to {char_limit['simplified']} characters."
+    elif intelligence_level == 'general':
+        context = f"{base_context} Your task is to provide a balanced, comprehensive explanation of the dream. You are addressing an individual who prefers a well-rounded view. The dream is as follows: {prompt} {framework} Your analysis should be up to {char_limit['general']} characters."
+    elif intelligence_level == 'detailed':
+        context = f"{base_context} Your task is to provide a detailed, nuanced explanation of the dream. You are addressing an individual who appreciates depth and complexity. The dream is as follows: {prompt} {framework} Your analysis should be up to {char_limit['detailed']} characters."
+    elif intelligence_level == 'expert':
+        context = f"{base_context} Your task is to provide an expert-level, technical explanation of the dream. You are addressing an expert in the field of dream analysis. The dream is as follows: {prompt} {framework} Your analysis should be up to {char_limit['expert']} characters."
+    elif intelligence_level == 'research':
+        context = f"{base_context} Your task is to provide an academic-level explanation of the dream with citations. You are addressing an academic researcher. The dream is as follows: {prompt} {framework} Your analysis should be up to {char_limit['research']} characters."
+    else:
+        context = f"{base_context} Your task is to provide a general-level explanation of the dream. The dream is as follows: {prompt} {framework} Your analysis should be up to {char_limit['general']} characters."
+    return context
+
+
+def request_dream_analysis(prompt, system_content, intelligence_level='general', max_attempts=None):
     try:
         log(f"Generating GPT response for dream analysis: {prompt}", type="info")
-
-        # Base Context Information
-        base_context = """
-        You are a Dream Analyst AI, equipped with knowledge in psychology, philosophy, literature, science, mysticism, and ancient wisdom.
-        """
-
-        # Framework for Analysis
-        framework = f"""
-        You must analyze the dream within the following framework:
-        1: Psychological Underpinnings: Examine the dream through the lens of psychology.
-        2: Philosophical Context: Evaluate the dream's implications on existential questions.
-        3: Literary Narratives: Compare the dream to any well-known stories or myths.
-        4: Scientific Facts: What do the latest scientific studies say about such dreams?
-        5: Mystical Interpretations: Are there any mystical or spiritual aspects to consider?
-        6: Ancient Wisdom: How would this dream be interpreted in ancient cultures?
-        7: Physiological Meanings: What physiological factors might contribute to such dreams?
-        """
-
-        # Character Limit Based on Intelligence Level
-        char_limit = {
-            'simplified': 150,
-            'general': 300,
-            'detailed': 400,
-            'expert': 500,
-            'research': 600,
-        }
-
-        # Intelligence Level Instruction and Context
-        if intelligence_level == 'simplified':
-            context = f"{base_context} Your task is to provide a simplified, jargon-free explanation of the dream. You are addressing an individual who prefers straightforward and easy-to-understand interpretations. Explain it to them like they are 10. The dream is as follows: {prompt} {framework} Your analysis should be up to {char_limit['simplified']} characters."
-        elif intelligence_level == 'general':
-            context = f"{base_context} Your task is to provide a balanced, comprehensive explanation of the dream. You are addressing an individual who prefers a well-rounded view. The dream is as follows: {prompt} {framework} Your analysis should be up to {char_limit['general']} characters."
-        elif intelligence_level == 'detailed':
-            context = f"{base_context} Your task is to provide a detailed, nuanced explanation of the dream. You are addressing an individual who appreciates depth and complexity. The dream is as follows: {prompt} {framework} Your analysis should be up to {char_limit['detailed']} characters."
-        elif intelligence_level == 'expert':
-            context = f"{base_context} Your task is to provide an expert-level, technical explanation of the dream. You are addressing an expert in the field of dream analysis. The dream is as follows: {prompt} {framework} Your analysis should be up to {char_limit['expert']} characters."
-        elif intelligence_level == 'research':
-            context = f"{base_context} Your task is to provide an academic-level explanation of the dream with citations. You are addressing an academic researcher. The dream is as follows: {prompt} {framework} Your analysis should be up to {char_limit['research']} characters."
-        else:
-            context = f"{base_context} Your task is to provide a general-level explanation of the dream. The dream is as follows: {prompt} {framework} Your analysis should be up to {char_limit['general']} characters."
+        context = build_dream_analysis_context(prompt, intelligence_level)
 
         # Generate Response
-        response = text_completion(
+        response = openai_completion(
+            text_completion,
+            max_attempts=max_attempts,
             text=context,
-            model="gpt-3.5-turbo",
+            model=ANALYSIS_MODEL,
             api_key=openai_api_key,
         )
 
         log(f"GPT-3.5-turbo response: {response}", type="info")
 
-        if "error" in response and response["error"] is not None:
-            log(f"Error from GPT-3.5-turbo: {response['error']}",
-                type="error", color="red")
-
         if "text" in response:
             return response["text"]
         else:
             log("Error: Unable to generate a response.", type="error", color="red")
             return "Error: Unable to generate a response."
 
+    except RateLimitedError:
+        raise
     except Exception as e:
         log(f"Error generating GPT response: {e}", type="error", color="red")
         return "Error: Unable to generate a response."
 
 
-def generate_dream_image(dreams, dream_id, style="renaissance", quality="low"):
+def generate_dream_analysis(prompt, system_content, intelligence_level='general', max_attempts=None):
+    """Analyze a dream entry, sharing the call with identical requests in flight.
+
+    Args:
+        prompt (str): Dream entry to analyze.
+        system_content (str): Prefix of the analysis prompt.
+        intelligence_level (str, optional): Level of the analysis. Defaults to 'general'.
+        max_attempts (int, optional): Overrides the default number of attempts. Defaults to None.
+
+    Returns:
+        str: The analysis, or an "Error:" message.
+
+    Raises:
+        RateLimitedError: If the caller is over its rate limit.
+    """
+    key = (prompt, intelligence_level, ANALYSIS_MODEL)
+    return analysis_flights.do(key, request_dream_analysis, prompt, system_content, intelligence_level, max_attempts)
+
+
+def open_completion_stream(messages, model=ANALYSIS_MODEL, **params):
+    """Start a streamed chat completion and return its chunk iterator.
+
+    Raises:
+        UpstreamError: If OpenAI refuses or fails to start the stream.
+    """
     try:
-        log(f"Debug: dream_id type: {type(dream_id)}, value: {dream_id}", type="info")
-        log(
-            f"Starting image generation for dream id: {dream_id}, style: {style}, quality: {quality}", type="info")
-        # Compare as strings
-        dream = next((d for d in dreams if d["id"] == dream_id), None)
+        return openai.ChatCompletion.create(
+            model=model,
+            messages=messages,
+            temperature=0.0,
+            stream=True,
+            api_key=openai_api_key,
+            request_timeout=openai_http.timeout,
+            **params,
+        )
+    except openai.error.OpenAIError as e:
+        raise UpstreamError(
+            f"OpenAI stream failed to start: {e}",
+            retryable=isinstance(e, RETRYABLE_OPENAI_ERRORS) or (e.http_status or 0) >= 500,
+        )
+
+
+def stream_completion_deltas(messages, model=ANALYSIS_MODEL, max_attempts=None, **params):
+    """Yield the deltas of a chat completion as OpenAI generates them.
+
+    Opening the stream is retried with backoff behind the completions circuit
+    breaker; once deltas have been yielded a failure can no longer be retried.
+
+    Args:
+        messages (list): Chat messages to send.
+        model (str, optional): Model to use. Defaults to ANALYSIS_MODEL.
+        max_attempts (int, optional): Overrides the default number of attempts. Defaults to None.
+        **params: Extra completion parameters, e.g. functions and function_call.
+
+    Yields:
+        dict: Delta of each chunk, in order.
+
+    Raises:
+        UpstreamError: If the stream cannot be opened or breaks off.
+    """
+    admit_openai_call(model)
+    chunks = call_with_retries(
+        open_completion_stream,
+        messages,
+        model=model,
+        breaker=completion_breaker,
+        policy=openai_retry_policy,
+        max_attempts=max_attempts,
+        **params,
+    )
+    try:
+        for chunk in chunks:
+            yield chunk["choices"][0].get("delta", {})
+    except (openai.error.OpenAIError, requests.exceptions.RequestException) as e:
+        completion_breaker.record_failure()
+        raise UpstreamError(f"OpenAI stream interrupted: {e}")
+
+
+def stream_completion_text(messages, model=ANALYSIS_MODEL, max_attempts=None):
+    """Yield the text of a chat completion as OpenAI generates it, see stream_completion_deltas."""
+    for delta in stream_completion_deltas(messages, model=model, max_attempts=max_attempts):
+        text = delta.get("content")
+        if text:
+            yield text
+
+
+def stream_function_arguments(function, messages, model=CHAT_MODEL, max_attempts=None):
+    """Yield the JSON arguments of a forced function call as OpenAI generates them.
+
+    Args:
+        function (dict): Function definition the model must call.
+        messages (list): Chat messages to send.
+        model (str, optional): Model to use. Defaults to CHAT_MODEL.
+        max_attempts (int, optional): Overrides the default number of attempts. Defaults to None.
+
+    Yields:
+        str: Fragments of the arguments JSON, which only parses once complete.
+    """
+    for delta in stream_completion_deltas(
+        messages,
+        model=model,
+        max_attempts=max_attempts,
+        functions=[function],
+        function_call={"name": function["name"]},
+    ):
+        fragment = delta.get("function_call", {}).get("arguments")
+        if fragment:
+            yield fragment
+
+
+def stream_dream_analysis_text(prompt, intelligence_level='general', max_attempts=None):
+    """Yield a dream analysis as it is generated, see stream_completion_text.
+
+    Args:
+        prompt (str): Dream entry to analyze.
+        intelligence_level (str, optional): Level of the analysis. Defaults to 'general'.
+        max_attempts (int, optional): Overrides the default number of attempts. Defaults to None.
+
+    Yields:
+        str: Analysis text deltas.
+    """
+    log(f"Streaming GPT response for dream analysis: {prompt}", type="info")
+    context = build_dream_analysis_context(prompt, intelligence_level)
+    yield from stream_completion_text(
+        [{"role": "user", "content": context}], model=ANALYSIS_MODEL, max_attempts=max_attempts
+    )
 
+
+def request_dream_image(dream, style="renaissance", quality="low", summary=None, max_attempts=None):
+    try:
         if not dream:
-            log(f"Dream with id {dream_id} not found in the provided dreams list.", type="warning")
+            log("No dream provided for image generation.", type="warning")
             return None
 
-        log(f"Found dream with id: {dream_id}. Proceeding with image generation.", type="info")
-        summary = get_image_summary(dream["metadata"]["entry"])
+        dream_id = dream.get("id")
+        log(
+            f"Starting image generation for dream id: {dream_id}, style: {style}, quality: {quality}", type="info")
+
+        # Reuse the caller's summary so retries don't pay for another completion
+        if summary is None:
+            summary = get_image_summary(dream["metadata"]["entry"])
         log(f"Image summary obtained: {summary}", type="info")
 
         # Adjust prompt based on style
@@ -164,38 +534,59 @@ def generate_dream_image(dreams, dream_id, style="renaissance", quality="low"):
             "size": resolution,
         }
 
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {openai_api_key}",
-        }
-
         log(f"Sending request to OpenAI API with data: {data}", type="info")
-        response = requests.post(
-            "https://api.openai.com/v1/images/generations",
-            data=json.dumps(data),
-            headers=headers,
+        admit_openai_call(IMAGE_MODEL)
+        response_data = call_with_retries(
+            post_image_generation,
+            data,
+            breaker=image_breaker,
+            policy=openai_retry_policy,
+            max_attempts=max_attempts,
         )
-
-        response_data = response.json()
         log(f"Received response from OpenAI API: {response_data}", type="info")
 
-        if "data" in response_data and len(response_data["data"]) > 0:
-            image_data = response_data["data"][0]
-            log(f"Generated image URL: {image_data['url']}", type="info")
-            return image_data["url"]
-        else:
-            log(
-                "Error generating dream-inspired image: No data in response",
-                type="error",
-                color="red",
-            )
-            return None
+        image_data = response_data["data"][0]
+        log(f"Generated image URL: {image_data['url']}", type="info")
+        return image_data["url"]
+    except RateLimitedError:
+        raise
     except Exception as e:
         log(f"Error generating dream-inspired image: {e}",
             type="error", color="red")
         return None
 
 
+def request_and_store_dream_image(dream, style, quality, summary, max_attempts, store):
+    image = request_dream_image(dream, style, quality, summary, max_attempts)
+    if image and store is not None:
+        return store(image)
+    return image
+
+
+def generate_dream_image(dream, style="renaissance", quality="low", summary=None, max_attempts=None, store=None):
+    """Generate an image for a dream, sharing the call with identical requests in flight.
+
+    Requests for the same dream, style and quality made while one is already
+    running wait for it and get the same result, so the image is generated,
+    and stored, once.
+
+    Args:
+        store (callable, optional): Called with the generated image's URL
+            inside the shared call, its result is returned instead of the
+            URL. Defaults to None.
+
+    Returns:
+        str: Image URL, or what store returned for it, or None if generation failed.
+
+    Raises:
+        RateLimitedError: If the caller is over its rate limit.
+    """
+    if not dream:
+        return request_dream_image(dream, style, quality, summary, max_attempts)
+    key = (dream.get("id"), dream["metadata"]["entry"], style, quality, store)
+    return image_flights.do(key, request_and_store_dream_image, dream, style, quality, summary, max_attempts, store)
+
+
 # SEARCH WITH CHAT FUNCTIONS
 discuss_emotions_function = compose_function(
     name="discuss_emotions",
@@ -308,69 +699,191 @@ available_functions = [
 ]
 
 
-def regular_chat(message, user_email):
-    global message_histories  # Access the global dictionary
+# Standing system prompt of regular_chat, sent once per request and never stored in the history
+CHAT_SYSTEM_PROMPT = """
+    Let's delve deeper into the realm of dreams. Draw upon the vast reservoirs of knowledge about dreams from different perspectives - scientific, psychological, philosophical, and mystical. Interpret the dream imagery, unravel its symbolism, and explore its relevance to the dreamer's waking life and personal growth.
+
+    In the context of lucid dreaming, discuss techniques for inducing lucidity, the benefits and potential challenges of lucid dreaming, and its implications for understanding consciousness and the human mind.
+
+    Weave this understanding into a comprehensive response that provides valuable insights and guidance to the dreamer, all within the constraints of 500 characters.
+    """
+
+
+def summarize_chat_history(summary, messages):
+    """Fold older chat messages into the running summary of a conversation.
+
+    Args:
+        summary (str): Previous summary, or None.
+        messages (list): Messages to fold in, oldest first.
+
+    Returns:
+        str: The new summary.
+
+    Raises:
+        UpstreamError: If OpenAI could not be called.
+    """
+    transcript = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+    previous = f"Summary of the conversation so far: {summary}\n\n" if summary else ""
+    # Housekeeping rather than a request of the user: it doesn't use up their
+    # own limit and yields to interactive calls for the organization's
+    with calling_as(None, BACKGROUND):
+        response = openai_completion(
+            text_completion,
+            text=f"{previous}Condense the following conversation between a dreamer and a dream guide into a summary of under 150 words. Keep the dreams, themes and open questions discussed.\n\n{transcript}",
+            model=ANALYSIS_MODEL,
+            api_key=openai_api_key,
+        )
+    return response["text"]
+
+
+chat_history = ChatHistory(
+    count_tokens=lambda text: count_tokens(text, model=CHAT_MODEL),
+    token_budget=int(os.environ.get("CHAT_TOKEN_BUDGET", 6000)),
+    history_budget=int(os.environ.get("CHAT_HISTORY_TOKEN_BUDGET", 3000)),
+    summarize=summarize_chat_history,
+)
+
+
+def load_chat_state(user_email):
+    """Return the user's conversation state, or a new one."""
+    state = chat_sessions.load(user_email)
+    if state is None:
+        log(f"Initializing new message history for user: {user_email}", type="info")
+        return ChatHistory.new_state()
+    return state
+
+
+def get_chat_session_stats():
+    """Return the size and eviction counters of the chat session store."""
+    return chat_sessions.stats()
+
 
+def build_chat_messages(user_email, turn, system_prompt=None):
+    """Return the messages for a turn: system prompt, history within the token budget, then the turn."""
+    return chat_history.build_messages(load_chat_state(user_email), turn, system_prompt)
+
+
+# Users whose history is being compacted by a job in this process
+pending_compactions = set()
+pending_compactions_lock = threading.Lock()
+
+
+def compact_chat_history(user_email, previous_summary, messages):
+    """Summarize old messages of a user's history and replace them with the summary.
+
+    Runs as a background job. The user's state is only locked while the
+    summary is applied, unless another compaction already applied one.
+    """
     try:
-        log(f"Generating GPT response for message: {message}", type="info")
+        summary = chat_history.compact(previous_summary, messages)
+        return chat_sessions.update(
+            user_email,
+            lambda state: chat_history.apply_compaction(state, previous_summary, messages, summary),
+        )
+    finally:
+        with pending_compactions_lock:
+            pending_compactions.discard(user_email)
 
-        # Retrieve the user's history, or initialize a new one if it does not exist yet
-        if user_email not in message_histories:
-            message_histories[user_email] = []
-            log(
-                f"Initializing new message history for user: {user_email}", type="info")
-        else:
-            log(
-                f"Retrieved existing message history for user: {user_email}", type="info")
 
-        all_messages = message_histories[user_email]
+def record_chat_turn(user_email, messages, topic=None):
+    """Add the messages of a completed turn to the user's history.
 
-        # Provide a default prompt for lucid dreaming conversation
-        if not message:
-            message = "Let's talk about the fascinating world of lucid dreaming."
+    Summarizing old messages calls OpenAI, so it is left to a background job
+    and the turn does not wait for it. Until the summary is applied the
+    messages stay in the history, and build_messages keeps to the budget.
 
-        initial_message = """
-            Let's delve deeper into the realm of dreams. Draw upon the vast reservoirs of knowledge about dreams from different perspectives - scientific, psychological, philosophical, and mystical. Interpret the dream imagery, unravel its symbolism, and explore its relevance to the dreamer's waking life and personal growth.
+    Returns:
+        Job: The compaction job, or None if none was started.
+    """
+    def append(state):
+        return state["summary"], chat_history.append(state, messages, topic)
+
+    previous_summary, overflow = chat_sessions.update(user_email, append)
+    if not overflow:
+        return None
+    with pending_compactions_lock:
+        if user_email in pending_compactions:
+            return None
+        pending_compactions.add(user_email)
+    try:
+        # Not the user's own request, so it doesn't use up their rate limit
+        return job_queue.submit("chat-compaction", compact_chat_history, user_email, previous_summary, overflow)
+    except QueueFullError as e:
+        with pending_compactions_lock:
+            pending_compactions.discard(user_email)
+        log(f"Not compacting the chat history of {user_email} this turn: {e}", type="warning")
+        return None
 
-            In the context of lucid dreaming, discuss techniques for inducing lucidity, the benefits and potential challenges of lucid dreaming, and its implications for understanding consciousness and the human mind.
 
-            Weave this understanding into a comprehensive response that provides valuable insights and guidance to the dreamer, all within the constraints of 500 characters.
-            """
+def build_chat_turn(message):
+    """Build the user message for one regular_chat turn."""
+    # Provide a default prompt for lucid dreaming conversation
+    if not message:
+        message = "Let's talk about the fascinating world of lucid dreaming."
+    return [{"role": "user", "content": message}]
 
-        # Combine system_message and user message
-        all_messages += [
-            {"role": "system", "content": initial_message},
-            {"role": "user", "content": message}
-        ]
 
-        response = chat_completion(
+def regular_chat(message, user_email):
+    try:
+        log(f"Generating GPT response for message: {message}", type="info")
+
+        turn = build_chat_turn(message)
+        all_messages = build_chat_messages(user_email, turn, CHAT_SYSTEM_PROMPT)
+
+        response = openai_completion(
+            chat_completion,
             messages=all_messages,
-            model='gpt-3.5-turbo-16k',
+            model=CHAT_MODEL,
             api_key=openai_api_key
         )
 
         log(f"GPT-4 response: {response}", type="info")
 
-        if "error" in response and response["error"] is not None:
-            log(f"Error from GPT-4: {response['error']}",
-                type="error", color="red")
-
         if "text" in response:
-            # Add the system's response to the message history
-            all_messages.append(
-                {"role": "system", "content": response["text"]})
-            log(f"Added system message: {response['text']}", type="info")
+            # Add the turn and the response to the message history
+            record_chat_turn(user_email, turn + [{"role": "assistant", "content": response["text"]}])
+            log(f"Added assistant message: {response['text']}", type="info")
 
             return response["text"]
         else:
             log("Error: Unable to generate a response.", type="error", color="red")
             return "Error: Unable to generate a response."
+    except RateLimitedError:
+        raise
     except Exception as e:
         log(f"Error generating GPT response: {e}", type="error", color="red")
         return "Error: Unable to generate a response."
 
 
-def call_function_by_name(function_name, prompt, messages):
+def stream_regular_chat(message, user_email):
+    """Yield the chat response as it is generated, see regular_chat.
+
+    The turn is added to the user's history only once the stream completes.
+
+    Args:
+        message (str): The user's message.
+        user_email (str): Email of the user.
+
+    Yields:
+        str: Response text deltas.
+
+    Raises:
+        UpstreamError: If the completion stream fails.
+    """
+    log(f"Streaming GPT response for message: {message}", type="info")
+    turn = build_chat_turn(message)
+    all_messages = build_chat_messages(user_email, turn, CHAT_SYSTEM_PROMPT)
+
+    parts = []
+    for text in stream_completion_text(all_messages, model=CHAT_MODEL):
+        parts.append(text)
+        yield text
+
+    record_chat_turn(user_email, turn + [{"role": "assistant", "content": "".join(parts)}])
+
+
+def select_function(function_name):
+    """Return the available function with this name, or a random one if unknown."""
     # Get the corresponding function from the available_functions dictionary
     function_to_call = next(
         (func for func in available_functions if func["name"]
@@ -385,6 +898,11 @@ def call_function_by_name(function_name, prompt, messages):
             color="yellow",
         )
         function_to_call = random.choice(available_functions)
+    return function_to_call
+
+
+def call_function_by_name(function_name, prompt, messages):
+    function_to_call = select_function(function_name)
 
     all_messages = []
 
@@ -392,78 +910,90 @@ def call_function_by_name(function_name, prompt, messages):
         all_messages += messages
 
     # Call the selected function
-    response = function_completion(
-        text=prompt,  # Use the last user message as the text for the function call
-        messages=all_messages,  # Include the message history
-        functions=[function_to_call],
-        function_call=function_to_call["name"],
-        api_key=openai_api_key,
-        model='gpt-3.5-turbo-16k'  # Set the model to 'gpt-3.5-turbo-16k'
-    )
+    try:
+        response = openai_completion(
+            function_completion,
+            text=prompt,  # Use the last user message as the text for the function call
+            messages=all_messages,  # Include the message history
+            functions=[function_to_call],
+            function_call=function_to_call["name"],
+            api_key=openai_api_key,
+            model=CHAT_MODEL
+        )
+    except RateLimitedError:
+        raise
+    except UpstreamError as e:
+        log(f"Function completion failed: {e}", type="error", color="red")
+        return {"error": str(e)}
 
     return response
 
 
-# Initialize a stack to keep track of topics discussed in the current session
-topic_stack = []
+def build_search_chat_turn(function_name, prompt, user_email):
+    """Search the user's dreams and build the system and user messages for one search chat turn.
 
-def search_chat_with_dreams(function_name, prompt, user_email, messages=None):
+    The dream context is only sent with this turn; the history keeps just the
+    user's prompt and the reply, see record_chat_turn.
+
+    Returns:
+        tuple: (cognitive_prompt, turn messages, search_results, topic of the turn or None)
+    """
     from lucidserver.memories import search_dreams  # Assuming the import is correct
-    global message_histories, topic_stack  # Access global variables
 
-    try:
-        log(f"Received prompt: {prompt}", type="info")
+    turn = []
+    topic = None
+    # Stack of the topics discussed with this user, the turn's topic is pushed once it completes
+    topic_stack = list(load_chat_state(user_email)["topics"])
 
-        if messages is None:
-            messages = []
+    # Count tokens in the prompt
+    prompt_tokens = count_tokens(prompt)
+    log(f"Token count for the prompt: {prompt_tokens}", type="info")
 
-        if user_email not in message_histories:
-            message_histories[user_email] = []
-            log(f"Initializing new message history for user: {user_email}", type="info")
-        else:
-            log(f"Retrieved existing message history for user: {user_email}", type="info")
+    # Search for relevant dreams
+    search_results = search_dreams(prompt, user_email)
 
-        all_messages = message_histories[user_email]
+    # Initial cognitive loop entry
+    cognitive_prompt = f"Ah, {user_email}. Your inquiry cascades through layers of cognitive and emotional paradigms. I surmise you're interested in {function_name}. Allow me to weave the threads of your subconscious tapestry."
 
-        # Count tokens in the prompt
-        prompt_tokens = count_tokens(prompt)
-        log(f"Token count for the prompt: {prompt_tokens}", type="info")
+    # Add dream data if available
+    if search_results:
+        log("Search results found. Adding to all_messages list.", type="info")
+        for dream in search_results[:3]:
+            message = f"A reverberation from your past dream, titled '{dream['metadata']['title']}', dated {dream['metadata']['date']}, has surfaced. The dream whispers: '{dream['metadata']['entry']}'. It has been psychoanalyzed as: '{dream['metadata'].get('analysis', 'Analysis not available')}'."
+            turn.append({"role": "system", "content": message})
+            log(f"Added system message: {message}", type="info")
 
-        # Search for relevant dreams
-        search_results = search_dreams(prompt, user_email)
+        # Recursive Query Prompt
+        recursive_prompt = f"Your past dreams seem to resonate with the theme of '{search_results[0]['metadata']['title']}'. Would you like to explore this theme further?"
+        turn.append({"role": "system", "content": recursive_prompt})
+        topic = search_results[0]['metadata']['title']
+        topic_stack.append(topic)
+    else:
+        cognitive_prompt += " However, the echos of past dreams are silent. Shall we venture into uncharted territories of your subconscious?"
 
-        # Initial cognitive loop entry
-        cognitive_prompt = f"Ah, {user_email}. Your inquiry cascades through layers of cognitive and emotional paradigms. I surmise you're interested in {function_name}. Allow me to weave the threads of your subconscious tapestry."
+    # Meta-Cognitive Prompt
+    meta_cognitive_prompt = "As we tread this kaleidoscopic mindscape, how do you feel about the insights unraveled so far?"
+    turn.append({"role": "system", "content": meta_cognitive_prompt})
 
-        # Add dream data if available
-        if search_results:
-            log("Search results found. Adding to all_messages list.", type="info")
-            for dream in search_results[:3]:
-                message = f"A reverberation from your past dream, titled '{dream['metadata']['title']}', dated {dream['metadata']['date']}, has surfaced. The dream whispers: '{dream['metadata']['entry']}'. It has been psychoanalyzed as: '{dream['metadata'].get('analysis', 'Analysis not available')}'."
-                all_messages.append({"role": "system", "content": message})
-                log(f"Added system message: {message}", type="info")
+    # Dynamic Function Re-routing based on the stack
+    if topic_stack:
+        next_function = f"Would you like to switch the focus to discussing '{topic_stack[-1]}' in your dreams?"
+        turn.append({"role": "system", "content": next_function})
 
-            # Recursive Query Prompt
-            recursive_prompt = f"Your past dreams seem to resonate with the theme of '{search_results[0]['metadata']['title']}'. Would you like to explore this theme further?"
-            all_messages.append({"role": "system", "content": recursive_prompt})
-            topic_stack.append(search_results[0]['metadata']['title'])
-        else:
-            cognitive_prompt += " However, the echos of past dreams are silent. Shall we venture into uncharted territories of your subconscious?"
+    # Add final cognitive loop summary
+    cognitive_summary = f"To summarize our cognitive journey: We've sifted through {len(search_results) if search_results else 0} past dreams, pondered upon themes like '{topic_stack[-1] if topic_stack else 'None'}', and dabbled in meta-cognitive reflections. What's our next voyage?"
+    turn.append({"role": "system", "content": cognitive_summary})
 
-        # Meta-Cognitive Prompt
-        meta_cognitive_prompt = "As we tread this kaleidoscopic mindscape, how do you feel about the insights unraveled so far?"
-        all_messages.append({"role": "system", "content": meta_cognitive_prompt})
+    turn.append({"role": "user", "content": prompt})
+    return cognitive_prompt, turn, search_results, topic
 
-        # Dynamic Function Re-routing based on the stack
-        if topic_stack:
-            next_function = f"Would you like to switch the focus to discussing '{topic_stack[-1]}' in your dreams?"
-            all_messages.append({"role": "system", "content": next_function})
 
-        # Add final cognitive loop summary
-        cognitive_summary = f"To summarize our cognitive journey: We've sifted through {len(search_results) if search_results else 0} past dreams, pondered upon themes like '{topic_stack[-1] if topic_stack else 'None'}', and dabbled in meta-cognitive reflections. What's our next voyage?"
-        all_messages.append({"role": "system", "content": cognitive_summary})
+def search_chat_with_dreams(function_name, prompt, user_email, messages=None):
+    try:
+        log(f"Received prompt: {prompt}", type="info")
 
-        all_messages.append({"role": "user", "content": prompt})
+        cognitive_prompt, turn, search_results, topic = build_search_chat_turn(function_name, prompt, user_email)
+        all_messages = build_chat_messages(user_email, turn)
         log(f"Final messages: {all_messages}", type="info")
 
         response = call_function_by_name(function_name, cognitive_prompt, all_messages)
@@ -475,11 +1005,55 @@ def search_chat_with_dreams(function_name, prompt, user_email, messages=None):
             return "Error: Unable to generate a response."
 
         if "arguments" in response:
+            record_chat_turn(user_email, [turn[-1], {"role": "assistant", "content": json.dumps(response["arguments"])}], topic)
             response["search_results"] = search_results
             return response
         else:
             log("Error: Unable to generate a response.", type="error", color="red")
             return "Error: Unable to generate a response."
+    except RateLimitedError:
+        raise
     except Exception as e:
         log(f"Error generating GPT response with search: {e}", type="error", color="red")
-        return "Error: Unable to generate a response."
\ No newline at end of file
+        return "Error: Unable to generate a response."
+
+
+def stream_search_chat_with_dreams(function_name, prompt, user_email):
+    """Yield the events of a search chat turn as the function call is generated.
+
+    Yields ("search_results", dreams) first, then ("arguments", {"delta": ...})
+    for each fragment of the arguments JSON, and finally ("done", {...}) with
+    the parsed arguments. The turn is added to the user's history only once
+    the stream completes.
+
+    Args:
+        function_name (str): Name of the function the model should call.
+        prompt (str): The user's prompt.
+        user_email (str): Email of the user.
+
+    Yields:
+        tuple: (event name, JSON-serializable data)
+
+    Raises:
+        UpstreamError: If the stream fails or the arguments are not valid JSON.
+    """
+    log(f"Streaming search chat for prompt: {prompt}", type="info")
+    cognitive_prompt, turn, search_results, topic = build_search_chat_turn(function_name, prompt, user_email)
+    yield "search_results", search_results
+
+    function_to_call = select_function(function_name)
+    # Same message layout as function_completion: history, then the prompt as a user message
+    all_messages = build_chat_messages(user_email, turn) + [{"role": "user", "content": cognitive_prompt}]
+
+    fragments = []
+    for fragment in stream_function_arguments(function_to_call, all_messages):
+        fragments.append(fragment)
+        yield "arguments", {"delta": fragment}
+
+    try:
+        arguments = json.loads("".join(fragments))
+    except json.JSONDecodeError as e:
+        raise UpstreamError(f"Function call arguments are not valid JSON: {e}", retryable=False)
+
+    record_chat_turn(user_email, [turn[-1], {"role": "assistant", "content": "".join(fragments)}], topic)
+    yield "done", {"function_name": function_to_call["name"], "arguments": arguments}
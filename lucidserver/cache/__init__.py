@@ -0,0 +1,11 @@
+from .main import (
+    LRUCache,
+    PersistentLRUCache,
+    SingleFlight,
+)
+
+__all__ = [
+    "LRUCache",
+    "PersistentLRUCache",
+    "SingleFlight",
+]
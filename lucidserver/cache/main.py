@@ -0,0 +1,264 @@
+import copy
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Thread-safe, size-bounded LRU cache with an optional time-to-live.
+
+    Values are deep-copied on the way in and out so callers can freely mutate
+    what they get back without corrupting the cached entry.
+
+    Args:
+        max_size (int, optional): Maximum number of entries. Defaults to 1024.
+        ttl (float, optional): Seconds an entry stays fresh, None for no expiry. Defaults to None.
+        copy_values (bool, optional): Deep-copy values on set and get. Defaults to True.
+    """
+
+    def __init__(self, max_size=1024, ttl=None, copy_values=True):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.copy_values = copy_values
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _copy(self, value):
+        return copy.deepcopy(value) if self.copy_values else value
+
+    def get(self, key, default=None):
+        """Return the cached value for key, or default if missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return self._copy(value)
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        """Store value under key, evicting the least recently used entries if full.
+
+        Args:
+            key: Cache key.
+            value: Value to store.
+            ttl (float, optional): Overrides the cache TTL for this entry. Defaults to None.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._entries[key] = (self._copy(value), expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """Remove key from the cache if present."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Remove every entry and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and (entry[1] is None or entry[1] > time.monotonic())
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def stats(self):
+        """Return hit, miss and eviction counters along with the current size."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+            }
+
+
+class PersistentLRUCache:
+    """Size-bounded LRU cache stored in a SQLite file so entries survive restarts.
+
+    Values must be JSON serializable. The file can be shared by several worker
+    processes; SQLite serializes the writes.
+
+    Args:
+        path (str): Path of the SQLite database, ":memory:" for a throwaway cache.
+        max_size (int, optional): Maximum number of entries. Defaults to 10000.
+    """
+
+    def __init__(self, path, max_size=10000):
+        self.path = path
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS cache_last_used ON cache (last_used)"
+            )
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """Return the cached value for key, or default if missing."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return default
+            with self._connection:
+                self._connection.execute(
+                    "UPDATE cache SET last_used = ? WHERE key = ?", (time.time(), key)
+                )
+            self.hits += 1
+            return json.loads(row[0])
+
+    def set(self, key, value):
+        """Store value under key, evicting the least recently used entries if full."""
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO cache (key, value, last_used) VALUES (?, ?, ?)",
+                (key, json.dumps(value), time.time()),
+            )
+            evicted = self._connection.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY last_used ASC "
+                "LIMIT max(0, (SELECT COUNT(*) FROM cache) - ?))",
+                (self.max_size,),
+            ).rowcount
+            self.evictions += max(evicted, 0)
+
+    def invalidate(self, key):
+        """Remove key from the cache if present."""
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def clear(self):
+        """Remove every entry and reset the counters."""
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM cache")
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._connection.execute(
+                "SELECT 1 FROM cache WHERE key = ?", (key,)
+            ).fetchone() is not None
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def stats(self):
+        """Return hit, miss and eviction counters along with the current size."""
+        size = len(self)
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "size": size,
+            "max_size": self.max_size,
+        }
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into a single call.
+
+    The first caller for a key runs the function; callers arriving while it is
+    in flight wait for it and get the same result, or the same exception.
+    Exceptions that only concern the leader, e.g. its rate limit, are not
+    shared: a waiting caller that would get one makes the call itself.
+    Nothing is remembered once the call finishes, see LRUCache for that.
+
+    Args:
+        name (str): Name used in the stats.
+        private_errors (tuple, optional): Exception types not shared with waiting callers. Defaults to ().
+    """
+
+    def __init__(self, name, private_errors=()):
+        self.name = name
+        self.private_errors = tuple(private_errors)
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.coalesced = 0
+        self.reruns = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        """Call fn(*args, **kwargs), or wait for the in-flight call with the same key.
+
+        Returns:
+            The result of the shared call.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = {"done": threading.Event(), "result": None, "error": None}
+                self._calls[key] = call
+                self.calls += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call["done"].wait()
+            if isinstance(call["error"], self.private_errors):
+                with self._lock:
+                    self.reruns += 1
+                return fn(*args, **kwargs)
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = fn(*args, **kwargs)
+            return call["result"]
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call["done"].set()
+
+    def stats(self):
+        """Return how many calls were made and how many were saved by coalescing."""
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "coalesced": self.coalesced,
+                "reruns": self.reruns,
+                "in_flight": len(self._calls),
+            }
@@ -1,41 +1,206 @@
-from flask import Flask, request, jsonify, Response
+from flask import Flask, request, jsonify, Response, send_file
 from functools import wraps
+from werkzeug.wsgi import wrap_file
 import os
+import re
+import math
+import hashlib
+import time
+import threading
+import contextvars
 import jwt
-import requests
 import json
-from webargs import fields
+from marshmallow import Schema, ValidationError, EXCLUDE
+from webargs import fields, validate
 from webargs.flaskparser import use_args
 from lucidserver.memories import (
     create_dream,
+    create_dreams,
     get_dreams,
+    get_dreams_page,
     get_dream,
     update_dream_analysis_and_image,
     get_dream_analysis,
+    stream_dream_analysis,
     get_dream_image,
+    generate_and_save_dream_analysis,
+    generate_and_save_dream_image,
     search_dreams,
     delete_dream,
-    export_dreams_to_pdf
+    open_dreams_pdf,
+    iter_dreams_export,
+    EXPORT_FORMATS,
+    get_dream_cache_stats,
+    get_dream_index_stats,
+    get_analysis_cache_stats,
 )
-from lucidserver.actions import search_chat_with_dreams, regular_chat
+from lucidserver.actions import (
+    search_chat_with_dreams,
+    stream_search_chat_with_dreams,
+    regular_chat,
+    stream_regular_chat,
+    get_openai_breaker_stats,
+    get_chat_session_stats,
+    get_coalescing_stats,
+    get_rate_limit_stats,
+)
+from lucidserver.cache import LRUCache
+from lucidserver.jobs import job_queue, QueueFullError
+from lucidserver.http import get_http_client, get_http_stats
+from lucidserver.resilience import RateLimitedError, calling_as
+from lucidserver.images import image_store, get_image_store_stats, public_image_url
+from lucidserver.exports import artifact_store, create_export, get_export_stats, EXPORT_JOB_FORMATS
 from agentlogger import log
 import traceback
 
 
+# Page sizes for GET /api/dreams when the client asks for pagination
+DEFAULT_DREAMS_PAGE_SIZE = 50
+MAX_DREAMS_PAGE_SIZE = 200
+
+# Longest a GET /api/jobs/<job_id> request may wait for the job to finish
+MAX_JOB_WAIT_SECONDS = 30
+
+# Seconds clients and proxies may cache a stored image, they never change
+IMAGE_MAX_AGE = 31536000
+
+
+APPLE_JWKS_URL = "https://appleid.apple.com/auth/keys"
+
+# Pooled connections to Apple's key endpoint, sized for the occasional JWKS fetch
+apple_http = get_http_client(
+    "apple",
+    connect_timeout=float(os.environ.get("APPLE_CONNECT_TIMEOUT", 3)),
+    read_timeout=float(os.environ.get("APPLE_READ_TIMEOUT", 10)),
+    pool_maxsize=2,
+)
+
+
+class JWKSCache:
+    """Cache of JSON Web Key Set public keys indexed by kid.
+
+    Keys are refreshed in the background once the cache lifetime (Cache-Control
+    max-age, or `ttl` when absent) runs out, while the current keys keep being
+    served. An unknown kid triggers a synchronous re-fetch; concurrent misses
+    share a single fetch, and re-fetches for unknown kids are spaced at least
+    `min_refresh_interval` seconds apart.
+
+    Args:
+        url (str): JWKS endpoint.
+        ttl (float, optional): Key lifetime when the response has no max-age. Defaults to 3600.
+        min_refresh_interval (float, optional): Minimum seconds between fetches caused by unknown kids. Defaults to 60.
+    """
+
+    def __init__(self, url, ttl=3600, min_refresh_interval=60):
+        self.url = url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.keys = {}
+        self.expires_at = 0.0
+        self.fetched_at = None
+        self.fetch_count = 0
+        self._fetch_lock = threading.Lock()
+        self._background_lock = threading.Lock()
+        self._background_refresh = None
+
+    def fetch(self):
+        """Download the key set and return ({kid: public_key}, lifetime in seconds)."""
+        response = apple_http.get(self.url)
+        response.raise_for_status()
+        keys = {
+            key_dict["kid"]: jwt.algorithms.RSAAlgorithm.from_jwk(json.dumps(key_dict))
+            for key_dict in response.json()["keys"]
+        }
+        max_age = re.search(r"max-age=(\d+)", response.headers.get("Cache-Control", ""))
+        lifetime = int(max_age.group(1)) if max_age else self.ttl
+        return keys, lifetime
+
+    def refresh(self, unknown_kid=None):
+        """Fetch the key set unless another thread already did so.
+
+        Args:
+            unknown_kid (str, optional): Kid that caused the refresh; skips the fetch if it
+                appeared meanwhile or a fetch happened too recently. Defaults to None.
+        """
+        with self._fetch_lock:
+            now = time.monotonic()
+            if unknown_kid is not None:
+                if unknown_kid in self.keys:
+                    return
+                if self.fetched_at is not None and now - self.fetched_at < self.min_refresh_interval:
+                    return
+            keys, lifetime = self.fetch()
+            self.fetch_count += 1
+            self.keys = keys
+            self.fetched_at = time.monotonic()
+            self.expires_at = self.fetched_at + lifetime
+            log(f"Refreshed JWKS from {self.url}, {len(keys)} keys valid for {lifetime}s", type="info")
+
+    def refresh_in_background(self):
+        """Start a background refresh unless one is already running."""
+        with self._background_lock:
+            if self._background_refresh is not None and self._background_refresh.is_alive():
+                return
+            self._background_refresh = threading.Thread(target=self._safe_refresh, daemon=True)
+            self._background_refresh.start()
+
+    def _safe_refresh(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            log(f"Background JWKS refresh failed, keeping cached keys: {e}", type="error")
+
+    def get_key(self, kid):
+        """Return the public key for kid.
+
+        Raises:
+            Exception: If no key with this kid exists after a re-fetch.
+        """
+        key = self.keys.get(kid)
+        if key is not None:
+            if time.monotonic() >= self.expires_at:
+                self.refresh_in_background()
+            return key
+
+        self.refresh(unknown_kid=kid)
+        key = self.keys.get(kid)
+        if key is None:
+            raise Exception(f"No matching key found for kid {kid}")
+        return key
+
+
+apple_jwks = JWKSCache(
+    os.environ.get("APPLE_JWKS_URL", APPLE_JWKS_URL),
+    ttl=float(os.environ.get("APPLE_JWKS_TTL", 3600)),
+)
+
+
 def get_apple_public_key(kid):
-    keys = requests.get("https://appleid.apple.com/auth/keys").json()["keys"]
-    for key_dict in keys:
-        if key_dict["kid"] == kid:
-            public_key = jwt.algorithms.RSAAlgorithm.from_jwk(
-                json.dumps(key_dict))
-            return public_key
-    raise Exception(f"No matching key found for kid {kid}")
+    return apple_jwks.get_key(kid)
+
+
+# Claims of already verified tokens keyed by token digest, each kept until the token's exp
+verified_token_cache = LRUCache(
+    max_size=int(os.environ.get("VERIFIED_TOKEN_CACHE_SIZE", 4096)),
+)
 
 
 def decode_and_verify_token(id_token):
+    digest = hashlib.sha256(id_token.encode("utf-8")).hexdigest()
+    claims = verified_token_cache.get(digest)
+    if claims is not None:
+        return claims
+
     header = jwt.get_unverified_header(id_token)
     public_key = get_apple_public_key(header["kid"])
-    return jwt.decode(id_token, public_key, audience="com.jamesfeura.lucidjournal", algorithms=['RS256'])
+    claims = jwt.decode(id_token, public_key, audience="com.jamesfeura.lucidjournal", algorithms=['RS256'])
+
+    # Only tokens that expire are cached, and never beyond their expiry
+    if "exp" in claims:
+        remaining = claims["exp"] - time.time()
+        if remaining > 0:
+            verified_token_cache.set(digest, claims, ttl=remaining)
+    return claims
 
 
 def extract_user_email_from_token(id_token):
@@ -49,10 +214,14 @@ def handle_jwt_token(func):
         try:
             id_token = request.headers.get("Authorization").split(" ")[1]
             userEmail = extract_user_email_from_token(id_token)
-            return func(*args, **kwargs, userEmail=userEmail)
+            # Upstream calls made for this request count against the user's rate limits
+            with calling_as(userEmail):
+                return func(*args, **kwargs, userEmail=userEmail)
         except jwt.InvalidTokenError:
             log(f"Invalid ID token", type="error")
             return jsonify({"error": "Invalid ID token"}), 401
+        except RateLimitedError as e:
+            return too_many_requests(f"Rate limited: {e}", e.retry_after)
         except Exception as e:
             log(
                 f"Unhandled exception occurred: {traceback.format_exc()}", type="error")
@@ -60,6 +229,139 @@ def handle_jwt_token(func):
     return wrapper
 
 
+def service_unavailable(message, retry_after=5):
+    """Build a 503 response asking the client to retry later."""
+    log(message, type="error", color="red")
+    response = jsonify({"error": message})
+    response.headers["Retry-After"] = str(retry_after)
+    return response, 503
+
+
+def retry_after_seconds(retry_after):
+    """Round a retry delay up to the whole seconds of a Retry-After header."""
+    return max(1, math.ceil(retry_after or 1))
+
+
+def too_many_requests(message, retry_after=None):
+    """Build a 429 response telling the client when it may try again."""
+    log(message, type="warning")
+    response = jsonify({"error": "Too many requests, try again later."})
+    response.headers["Retry-After"] = str(retry_after_seconds(retry_after))
+    return response, 429
+
+
+def sse_event(event, data):
+    """Format one Server-Sent Event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def wants_event_stream():
+    """Whether the client opted into a Server-Sent Events response."""
+    streaming = request.args.get("stream", default="false", type=str).lower() == "true"
+    return streaming or request.accept_mimetypes.best == "text/event-stream"
+
+
+def sse_stream(events, error_message):
+    """Yield (event, data) pairs as SSE text, ending with an error event if they fail."""
+    # Flush the headers straight away, before the model produces its first token
+    yield ": stream started\n\n"
+    try:
+        for event, data in events:
+            yield sse_event(event, data)
+    except RateLimitedError as e:
+        log(f"Rate limited: {e}", type="warning")
+        yield sse_event("error", {"error": "Too many requests, try again later.",
+                                  "retry_after": retry_after_seconds(e.retry_after)})
+    except Exception as e:
+        log(f"{error_message} {e}", type="error", color="red")
+        yield sse_event("error", {"error": error_message})
+
+
+def token_events(stream, *args, done=None, **kwargs):
+    """Turn a text stream into token events followed by a done event."""
+    for text in stream(*args, **kwargs):
+        yield "token", {"text": text}
+    yield "done", done or {}
+
+
+def run_in_context(context, iterator):
+    """Iterate in the given context, so a stream keeps the caller set by calling_as."""
+    while True:
+        try:
+            yield context.run(next, iterator)
+        except StopIteration:
+            return
+
+
+def stream_events(events, error_message):
+    """Build a text/event-stream response that reaches the client unbuffered."""
+    # The body is generated after the view returns, outside its calling_as block
+    body = run_in_context(contextvars.copy_context(), sse_stream(events, error_message))
+    response = Response(body, mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+# Bytes per chunk when streaming exports to the client
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+# Most dreams accepted by one bulk import request
+BULK_MAX_DREAMS = int(os.environ.get("BULK_MAX_DREAMS", 5000))
+
+# Content types of newline-delimited JSON request bodies
+NDJSON_MIMETYPES = ("application/x-ndjson", "application/jsonl", "application/json-seq")
+
+
+def read_bulk_items():
+    """Read the items of a bulk request: a JSON list, {"dreams": [...]}, or NDJSON lines.
+
+    Returns:
+        list: The items, with None for NDJSON lines that are not valid JSON, or None if the body is unreadable.
+    """
+    if request.mimetype in NDJSON_MIMETYPES:
+        items = []
+        for line in request.get_data(as_text=True).splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except json.JSONDecodeError:
+                items.append(None)
+        return items
+    body = request.get_json(silent=True)
+    if isinstance(body, dict):
+        body = body.get("dreams")
+    return body if isinstance(body, list) else None
+
+
+def with_image_url(dream):
+    """Return a dream with its stored image as a URL on the host the request came to."""
+    if not dream or not dream.get("image"):
+        return dream
+    return {**dream, "image": public_image_url(dream["image"], request.host_url)}
+
+
+def job_response(job):
+    """Build the status of a job, with the URL of the image an image job saved."""
+    data = job.to_dict()
+    if job.kind == "image" and data["result"]:
+        data["result"] = public_image_url(data["result"], request.host_url)
+    return data
+
+
+def submit_job(kind, fn, *args, owner=None, params=None):
+    """Queue a background job and build the 202 response pointing at its status."""
+    try:
+        job = job_queue.submit(kind, fn, *args, owner=owner, params=params)
+    except QueueFullError as e:
+        log(f"Rejected {kind} job for {owner}: {e}", type="error")
+        return service_unavailable("Server is busy, try again later.")
+    response = jsonify(job_response(job))
+    response.headers["Location"] = f"/api/jobs/{job.id}"
+    return response, 202
+
+
 # Define all your endpoints here, and use the app object passed as an argument to bind them
 def register_endpoints(app):
 
@@ -75,6 +377,17 @@ def register_endpoints(app):
         "id_token": fields.Str(required=True),
     }
 
+    # Items of a bulk import, the token comes from the Authorization header instead
+    bulk_dream_schema = Schema.from_dict({name: field for name, field in dream_args.items() if name != "id_token"})(unknown=EXCLUDE)
+
+    # Query parameters of a journal page
+    dreams_page_schema = Schema.from_dict({
+        "limit": fields.Int(validate=validate.Range(min=1), load_default=DEFAULT_DREAMS_PAGE_SIZE),
+        "cursor": fields.Str(validate=validate.Length(min=1), load_default=None),
+        "order_by": fields.Str(validate=validate.OneOf(["created_at", "date"]), load_default="created_at"),
+        "order": fields.Str(validate=validate.OneOf(["asc", "desc"]), load_default="desc"),
+    })(unknown=EXCLUDE)
+
     update_dream_args = {
         "analysis": fields.Str(),
         "image": fields.Str(),
@@ -91,6 +404,7 @@ def register_endpoints(app):
 
     search_args = {
         "query": fields.Str(required=True),
+        "n_results": fields.Int(load_default=100, validate=validate.Range(min=1)),  # Optional, max dreams to return
     }
     
     # Placeholder for user's image style preferences
@@ -120,7 +434,8 @@ def register_endpoints(app):
                 args.get("lucidity"),
                 args.get("characters"),
                 args.get("emotions"),
-                args.get("setting")
+                args.get("setting"),
+                intelligence_level=user_intelligence_preferences.get(userEmail, {}).get("level", "general"),
             )
 
             if dream_data is None or "id" not in dream_data:
@@ -133,7 +448,7 @@ def register_endpoints(app):
 
             log(f"Successfully created dream with UUID {uuid_from_dream} and data {dream_data}", type="info")
 
-            response_data = {"uuid": uuid_from_dream, "dream": dream_data["dream"]}
+            response_data = {"uuid": uuid_from_dream, "dream": dream_data["dream"], "jobs": dream_data.get("jobs", [])}
 
             return jsonify(response_data), 200
 
@@ -162,17 +477,64 @@ def register_endpoints(app):
                 f"Successfully updated dream with dream_id {dream_id} and data {dream}",
                 type="info",
             )
-            return jsonify(dream), 200
+            return jsonify(with_image_url(dream)), 200
         except Exception as e:
             log(
                 f"Unhandled exception occurred: {traceback.format_exc()}", type="error")
             return jsonify({"error": "Internal server error"}), 500
 
+    @app.route("/api/dreams/bulk", methods=["POST"])
+    @handle_jwt_token
+    def bulk_create_dreams_endpoint(userEmail):
+        items = read_bulk_items()
+        if not items:
+            return jsonify({"error": "Expected a list of dreams or NDJSON lines."}), 400
+        if len(items) > BULK_MAX_DREAMS:
+            return jsonify({"error": f"At most {BULK_MAX_DREAMS} dreams can be imported at once."}), 413
+
+        # Validate every item first, then store the valid ones in batches
+        results = [None] * len(items)
+        valid = []
+        for index, item in enumerate(items):
+            if item is None:
+                results[index] = {"index": index, "status": "invalid", "errors": {"_schema": ["Invalid JSON."]}}
+                continue
+            try:
+                valid.append((index, bulk_dream_schema.load(item)))
+            except ValidationError as e:
+                results[index] = {"index": index, "status": "invalid", "errors": e.messages}
+
+        for (index, _), result in zip(valid, create_dreams([dream for _, dream in valid], userEmail)):
+            results[index] = {"index": index, **result}
+
+        created = sum(1 for result in results if result["status"] == "created")
+        log(f"Bulk import for {userEmail}: {created} of {len(items)} dreams created.", type="info")
+        return jsonify({"created": created, "failed": len(items) - created, "results": results}), 200
+
     @app.route("/api/dreams", methods=["GET"], endpoint='get_dreams_endpoint')
     @handle_jwt_token
     def get_dreams_endpoint(userEmail):
-        dreams = get_dreams(userEmail)
-        return jsonify(dreams), 200
+        # Without paging parameters, keep returning the whole journal as a plain list
+        if "limit" not in request.args and "cursor" not in request.args:
+            dreams = get_dreams(userEmail)
+            return jsonify([with_image_url(dream) for dream in dreams]), 200
+
+        try:
+            args = dreams_page_schema.load(request.args)
+        except ValidationError as e:
+            log(f"Invalid dreams page request from user {userEmail}: {e.messages}", type="error")
+            return jsonify({"error": "Invalid query parameters.", "errors": e.messages}), 400
+        limit = min(args["limit"], MAX_DREAMS_PAGE_SIZE)
+
+        try:
+            page = get_dreams_page(userEmail, limit=limit, cursor=args["cursor"], order_by=args["order_by"],
+                                   descending=args["order"] == "desc")
+        except ValueError as e:
+            log(f"Invalid dreams page request from user {userEmail}: {e}", type="error")
+            return jsonify({"error": str(e)}), 400
+
+        page["dreams"] = [with_image_url(dream) for dream in page["dreams"]]
+        return jsonify(page), 200
 
     @app.route("/api/dreams/<dream_id>", methods=["GET"])
     @handle_jwt_token
@@ -182,7 +544,7 @@ def register_endpoints(app):
             log(f"Dream with id {dream_id} not found.", type="error")
             return jsonify({"error": f"Dream with id {dream_id} not found."}), 404
         log(f"Successfully fetched dream with id {dream_id}", type="info")
-        return jsonify(dream), 200
+        return jsonify(with_image_url(dream)), 200
 
     @app.route("/api/dreams/<string:dream_id>/analysis", methods=["GET"])
     @handle_jwt_token
@@ -199,10 +561,37 @@ def register_endpoints(app):
             log(f"Unauthorized access attempt to dream with id {dream_id} by user {userEmail}.", type="error")
             return jsonify({"error": "Unauthorized access."}), 401
 
-        analysis = get_dream_analysis(dream_id, intelligence_level)
+        # Clients can ask for a fresh analysis instead of the cached one
+        bypass_cache = request.args.get("refresh", default="false", type=str).lower() == "true"
+
+        # Stream tokens as Server-Sent Events when asked to
+        if wants_event_stream():
+            events = token_events(stream_dream_analysis, dream_id, intelligence_level, done={"dream_id": dream_id},
+                                  bypass_cache=bypass_cache, dream=dream)
+            return stream_events(events, f"Could not generate analysis for dream {dream_id}.")
+
+        analysis = get_dream_analysis(dream_id, intelligence_level, bypass_cache=bypass_cache)
+        if analysis is None:
+            return service_unavailable(f"Could not generate analysis for dream {dream_id}.")
         log(f"Successfully retrieved analysis for dream_id {dream_id}: {analysis}", type="info")
         return jsonify(analysis)
 
+    @app.route("/api/dreams/<string:dream_id>/analysis", methods=["POST"])
+    @handle_jwt_token
+    def start_dream_analysis_job_endpoint(dream_id, userEmail):
+        body = request.get_json(silent=True) or {}
+        saved_intelligence_level = user_intelligence_preferences.get(userEmail, {}).get("level", "general")
+        intelligence_level = body.get("intelligence_level", saved_intelligence_level)
+
+        dream = get_dream(dream_id)
+        if dream is None or dream["metadata"]["useremail"] != userEmail:
+            log(f"Unauthorized access attempt to dream with id {dream_id} by user {userEmail}.", type="error")
+            return jsonify({"error": "Unauthorized access."}), 401
+
+        params = {"dream_id": dream_id, "intelligence_level": intelligence_level}
+        return submit_job("analysis", generate_and_save_dream_analysis, dream_id, intelligence_level,
+                          owner=userEmail, params=params)
+
     @app.route("/api/user/intelligence-level", methods=["POST"])
     @handle_jwt_token
     def update_intelligence_level(userEmail):
@@ -228,11 +617,114 @@ def register_endpoints(app):
             userEmail, {}).get("style", "renaissance")
         userPreferredQuality = user_style_preferences.get(
             userEmail, {}).get("quality", "low")
+        # Clients can ask for a new image instead of the stored one
+        bypass_cache = request.args.get("refresh", default="false", type=str).lower() == "true"
         image = get_dream_image(
-            dream_id, userPreferredStyle, userPreferredQuality)
+            dream_id, userPreferredStyle, userPreferredQuality, dream=dream, bypass_cache=bypass_cache)
+        if image is None:
+            return service_unavailable(f"Could not generate image for dream {dream_id}.")
         log(
             f"Successfully retrieved image for dream_id {dream_id}", type="info")
-        return jsonify({"image": image})
+        return jsonify({"image": public_image_url(image, request.host_url)})
+
+    @app.route("/api/images/<string:digest>", methods=["GET"])
+    def get_image_endpoint(digest):
+        # Images are named by the hash of their content, so they never change and can be cached forever
+        size = request.args.get("size", default=None, type=int)
+        if not image_store.exists(digest):
+            return jsonify({"error": "Image not found."}), 404
+        if size is not None and not image_store.exists(digest, size):
+            size = None  # No thumbnail this size, the original is small enough
+        response = send_file(
+            image_store.path(digest, size),
+            mimetype="image/png",
+            etag=digest if size is None else f"{digest}-{size}",
+            max_age=IMAGE_MAX_AGE,
+            conditional=True,
+        )
+        response.cache_control.immutable = True
+        return response
+
+    @app.route("/api/dreams/<string:dream_id>/image", methods=["POST"])
+    @handle_jwt_token
+    def start_dream_image_job_endpoint(dream_id, userEmail):
+        dream = get_dream(dream_id)
+        if dream is None or dream["metadata"]["useremail"] != userEmail:
+            log(f"Error occurred: Dream with id {dream_id} not found.",
+                type="error", color="red")
+            return jsonify({"error": f"Dream with id {dream_id} not found."}), 404
+        body = request.get_json(silent=True) or {}
+        style = body.get("style", user_style_preferences.get(userEmail, {}).get("style", "renaissance"))
+        quality = body.get("quality", user_style_preferences.get(userEmail, {}).get("quality", "low"))
+
+        params = {"dream_id": dream_id, "style": style, "quality": quality}
+        return submit_job("image", generate_and_save_dream_image, dream_id, style, quality,
+                          owner=userEmail, params=params)
+
+    @app.route("/api/jobs/<string:job_id>", methods=["GET"])
+    @handle_jwt_token
+    def get_job_endpoint(job_id, userEmail):
+        job = job_queue.get(job_id)
+        if job is None or job.owner != userEmail:
+            return jsonify({"error": f"Job with id {job_id} not found."}), 404
+
+        # Long-poll: hold the request until the job finishes or the wait runs out
+        wait = request.args.get("wait", default=0, type=float)
+        if wait > 0 and not job.done:
+            job.wait(min(wait, MAX_JOB_WAIT_SECONDS))
+
+        return jsonify(job_response(job)), 200
+
+    @app.route("/api/exports", methods=["POST"])
+    @handle_jwt_token
+    def start_export_job_endpoint(userEmail):
+        body = request.get_json(silent=True) or {}
+        format = body.get("format", "pdf")
+        compress = bool(body.get("gzip", False))
+        if format not in EXPORT_JOB_FORMATS:
+            return jsonify({"error": f"Unknown export format {format}."}), 400
+        if compress and not EXPORT_JOB_FORMATS[format][2]:
+            return jsonify({"error": f"{format} exports cannot be compressed."}), 400
+
+        params = {"format": format, "gzip": compress}
+        return submit_job("export", create_export, userEmail, format, compress, owner=userEmail, params=params)
+
+    @app.route("/api/exports/<string:artifact_id>", methods=["GET"])
+    @handle_jwt_token
+    def download_export_endpoint(artifact_id, userEmail):
+        artifact = artifact_store.get(artifact_id)
+        if artifact is None or artifact["owner"] != userEmail:
+            return jsonify({"error": "Export not found or expired."}), 404
+        # Conditional responses answer Range requests, so large downloads can resume
+        response = send_file(
+            artifact_store.path(artifact_id),
+            mimetype=artifact["mimetype"],
+            as_attachment=True,
+            download_name=artifact["filename"],
+            etag=artifact_id,
+            conditional=True,
+        )
+        response.cache_control.private = True
+        return response
+
+    @app.route("/api/stats", methods=["GET"])
+    @handle_jwt_token
+    def get_stats_endpoint(userEmail):
+        # Per-process counters: connection reuse, cache hit rates, circuit and job queue state
+        return jsonify({
+            "http": get_http_stats(),
+            "dream_cache": get_dream_cache_stats(),
+            "dream_index": get_dream_index_stats(),
+            "analysis_cache": get_analysis_cache_stats(),
+            "verified_token_cache": verified_token_cache.stats(),
+            "openai_breakers": get_openai_breaker_stats(),
+            "chat_sessions": get_chat_session_stats(),
+            "coalescing": get_coalescing_stats(),
+            "rate_limits": get_rate_limit_stats(),
+            "images": get_image_store_stats(),
+            "exports": get_export_stats(),
+            "jobs": job_queue.stats(),
+        }), 200
 
     @app.route("/api/user/image-style", methods=["POST"])
     @handle_jwt_token
@@ -254,7 +746,7 @@ def register_endpoints(app):
     @use_args(search_args)
     @handle_jwt_token
     def search_dreams_endpoint(args, userEmail):
-        dreams = search_dreams(args["query"], userEmail)
+        dreams = search_dreams(args["query"], userEmail, n_results=args["n_results"])
         log(f"Successfully retrieved search results: {dreams}", type="info")
         return jsonify(dreams)
 
@@ -262,6 +754,9 @@ def register_endpoints(app):
     @use_args(regular_chat_args)
     @handle_jwt_token
     def chat_endpoint(args, userEmail):
+        if wants_event_stream():
+            return stream_events(token_events(stream_regular_chat, args["message"], userEmail),
+                                 "Unable to generate a response.")
         response = regular_chat(args["message"], userEmail)
         log(f"Successfully retrieved chat response: {response}", type="info")
         return jsonify({"response": response})
@@ -270,6 +765,9 @@ def register_endpoints(app):
     @use_args(chat_args)
     @handle_jwt_token
     def search_chat_with_dreams_endpoint(args, userEmail):
+        if wants_event_stream():
+            events = stream_search_chat_with_dreams(args["function_name"], args["prompt"], userEmail)
+            return stream_events(events, "Unable to generate a response.")
         response = search_chat_with_dreams(
             args["function_name"], args["prompt"], userEmail)
         log(
@@ -301,25 +799,33 @@ def register_endpoints(app):
     @handle_jwt_token
     def export_dreams_to_pdf_endpoint(userEmail):
         try:
-            # Generate the path for the PDF file
-            path = "./dreams.pdf"
-
-            # Call the export_dreams_to_pdf function
-            export_dreams_to_pdf(path=path, userEmail=userEmail)
-
-            # Read the generated PDF into memory
-            with open(path, 'rb') as file:
-                pdf_data = file.read()
-
-            # Prepare and return the PDF file as a HTTP response
-            response = Response(pdf_data, mimetype="application/pdf")
-            response.headers["Content-Disposition"] = "attachment; filename=dreams.pdf"
-
-            # Delete the PDF file from the server to free up resources
-            os.remove(path)
-
-            return response
-
+            # Rendered in the export pool into a file of this request's own
+            pdf_file = open_dreams_pdf(userEmail)
         except Exception as e:
             log(f"Failed to export dreams to PDF. Error: {e}", type="error")
-            return jsonify({"error": "Failed to export dreams to PDF"}), 500
\ No newline at end of file
+            return jsonify({"error": "Failed to export dreams to PDF"}), 500
+
+        # Stream the PDF in chunks, the file is closed once it has been sent
+        response = Response(wrap_file(request.environ, pdf_file, buffer_size=EXPORT_CHUNK_SIZE),
+                            mimetype="application/pdf", direct_passthrough=True)
+        response.headers["Content-Disposition"] = "attachment; filename=dreams.pdf"
+        response.content_length = os.fstat(pdf_file.fileno()).st_size
+        return response
+
+    @app.route("/api/dreams/export/<string:format>", methods=["GET"])
+    @handle_jwt_token
+    def export_dreams_endpoint(format, userEmail):
+        if format not in EXPORT_FORMATS:
+            return jsonify({"error": f"Unknown export format {format}."}), 404
+        compress = request.args.get("gzip", default="false", type=str).lower() == "true"
+        _, mimetype, extension = EXPORT_FORMATS[format]
+        filename = f"dreams.{extension}"
+        if compress:
+            mimetype = "application/gzip"
+            filename += ".gz"
+
+        # Dreams are read and sent a page at a time, memory stays flat for any journal size
+        response = Response(iter_dreams_export(userEmail, format, compress=compress), mimetype=mimetype)
+        response.headers["Content-Disposition"] = f"attachment; filename={filename}"
+        log(f"Streaming {filename} export for user {userEmail}.", type="info")
+        return response
\ No newline at end of file
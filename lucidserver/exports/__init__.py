@@ -0,0 +1,15 @@
+from .main import (
+    ArtifactStore,
+    artifact_store,
+    create_export,
+    get_export_stats,
+    EXPORT_JOB_FORMATS,
+)
+
+__all__ = [
+    "ArtifactStore",
+    "artifact_store",
+    "create_export",
+    "get_export_stats",
+    "EXPORT_JOB_FORMATS",
+]
@@ -0,0 +1,272 @@
+import os
+import re
+import json
+import time
+import hashlib
+import tempfile
+import threading
+from agentlogger import log
+from lucidserver.cache import SingleFlight
+from lucidserver.memories import (
+    render_dreams_pdf_file,
+    write_dreams_export,
+    export_dreams_to_json_file,
+    journal_fingerprint,
+)
+
+# Where finished exports are downloaded from, see GET /api/exports/<artifact_id>
+EXPORT_BASE_URL = os.environ.get("EXPORT_BASE_URL", "/api/exports")
+
+ARTIFACT_ID_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+# Export formats: content type, file extension and whether gzip is offered
+EXPORT_JOB_FORMATS = {
+    "pdf": ("application/pdf", "pdf", False),
+    "json": ("application/json", "json", False),
+    "ndjson": ("application/x-ndjson", "ndjson", True),
+    "txt": ("text/plain", "txt", True),
+}
+
+
+class ArtifactStore:
+    """Finished export files on local disk, kept for `ttl` seconds after they are written or reused.
+
+    Each artifact is a file named by its ID plus a JSON sidecar describing
+    it. Expired artifacts are removed when they are looked up, and at most
+    once a minute when a new one is stored.
+
+    Args:
+        root (str): Directory holding the artifacts.
+        ttl (float, optional): Seconds an artifact can be downloaded. Defaults to 3600.
+    """
+
+    def __init__(self, root, ttl=3600):
+        self.root = root
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._last_cleanup = 0
+        self.stored = 0
+        self.reused = 0
+        self.expired = 0
+
+    def path(self, artifact_id):
+        """Return the file path of an artifact.
+
+        Raises:
+            ValueError: If artifact_id is not a sha256 hex digest.
+        """
+        if not ARTIFACT_ID_PATTERN.match(artifact_id):
+            raise ValueError(f"Invalid artifact ID: {artifact_id}")
+        return os.path.join(self.root, artifact_id)
+
+    def get(self, artifact_id):
+        """Return the metadata of an artifact, or None if unknown or expired."""
+        try:
+            path = self.path(artifact_id)
+            with open(f"{path}.json") as f:
+                artifact = json.load(f)
+        except (ValueError, OSError):
+            return None
+        if artifact["expires_at"] <= time.time():
+            self.remove(artifact_id)
+            return None
+        # The sidecar is written first, the artifact may still be moving into place
+        return artifact if os.path.exists(path) else None
+
+    def put(self, artifact_id, write, owner, filename, mimetype):
+        """Produce and store an artifact.
+
+        Args:
+            artifact_id (str): ID of the artifact, a sha256 hex digest.
+            write (callable): Writes the artifact to the path it is given.
+            owner (str): Email of the user who may download it.
+            filename (str): Name the artifact is downloaded as.
+            mimetype (str): Content type of the artifact.
+
+        Returns:
+            dict: Metadata of the stored artifact.
+        """
+        path = self.path(artifact_id)
+        os.makedirs(self.root, exist_ok=True)
+        self.cleanup()
+
+        # Written next to its final path, so downloads never see a partial file
+        fd, temp_path = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        os.close(fd)
+        try:
+            write(temp_path)
+            now = time.time()
+            artifact = {
+                "artifact_id": artifact_id,
+                "owner": owner,
+                "filename": filename,
+                "mimetype": mimetype,
+                "size": os.path.getsize(temp_path),
+                "created_at": now,
+                "expires_at": now + self.ttl,
+            }
+            self._write_sidecar(artifact)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+
+        with self._lock:
+            self.stored += 1
+        return artifact
+
+    def renew(self, artifact_id):
+        """Restart the lifetime of an artifact that is handed out again.
+
+        Returns:
+            dict: Metadata of the artifact, or None if unknown or expired.
+        """
+        artifact = self.get(artifact_id)
+        if artifact is None:
+            return None
+        artifact = {**artifact, "expires_at": time.time() + self.ttl}
+        self._write_sidecar(artifact)
+        with self._lock:
+            self.reused += 1
+        return artifact
+
+    def _write_sidecar(self, artifact):
+        # Replaced in one step, so lookups and cleanup never read a partial sidecar
+        fd, temp_path = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(artifact, f)
+            os.replace(temp_path, f"{self.path(artifact['artifact_id'])}.json")
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+
+    def remove(self, artifact_id):
+        path = self.path(artifact_id)
+        for name in (path, f"{path}.json"):
+            try:
+                os.unlink(name)
+            except FileNotFoundError:
+                pass
+
+    def cleanup(self):
+        """Remove expired artifacts, at most once a minute."""
+        with self._lock:
+            if time.monotonic() - self._last_cleanup < 60:
+                return
+            self._last_cleanup = time.monotonic()
+        try:
+            names = os.listdir(self.root)
+        except FileNotFoundError:
+            return
+        now = time.time()
+        for name in names:
+            artifact_id, extension = os.path.splitext(name)
+            if extension != ".json" or not ARTIFACT_ID_PATTERN.match(artifact_id):
+                continue
+            try:
+                with open(os.path.join(self.root, name)) as f:
+                    expires_at = json.load(f)["expires_at"]
+            except (OSError, ValueError, KeyError):
+                continue
+            if expires_at <= now:
+                self.remove(artifact_id)
+                with self._lock:
+                    self.expired += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "stored": self.stored,
+                "reused": self.reused,
+                "expired": self.expired,
+                "ttl": self.ttl,
+            }
+
+
+artifact_store = ArtifactStore(
+    os.environ.get("EXPORT_ARTIFACT_PATH", "./exports"),
+    ttl=float(os.environ.get("EXPORT_ARTIFACT_TTL", 3600)),
+)
+
+# Identical exports running at the same time produce one artifact
+export_flights = SingleFlight("export")
+
+
+def export_artifact_id(userEmail, format, compress, fingerprint):
+    """Return the artifact ID of an export of one version of a user's journal."""
+    raw = json.dumps([userEmail, format, bool(compress), fingerprint])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def write_export(path, userEmail, format, compress=False):
+    """Write one of the EXPORT_JOB_FORMATS of a user's journal to path."""
+    if format == "pdf":
+        render_dreams_pdf_file(path, userEmail)
+    elif format == "json":
+        export_dreams_to_json_file(path, userEmail)
+    else:
+        write_dreams_export(path, userEmail, format, compress)
+
+
+def create_export(userEmail, format="pdf", compress=False):
+    """Produce a downloadable export of a user's journal.
+
+    Meant to run as a background job. An export of a journal that has not
+    changed since the same export was last produced reuses that artifact.
+
+    Args:
+        userEmail (str): Email of the user.
+        format (str, optional): One of EXPORT_JOB_FORMATS. Defaults to "pdf".
+        compress (bool, optional): Gzip the export, for formats that offer it. Defaults to False.
+
+    Returns:
+        dict: The artifact's ID, download URL, filename, size and expiry, and whether it was reused.
+
+    Raises:
+        ValueError: If the format is unknown or cannot be compressed.
+    """
+    if format not in EXPORT_JOB_FORMATS:
+        raise ValueError(f"Cannot export dreams as {format}")
+    mimetype, extension, compressible = EXPORT_JOB_FORMATS[format]
+    if compress and not compressible:
+        raise ValueError(f"{format} exports cannot be compressed")
+    filename = f"dreams.{extension}"
+    if compress:
+        mimetype = "application/gzip"
+        filename += ".gz"
+
+    artifact_id = export_artifact_id(userEmail, format, compress, journal_fingerprint(userEmail))
+
+    def produce():
+        # Reused with a full lifetime, so it does not expire right after being handed out
+        artifact = artifact_store.renew(artifact_id)
+        if artifact is not None:
+            log(f"Reusing {filename} export {artifact_id} of an unchanged journal for {userEmail}.", type="info")
+            return {**artifact, "reused": True}
+        artifact = artifact_store.put(
+            artifact_id,
+            lambda path: write_export(path, userEmail, format, compress),
+            owner=userEmail,
+            filename=filename,
+            mimetype=mimetype,
+        )
+        log(f"Stored {filename} export {artifact_id} for {userEmail}.", type="info")
+        return {**artifact, "reused": False}
+
+    artifact = export_flights.do(artifact_id, produce)
+    return {
+        "artifact_id": artifact["artifact_id"],
+        "download_url": f"{EXPORT_BASE_URL}/{artifact['artifact_id']}",
+        "filename": artifact["filename"],
+        "size": artifact["size"],
+        "expires_at": artifact["expires_at"],
+        "reused": artifact["reused"],
+    }
+
+
+def get_export_stats():
+    """Return the counters of the export artifact store."""
+    return artifact_store.stats()
@@ -0,0 +1,13 @@
+from .main import (
+    ChatHistory,
+    MemorySessionStore,
+    SQLiteSessionStore,
+    create_session_store,
+)
+
+__all__ = [
+    "ChatHistory",
+    "MemorySessionStore",
+    "SQLiteSessionStore",
+    "create_session_store",
+]
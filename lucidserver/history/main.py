@@ -0,0 +1,383 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+from agentlogger import log
+from lucidserver.cache import LRUCache
+from lucidserver.resilience import UpstreamError
+
+# Tokens each chat message costs on top of its content (role and separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Most recent search chat topics kept per conversation
+MAX_TOPICS = 20
+
+
+class ChatHistory:
+    """Token-budgeted conversation history.
+
+    A conversation state holds the recent messages with their token counts and
+    a running summary of everything older. The standing system prompt is never
+    stored; it is sent once at the top of each request. When the stored
+    messages outgrow `history_budget`, the oldest ones are compacted into the
+    summary, which is then reused on every later turn until the next
+    compaction. States are plain dicts so any session store can hold them.
+
+    record compacts in one step. States shared between threads or workers
+    use append, compact and apply_compaction instead, so the summary is
+    written without holding the state locked.
+
+    Args:
+        count_tokens (callable): Returns the token count of a string.
+        token_budget (int, optional): Most tokens a request's messages may use. Defaults to 6000.
+        history_budget (int, optional): Most tokens kept as recent messages before compacting. Defaults to 3000.
+        summarize (callable, optional): summarize(previous_summary, messages) -> str, raising
+            UpstreamError if it fails. Without it old messages are dropped instead of
+            summarized. Defaults to None.
+    """
+
+    def __init__(self, count_tokens, token_budget=6000, history_budget=3000, summarize=None):
+        self.count_tokens = count_tokens
+        self.token_budget = token_budget
+        self.history_budget = history_budget
+        self.summarize = summarize
+        # Token counts of repeated content such as the system prompt
+        self._token_counts = LRUCache(max_size=256, copy_values=False)
+        self.compactions = 0
+
+    @staticmethod
+    def new_state():
+        """Return an empty conversation state."""
+        return {"summary": None, "messages": [], "tokens": [], "topics": []}
+
+    def message_tokens(self, message):
+        """Return the token cost of a message, caching counts by content."""
+        content = message["content"] or ""
+        tokens = self._token_counts.get(content)
+        if tokens is None:
+            tokens = self.count_tokens(content)
+            self._token_counts.set(content, tokens)
+        return tokens + MESSAGE_OVERHEAD_TOKENS
+
+    def summary_message(self, state):
+        if not state["summary"]:
+            return None
+        return {"role": "system", "content": f"Summary of the earlier conversation: {state['summary']}"}
+
+    def build_messages(self, state, turn, system_prompt=None):
+        """Assemble the messages for a request within the token budget.
+
+        Args:
+            state (dict): Conversation state.
+            turn (list): Messages of the current turn, always sent in full.
+            system_prompt (str, optional): Standing system prompt sent first. Defaults to None.
+
+        Returns:
+            list: System prompt, summary, as many recent messages as fit, then the turn.
+        """
+        head = []
+        if system_prompt:
+            head.append({"role": "system", "content": system_prompt})
+        summary = self.summary_message(state)
+        if summary is not None:
+            head.append(summary)
+
+        remaining = self.token_budget - sum(self.message_tokens(message) for message in head + turn)
+        recent = []
+        for message, tokens in zip(reversed(state["messages"]), reversed(state["tokens"])):
+            if tokens > remaining:
+                break
+            recent.append(message)
+            remaining -= tokens
+        recent.reverse()
+        return head + recent + turn
+
+    def record(self, state, messages, topic=None):
+        """Append the messages of a completed turn, compacting old ones if over budget.
+
+        Args:
+            state (dict): Conversation state, updated in place.
+            messages (list): Messages to keep, e.g. the user message and the reply.
+            topic (str, optional): Topic of the turn to push on the topic stack. Defaults to None.
+        """
+        overflow = self.append(state, messages, topic)
+        if overflow:
+            previous_summary = state["summary"]
+            summary = self.compact(previous_summary, overflow)
+            self.apply_compaction(state, previous_summary, overflow, summary)
+
+    def append(self, state, messages, topic=None):
+        """Append the messages of a completed turn without compacting.
+
+        Args:
+            state (dict): Conversation state, updated in place.
+            messages (list): Messages to keep, e.g. the user message and the reply.
+            topic (str, optional): Topic of the turn to push on the topic stack. Defaults to None.
+
+        Returns:
+            list: Oldest messages due to be compacted, empty while the history is within budget.
+        """
+        if topic:
+            state["topics"] = (state["topics"] + [topic])[-MAX_TOPICS:]
+        for message in messages:
+            state["messages"].append(message)
+            state["tokens"].append(self.message_tokens(message))
+
+        total = sum(state["tokens"])
+        if total <= self.history_budget:
+            return []
+
+        # Compact down to half the budget so the next few turns don't compact again.
+        # Messages kept after failed compactions are folded in over several turns,
+        # at most history_budget tokens at a time.
+        count = 0
+        compacted = 0
+        while count < len(state["messages"]) and total > self.history_budget // 2:
+            tokens = state["tokens"][count]
+            if count and compacted + tokens > self.history_budget:
+                break
+            total -= tokens
+            compacted += tokens
+            count += 1
+        return state["messages"][:count]
+
+    def compact(self, summary, messages):
+        """Summarize messages into a new summary.
+
+        Args:
+            summary (str): Summary the messages follow, or None.
+            messages (list): Messages to fold in, oldest first.
+
+        Returns:
+            str: The new summary, or None if there is no summarizer or it failed.
+        """
+        if self.summarize is None:
+            return None
+        try:
+            return self.summarize(summary, messages) or None
+        except UpstreamError as e:
+            log(f"Could not summarize chat history, keeping {len(messages)} messages for the next compaction: {e}", type="warning")
+            return None
+
+    def apply_compaction(self, state, previous_summary, messages, summary):
+        """Replace compacted messages with their summary.
+
+        Nothing changes if summarizing failed, the messages are compacted again
+        on a later turn, or if another compaction of them was applied first.
+
+        Args:
+            state (dict): Conversation state, updated in place.
+            previous_summary (str): Summary the compaction started from.
+            messages (list): Messages that were compacted, as returned by append.
+            summary (str): Their summary, or None if there is none.
+
+        Returns:
+            bool: True if the compaction was applied.
+        """
+        if summary is None and self.summarize is not None:
+            return False
+        count = len(messages)
+        if state["summary"] != previous_summary or state["messages"][:count] != messages:
+            return False
+        del state["messages"][:count]
+        del state["tokens"][:count]
+        if summary:
+            state["summary"] = summary
+            self.compactions += 1
+        return True
+
+
+class SessionStore:
+    """Base of the chat session stores, holding one conversation state per user.
+
+    Changes to one user's conversation are serialized with lock(), a lock
+    per user that only exists while a thread holds or waits for it, so
+    users never wait on each other.
+    """
+
+    def __init__(self):
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    @contextmanager
+    def lock(self, user_email):
+        """Hold the lock serializing changes to this user's conversation."""
+        with self._locks_lock:
+            entry = self._locks.setdefault(user_email, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._locks_lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[user_email]
+
+    def update(self, user_email, change):
+        """Apply a change to the user's conversation state in one atomic step.
+
+        Args:
+            user_email (str): Email of the user.
+            change (callable): change(state) updates the state in place, a new one if the user has none.
+
+        Returns:
+            The value returned by change.
+        """
+        with self.lock(user_email):
+            state = self.load(user_email)
+            if state is None:
+                state = ChatHistory.new_state()
+            result = change(state)
+            self.save(user_email, state)
+        return result
+
+
+class MemorySessionStore(SessionStore):
+    """Sessions kept in this process, evicted when idle or least recently used.
+
+    Args:
+        max_sessions (int, optional): Most conversations kept at once. Defaults to 10000.
+        ttl (float, optional): Seconds a conversation is kept after its last turn. Defaults to 86400.
+    """
+
+    def __init__(self, max_sessions=10000, ttl=86400):
+        super().__init__()
+        self.sessions = LRUCache(max_size=max_sessions, ttl=ttl)
+
+    def load(self, user_email):
+        """Return the user's conversation state, or None if there is none."""
+        return self.sessions.get(user_email)
+
+    def save(self, user_email, state):
+        """Store the user's conversation state and restart its idle timer."""
+        self.sessions.set(user_email, state)
+
+    def delete(self, user_email):
+        """Forget the user's conversation."""
+        self.sessions.invalidate(user_email)
+
+    def stats(self):
+        return {"backend": "memory", **self.sessions.stats()}
+
+
+class SQLiteSessionStore(SessionStore):
+    """Sessions stored in a SQLite file, shared by every worker process on the host.
+
+    Args:
+        path (str): Path of the SQLite database, ":memory:" for a throwaway store.
+        max_sessions (int, optional): Most conversations kept at once. Defaults to 10000.
+        ttl (float, optional): Seconds a conversation is kept after its last turn. Defaults to 86400.
+    """
+
+    def __init__(self, path, max_sessions=10000, ttl=86400):
+        super().__init__()
+        self.path = path
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        if path != ":memory:":
+            # Readers in other workers don't wait for a writer
+            self._connection.execute("PRAGMA journal_mode=WAL")
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS sessions (user_email TEXT PRIMARY KEY, state TEXT NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS sessions_last_used ON sessions (last_used)"
+            )
+        self.evictions = 0
+
+    def load(self, user_email):
+        """Return the user's conversation state, or None if there is none or it went idle."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT state FROM sessions WHERE user_email = ? AND last_used > ?",
+                (user_email, time.time() - self.ttl),
+            ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def save(self, user_email, state):
+        """Store the user's conversation state, evicting idle and least recently used ones."""
+        with self._lock, self._connection:
+            self._write(user_email, state)
+
+    def update(self, user_email, change):
+        """Apply a change to the user's conversation state in one atomic step.
+
+        The state is read and written in an immediate transaction, so turns
+        handled by other workers at the same time wait instead of being lost.
+
+        Args:
+            user_email (str): Email of the user.
+            change (callable): change(state) updates the state in place, a new one if the user has none.
+
+        Returns:
+            The value returned by change.
+        """
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._connection.execute(
+                    "SELECT state FROM sessions WHERE user_email = ? AND last_used > ?",
+                    (user_email, time.time() - self.ttl),
+                ).fetchone()
+                state = json.loads(row[0]) if row is not None else ChatHistory.new_state()
+                result = change(state)
+                self._write(user_email, state)
+                self._connection.commit()
+            except BaseException:
+                self._connection.rollback()
+                raise
+        return result
+
+    def _write(self, user_email, state):
+        now = time.time()
+        self._connection.execute(
+            "INSERT OR REPLACE INTO sessions (user_email, state, last_used) VALUES (?, ?, ?)",
+            (user_email, json.dumps(state), now),
+        )
+        evicted = self._connection.execute(
+            "DELETE FROM sessions WHERE last_used <= ?", (now - self.ttl,)
+        ).rowcount
+        evicted += self._connection.execute(
+            "DELETE FROM sessions WHERE user_email IN (SELECT user_email FROM sessions ORDER BY last_used ASC "
+            "LIMIT max(0, (SELECT COUNT(*) FROM sessions) - ?))",
+            (self.max_sessions,),
+        ).rowcount
+        self.evictions += max(evicted, 0)
+
+    def delete(self, user_email):
+        """Forget the user's conversation."""
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM sessions WHERE user_email = ?", (user_email,))
+
+    def stats(self):
+        with self._lock:
+            size = self._connection.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+        return {
+            "backend": "sqlite",
+            "size": size,
+            "max_size": self.max_sessions,
+            "ttl": self.ttl,
+            "evictions": self.evictions,
+        }
+
+
+def create_session_store():
+    """Create the chat session store configured by the environment.
+
+    SESSION_STORE selects "memory" (default, per process) or "sqlite" (shared
+    through SESSION_STORE_PATH by every worker on the host).
+    """
+    backend = os.environ.get("SESSION_STORE", "memory")
+    max_sessions = int(os.environ.get("SESSION_MAX", 10000))
+    ttl = float(os.environ.get("SESSION_TTL", 86400))
+    if backend == "sqlite":
+        return SQLiteSessionStore(os.environ.get("SESSION_STORE_PATH", "./sessions.db"), max_sessions, ttl)
+    if backend != "memory":
+        log(f"Unknown SESSION_STORE {backend}, keeping sessions in memory", type="warning")
+    return MemorySessionStore(max_sessions, ttl)
@@ -0,0 +1,11 @@
+from .main import (
+    HTTPClient,
+    get_http_client,
+    get_http_stats,
+)
+
+__all__ = [
+    "HTTPClient",
+    "get_http_client",
+    "get_http_stats",
+]
@@ -0,0 +1,114 @@
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class HTTPClient:
+    """Pooled keep-alive HTTP client for one upstream, with default timeouts.
+
+    Every request goes through a single requests.Session, so connections to the
+    upstream are kept alive and reused instead of being opened per call. A
+    request without an explicit timeout gets the client's connect and read
+    timeouts, so a stalled upstream can never hang a worker.
+
+    Args:
+        name (str): Upstream name used in the stats.
+        connect_timeout (float, optional): Seconds to wait for a connection. Defaults to 5.
+        read_timeout (float, optional): Seconds to wait for response data. Defaults to 30.
+        pool_maxsize (int, optional): Connections kept alive per host. Defaults to 10.
+    """
+
+    def __init__(self, name, connect_timeout=5, read_timeout=30, pool_maxsize=10):
+        self.name = name
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize)
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+    def request(self, method, url, **kwargs):
+        """Send a request through the pool, applying the default timeouts.
+
+        Args:
+            method (str): HTTP method.
+            url (str): Request URL.
+            **kwargs: Arguments for requests.Session.request.
+
+        Returns:
+            requests.Response: The response.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        with self._lock:
+            self.requests += 1
+        try:
+            return self.session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            with self._lock:
+                self.errors += 1
+            raise
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def close(self):
+        """Close every pooled connection."""
+        self.session.close()
+
+    def stats(self):
+        """Return request counts and how many requests reused a pooled connection."""
+        pools = self.adapter.poolmanager.pools
+        connections_opened = 0
+        pooled_requests = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                connections_opened += pool.num_connections
+                pooled_requests += pool.num_requests
+        with self._lock:
+            return {
+                "name": self.name,
+                "requests": self.requests,
+                "errors": self.errors,
+                "connections_opened": connections_opened,
+                "connections_reused": max(pooled_requests - connections_opened, 0),
+                "connect_timeout": self.timeout[0],
+                "read_timeout": self.timeout[1],
+            }
+
+
+# Every client created through get_http_client, by name
+http_clients = {}
+http_clients_lock = threading.Lock()
+
+
+def get_http_client(name, connect_timeout=5, read_timeout=30, pool_maxsize=10):
+    """Return the shared client for an upstream, creating it on first use.
+
+    Args:
+        name (str): Upstream name, e.g. "openai".
+        connect_timeout (float, optional): Seconds to wait for a connection. Defaults to 5.
+        read_timeout (float, optional): Seconds to wait for response data. Defaults to 30.
+        pool_maxsize (int, optional): Connections kept alive per host. Defaults to 10.
+
+    Returns:
+        HTTPClient: The client shared by every caller of this upstream.
+    """
+    with http_clients_lock:
+        client = http_clients.get(name)
+        if client is None:
+            client = HTTPClient(name, connect_timeout, read_timeout, pool_maxsize)
+            http_clients[name] = client
+        return client
+
+
+def get_http_stats():
+    """Return the stats of every shared HTTP client, by name."""
+    with http_clients_lock:
+        clients = list(http_clients.values())
+    return {client.name: client.stats() for client in clients}
@@ -0,0 +1,17 @@
+from .main import (
+    ImageStore,
+    image_store,
+    image_url,
+    image_digest,
+    public_image_url,
+    get_image_store_stats,
+)
+
+__all__ = [
+    "ImageStore",
+    "image_store",
+    "image_url",
+    "image_digest",
+    "public_image_url",
+    "get_image_store_stats",
+]
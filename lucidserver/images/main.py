@@ -0,0 +1,189 @@
+import io
+import os
+import re
+import hashlib
+import tempfile
+import threading
+from urllib.parse import urlsplit
+from PIL import Image
+from agentlogger import log
+from lucidserver.http import get_http_client
+
+# Where stored images are served from, see GET /api/images/<digest>. A path
+# is made absolute with the host of each request, see public_image_url.
+IMAGE_BASE_URL = os.environ.get("IMAGE_BASE_URL", "/api/images")
+IMAGE_BASE_PATH = urlsplit(IMAGE_BASE_URL).path.rstrip("/")
+
+DIGEST_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+# Generated images live on OpenAI's storage, which is a different host from the API
+image_http = get_http_client(
+    "image-downloads",
+    connect_timeout=5,
+    read_timeout=float(os.environ.get("IMAGE_DOWNLOAD_TIMEOUT", 30)),
+)
+
+
+class ImageStore:
+    """Content-addressed image files on local disk.
+
+    Images are stored once under the sha256 digest of their bytes, so storing
+    the same image twice is free and a digest always names the same content,
+    which makes stored files safe to cache forever. Thumbnails are generated
+    when an image is stored.
+
+    Args:
+        root (str): Directory holding the images.
+        thumbnail_sizes (tuple, optional): Longest side in pixels of each thumbnail. Defaults to (128,).
+    """
+
+    def __init__(self, root, thumbnail_sizes=(128,)):
+        self.root = root
+        self.thumbnail_sizes = tuple(thumbnail_sizes)
+        self._lock = threading.Lock()
+        self.stored = 0
+        self.duplicates = 0
+        self.downloads = 0
+
+    def path(self, digest, size=None):
+        """Return the file path of an image or one of its thumbnails.
+
+        Raises:
+            ValueError: If digest is not a sha256 hex digest.
+        """
+        if not DIGEST_PATTERN.match(digest):
+            raise ValueError(f"Invalid image digest: {digest}")
+        name = digest if size is None else f"{digest}_{size}"
+        return os.path.join(self.root, digest[:2], f"{name}.png")
+
+    def exists(self, digest, size=None):
+        if not digest:
+            return False
+        try:
+            return os.path.exists(self.path(digest, size))
+        except ValueError:
+            return False
+
+    def write(self, path, data):
+        """Write a file atomically, so readers never see a partial image."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def put(self, data):
+        """Store image bytes and their thumbnails.
+
+        Args:
+            data (bytes): PNG image.
+
+        Returns:
+            str: sha256 digest naming the image.
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        if self.exists(digest):
+            with self._lock:
+                self.duplicates += 1
+            return digest
+
+        self.write_thumbnails(digest, data)
+        # The original goes last: once it exists the image is complete
+        self.write(self.path(digest), data)
+        with self._lock:
+            self.stored += 1
+        return digest
+
+    def write_thumbnails(self, digest, data):
+        try:
+            image = Image.open(io.BytesIO(data))
+            image.load()
+        except Exception as e:
+            log(f"Could not read image {digest} for thumbnails: {e}", type="error")
+            return
+        for size in self.thumbnail_sizes:
+            if max(image.size) <= size:
+                continue
+            thumbnail = image.copy()
+            thumbnail.thumbnail((size, size))
+            buffer = io.BytesIO()
+            thumbnail.save(buffer, format="PNG", optimize=True)
+            self.write(self.path(digest, size), buffer.getvalue())
+
+    def download(self, url):
+        """Download an image once and store it.
+
+        Returns:
+            str: sha256 digest naming the image.
+        """
+        response = image_http.get(url)
+        response.raise_for_status()
+        with self._lock:
+            self.downloads += 1
+        return self.put(response.content)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "stored": self.stored,
+                "duplicates": self.duplicates,
+                "downloads": self.downloads,
+                "thumbnail_sizes": list(self.thumbnail_sizes),
+            }
+
+
+image_store = ImageStore(
+    os.environ.get("IMAGE_STORE_PATH", "./images"),
+    thumbnail_sizes=[int(size) for size in os.environ.get("IMAGE_THUMBNAIL_SIZES", "128").split(",") if size],
+)
+
+
+def image_url(digest, host_url=None):
+    """Return the URL the server serves a stored image from.
+
+    Args:
+        digest (str): Digest of the image.
+        host_url (str, optional): Scheme and host the request came to, used
+            when IMAGE_BASE_URL is a path. Defaults to None, giving the path.
+    """
+    if urlsplit(IMAGE_BASE_URL).netloc:
+        return f"{IMAGE_BASE_URL.rstrip('/')}/{digest}"
+    if host_url is None:
+        return f"{IMAGE_BASE_PATH}/{digest}"
+    return f"{host_url.rstrip('/')}{IMAGE_BASE_PATH}/{digest}"
+
+
+def image_digest(image):
+    """Return the digest of a stored image from a dream's image, or None for any other URL.
+
+    Dreams store the digest; images saved before that store its URL or path.
+    """
+    if not image:
+        return None
+    if DIGEST_PATTERN.match(image):
+        return image
+    path = urlsplit(image).path
+    if not path.startswith(f"{IMAGE_BASE_PATH}/"):
+        return None
+    digest = path[len(IMAGE_BASE_PATH) + 1:]
+    return digest if DIGEST_PATTERN.match(digest) else None
+
+
+def public_image_url(image, host_url=None):
+    """Return the URL clients load a dream's image from.
+
+    Stored images become a URL on IMAGE_BASE_URL or the request's host, so
+    the URL is built per response rather than saved. Anything else, e.g. an
+    upstream URL kept because storing failed, is returned as is.
+    """
+    digest = image_digest(image)
+    return image_url(digest, host_url) if digest is not None else image
+
+
+def get_image_store_stats():
+    """Return how many images were stored, deduplicated and downloaded."""
+    return image_store.stats()
@@ -0,0 +1,13 @@
+from .main import (
+    Job,
+    JobQueue,
+    QueueFullError,
+    job_queue,
+)
+
+__all__ = [
+    "Job",
+    "JobQueue",
+    "QueueFullError",
+    "job_queue",
+]
@@ -0,0 +1,169 @@
+import os
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from agentlogger import log
+from lucidserver.cache import LRUCache
+from lucidserver.resilience import calling_as, BACKGROUND
+
+
+class QueueFullError(Exception):
+    """Raised when a job is submitted while every worker and queue slot is taken."""
+
+
+class Job:
+    """A unit of background work and its outcome.
+
+    Args:
+        kind (str): What the job does, e.g. "analysis" or "image".
+        owner (str, optional): Email of the user who started the job. Defaults to None.
+        params (dict, optional): Parameters to report back with the status. Defaults to None.
+    """
+
+    def __init__(self, kind, owner=None, params=None):
+        self.id = str(uuid.uuid4())
+        self.kind = kind
+        self.owner = owner
+        self.params = params or {}
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._done = threading.Event()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Block until the job finishes or timeout seconds pass.
+
+        Returns:
+            bool: True if the job finished.
+        """
+        return self._done.wait(timeout)
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "params": self.params,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobQueue:
+    """Bounded worker pool that runs jobs in the background and keeps their status.
+
+    At most `max_workers` jobs run at once and at most `max_queue` more wait for a
+    worker; further submissions raise QueueFullError instead of piling up.
+    Finished jobs are kept for `retention` seconds so clients can poll them.
+
+    Args:
+        max_workers (int, optional): Number of worker threads. Defaults to 4.
+        max_queue (int, optional): Number of jobs allowed to wait for a worker. Defaults to 64.
+        retention (float, optional): Seconds a job's status is kept. Defaults to 3600.
+        name (str, optional): Prefix of the worker thread names. Defaults to "jobs".
+    """
+
+    def __init__(self, max_workers=4, max_queue=64, retention=3600, name="jobs"):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self._lock = threading.Lock()
+        self.jobs = LRUCache(max_size=10000, ttl=retention, copy_values=False)
+        self.submitted = 0
+        self.rejected = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.running = 0
+
+    def submit(self, kind, fn, *args, owner=None, params=None, **kwargs):
+        """Queue fn(*args, **kwargs) to run on a worker.
+
+        The job succeeds with fn's return value, or fails with the message of
+        any exception it raises. Upstream calls made by fn are attributed to
+        the owner at BACKGROUND priority, see calling_as.
+
+        Returns:
+            Job: The queued job.
+
+        Raises:
+            QueueFullError: If all workers are busy and the queue is full.
+        """
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise QueueFullError(f"Job queue is full, cannot run {kind} job")
+
+        job = Job(kind, owner=owner, params=params)
+        self.jobs.set(job.id, job)
+        with self._lock:
+            self.submitted += 1
+        try:
+            self._executor.submit(self._run, job, fn, args, kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        log(f"Queued {kind} job {job.id} for {owner}", type="info")
+        return job
+
+    def _run(self, job, fn, args, kwargs):
+        job.status = "running"
+        job.started_at = time.time()
+        with self._lock:
+            self.running += 1
+        try:
+            # Upstream calls of jobs count against their owner and wait behind interactive requests
+            with calling_as(job.owner, BACKGROUND):
+                job.result = fn(*args, **kwargs)
+            job.status = "succeeded"
+        except Exception as e:
+            log(f"{job.kind} job {job.id} failed: {e}", type="error", color="red")
+            job.error = str(e)
+            job.status = "failed"
+        finally:
+            job.finished_at = time.time()
+            with self._lock:
+                self.running -= 1
+                if job.status == "succeeded":
+                    self.succeeded += 1
+                else:
+                    self.failed += 1
+            self._slots.release()
+            job._done.set()
+
+    def get(self, job_id):
+        """Return the job with this ID, or None if unknown or expired."""
+        return self.jobs.get(job_id)
+
+    def stats(self):
+        """Return job counters and pool limits."""
+        with self._lock:
+            return {
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "succeeded": self.succeeded,
+                "failed": self.failed,
+                "running": self.running,
+                "queued": self.submitted - self.succeeded - self.failed - self.running,
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+            }
+
+
+# Shared pool for LLM generation jobs
+job_queue = JobQueue(
+    max_workers=int(os.environ.get("JOB_WORKERS", 4)),
+    max_queue=int(os.environ.get("JOB_QUEUE_DEPTH", 64)),
+    retention=float(os.environ.get("JOB_RETENTION", 3600)),
+)
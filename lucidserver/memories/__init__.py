@@ -1,27 +1,67 @@
 from .main import (
     create_dream,
+    create_dreams,
     get_dream,
     get_dreams,
+    get_dreams_page,
     get_dream_analysis,
+    stream_dream_analysis,
     get_dream_image,
+    generate_and_save_dream_analysis,
+    generate_and_save_dream_image,
+    generate_dream_image_summary,
+    queue_dream_pipeline,
     update_dream_analysis_and_image,
+    patch_dream,
+    DREAM_PATCH_FIELDS,
     search_dreams,
+    search_dreams_in_index,
+    build_dream_index,
+    get_dream_index_stats,
     delete_dream,
     export_dreams_to_pdf,
+    open_dreams_pdf,
+    render_dreams_pdf_file,
+    journal_fingerprint,
     export_dreams_to_txt,
-    export_dreams_to_json_file
+    iter_dreams_export,
+    write_dreams_export,
+    EXPORT_FORMATS,
+    export_dreams_to_json_file,
+    get_dream_cache_stats,
+    get_analysis_cache_stats
 )
 
 __all__ = [
     "create_dream",
+    "create_dreams",
     "get_dream",
     "get_dreams",
+    "get_dreams_page",
     "get_dream_analysis",
+    "stream_dream_analysis",
     "get_dream_image",
+    "generate_and_save_dream_analysis",
+    "generate_and_save_dream_image",
+    "generate_dream_image_summary",
+    "queue_dream_pipeline",
     "update_dream_analysis_and_image",
+    "patch_dream",
+    "DREAM_PATCH_FIELDS",
     "search_dreams",
+    "search_dreams_in_index",
+    "build_dream_index",
+    "get_dream_index_stats",
     "delete_dream",
     "export_dreams_to_pdf",
+    "open_dreams_pdf",
+    "render_dreams_pdf_file",
+    "journal_fingerprint",
     "export_dreams_to_txt",
-    "export_dreams_to_json_file"
+    "iter_dreams_export",
+    "write_dreams_export",
+    "EXPORT_FORMATS",
+    "export_dreams_to_json_file",
+    "get_dream_cache_stats",
+    "get_analysis_cache_stats"
 ]
\ No newline at end of file
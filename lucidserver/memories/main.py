@@ -1,15 +1,115 @@
-import time
+import io
+import os
+import sys
 import json
+import time
+import uuid
+import bisect
+import zlib
+import base64
+import hashlib
+import tempfile
+import itertools
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from reportlab.lib.pagesizes import letter
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.enums import TA_JUSTIFY
 from agentlogger import log
 from agentmemory import create_memory, get_memories, update_memory, get_memory, search_memory, delete_memory, export_memory_to_json, get_client
-from lucidserver.actions import generate_dream_analysis, generate_dream_image, get_image_summary
+from lucidserver.actions import generate_dream_analysis, stream_dream_analysis_text, generate_dream_image, get_image_summary, ANALYSIS_MODEL
+from lucidserver.cache import LRUCache, PersistentLRUCache, SingleFlight
+from lucidserver.jobs import job_queue, QueueFullError
+from lucidserver.images import image_store, image_digest
+from lucidserver.resilience import RateLimitedError
+from lucidserver.vectors import VectorIndex
+
+
+# Read-through cache of dream objects keyed by dream ID. The TTL bounds how long
+# another worker's writes can go unseen, since each process has its own cache.
+dream_cache = LRUCache(
+    max_size=int(os.environ.get("DREAM_CACHE_SIZE", 1024)),
+    ttl=float(os.environ.get("DREAM_CACHE_TTL", 60)),
+)
+
+
+def get_dream_cache_stats():
+    """Return hit/miss counters and size of the dream cache."""
+    return dream_cache.stats()
+
+
+# Optional per-user vector index on local disk, searched by search_dreams instead of storage
+DREAM_VECTOR_INDEX = os.environ.get("DREAM_VECTOR_INDEX", "false").lower() == "true"
+dream_index = None
+if DREAM_VECTOR_INDEX:
+    dream_index = VectorIndex(
+        os.environ.get("DREAM_INDEX_PATH", "./dream_index"),
+        ttl=float(os.environ.get("DREAM_INDEX_TTL", 3600)),
+        max_keys=int(os.environ.get("DREAM_INDEX_USERS", 1024)),
+    )
+
+# Concurrent searches of a user without an index build it once
+dream_index_builds = SingleFlight("dream-index")
+
+# Embeddings of recent search queries, so repeated searches skip the embedding model
+query_embedding_cache = LRUCache(max_size=1024, copy_values=False)
+query_embedder = None
+query_embedder_lock = threading.Lock()
+
+
+def get_dream_index_stats():
+    """Return the counters of the dream vector index, or None if it is disabled."""
+    return dream_index.stats() if dream_index is not None else None
+
+
+# Persistent cache of generated analyses, opened on first use
+analysis_cache = None
+analysis_cache_lock = threading.Lock()
+
+
+def get_analysis_cache():
+    """Return the persistent analysis cache, opening it on first use."""
+    global analysis_cache
+    with analysis_cache_lock:
+        if analysis_cache is None:
+            analysis_cache = PersistentLRUCache(
+                os.environ.get("ANALYSIS_CACHE_PATH", "./analysis_cache.db"),
+                max_size=int(os.environ.get("ANALYSIS_CACHE_SIZE", 10000)),
+            )
+        return analysis_cache
+
+
+def analysis_cache_key(entry, intelligence_level, model=ANALYSIS_MODEL):
+    """Hash the inputs that determine an analysis into a cache key."""
+    raw = json.dumps([model, intelligence_level, entry])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def image_summary_cache_key(entry):
+    """Hash a dream entry into the cache key of its image summary."""
+    raw = json.dumps(["image_summary", entry])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
 
+def image_cache_key(entry, style, quality):
+    """Hash the inputs that determine a dream image into a cache key."""
+    raw = json.dumps(["image", style, quality, entry])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
 
-def create_dream(title, date, entry, userEmail, symbols=None, lucidity=None, characters=None, emotions=None, setting=None):
+
+def get_analysis_cache_stats():
+    """Return hit/miss counters and size of the analysis cache."""
+    return get_analysis_cache().stats()
+
+
+# Optional pipeline queued when a dream is created, so results are ready before the user asks
+EAGER_ANALYSIS = os.environ.get("EAGER_ANALYSIS", "false").lower() == "true"
+EAGER_IMAGE_SUMMARY = os.environ.get("EAGER_IMAGE_SUMMARY", "false").lower() == "true"
+
+
+def create_dream(title, date, entry, userEmail, symbols=None, lucidity=None, characters=None, emotions=None, setting=None, intelligence_level=None):
     try:
         # Step 1: Initial log to confirm function entry
         log(f"Entering create_dream function with title: {title}, date: {date}, entry: {entry}, userEmail: {userEmail}", type="debug")
@@ -63,13 +163,98 @@ def create_dream(title, date, entry, userEmail, symbols=None, lucidity=None, cha
             log(f"Fetched dream ID does not match generated UUID. Fetched: {dream.get('id', '')}, Expected: {memory_id}", type="error")
             return None
 
+        # Prime the cache, the client usually opens the new dream right away
+        dream_cache.set(memory_id, memory_to_dream(dream))
+        update_dream_sort_index(userEmail, memory_id, dream["metadata"])
+        if dream.get("embedding") is not None:
+            update_dream_index(userEmail, items=[(memory_id, dream["embedding"])])
+
+        # Start generating in the background, so the analysis is usually ready when the dream is opened
+        jobs = queue_dream_pipeline(
+            memory_id,
+            intelligence_level or "general",
+            analysis=EAGER_ANALYSIS,
+            image_summary=EAGER_IMAGE_SUMMARY,
+            owner=userEmail,
+        )
+
         # Step 5: Return a dictionary containing both the dream and the generated UUID
-        return {"id": memory_id, "dream": dream}
+        return {"id": memory_id, "dream": dream, "jobs": [job.to_dict() for job in jobs]}
 
     except Exception as e:
         log(f"Exception occurred in create_dream: {e}", type="error")
         return None
 
+# Dreams embedded and written per storage call when importing in bulk
+BULK_BATCH_SIZE = int(os.environ.get("BULK_BATCH_SIZE", 256))
+
+# Optional dream fields, stored only when given
+DREAM_OPTIONAL_FIELDS = ("symbols", "lucidity", "characters", "emotions", "setting")
+
+
+def create_dreams(dreams, userEmail, batch_size=None):
+    """Create many dreams for a user, e.g. when importing a journal from another app.
+
+    Dreams are embedded and written in batches with one storage call each, and
+    each batch is verified with a single read instead of one per dream. Unlike
+    create_dream no background generation is started; analyses and images are
+    generated when the dreams are opened.
+
+    Args:
+        dreams (list): Dicts with title, date, entry and optionally symbols, lucidity, characters, emotions and setting.
+        userEmail (str): Email of the user.
+        batch_size (int, optional): Dreams per batch. Defaults to BULK_BATCH_SIZE.
+
+    Returns:
+        list: One result per dream, in order: {"id", "status": "created"} or {"status": "failed", "error"}.
+    """
+    batch_size = batch_size or BULK_BATCH_SIZE
+    collection = get_client().get_or_create_collection("dreams")
+    results = []
+    for start in range(0, len(dreams), batch_size):
+        batch = dreams[start:start + batch_size]
+        ids = [str(uuid.uuid4()) for _ in batch]
+        documents = []
+        metadatas = []
+        now = time.time()
+        for offset, dream in enumerate(batch):
+            # Microsecond steps keep the import order when paging by created_at
+            created_at = now + offset / 1e6
+            metadata = {
+                "title": dream["title"],
+                "date": dream["date"],
+                "entry": dream["entry"],
+                "useremail": userEmail,
+                "created_at": created_at,
+                "updated_at": created_at,
+            }
+            metadata.update({field: dream[field] for field in DREAM_OPTIONAL_FIELDS if dream.get(field) is not None})
+            documents.append(f"{dream['title']}\n{dream['entry']}")
+            metadatas.append(metadata)
+
+        try:
+            collection.upsert(ids=ids, documents=documents, metadatas=metadatas)
+            # The vector index needs the embeddings the backend computed
+            stored_page = collection.get(ids=ids, include=["embeddings"] if dream_index is not None else [])
+            stored = set(stored_page["ids"])
+        except Exception as e:
+            log(f"Failed to store dreams {start} to {start + len(batch) - 1} for {userEmail}: {e}", type="error", color="red")
+            results.extend({"status": "failed", "error": "Could not store dream"} for _ in batch)
+            continue
+        for memory_id, metadata in zip(ids, metadatas):
+            if memory_id in stored:
+                update_dream_sort_index(userEmail, memory_id, metadata)
+                results.append({"id": memory_id, "status": "created"})
+            else:
+                results.append({"status": "failed", "error": "Dream was not stored"})
+        if dream_index is not None:
+            update_dream_index(userEmail, items=list(zip(stored_page["ids"], stored_page["embeddings"])))
+
+    created = sum(1 for result in results if result["status"] == "created")
+    log(f"Imported {created} of {len(dreams)} dreams for {userEmail}.", type="info")
+    return results
+
+
 def get_dream(dream_id):
     """Retrieve a specific dream by ID.
 
@@ -81,6 +266,11 @@ def get_dream(dream_id):
     """
     log(f"Initiating retrieval of dream with id {dream_id}.", type="info")
 
+    cached = dream_cache.get(dream_id)
+    if cached is not None:
+        log(f"Retrieved dream with id {dream_id} from cache.", type="info")
+        return cached
+
     # Fetching the dream
     dream = get_memory("dreams", dream_id)
     if dream is None:
@@ -88,27 +278,8 @@ def get_dream(dream_id):
         return None
 
     # Constructing the dream data
-    dream_data = {
-        "id": dream["id"],
-        "document": dream["document"],
-        "metadata": {
-            "title": dream["metadata"]["title"],
-            "date": dream["metadata"]["date"],
-            "entry": dream["metadata"]["entry"],
-            "useremail": dream["metadata"]["useremail"],
-            "symbols": dream["metadata"].get("symbols"),
-            "lucidity": dream["metadata"].get("lucidity"),
-            "characters": dream["metadata"].get("characters"),
-            "emotions": dream["metadata"].get("emotions"),
-            "setting": dream["metadata"].get("setting")
-        }
-    }
-
-    # Optionally, extract analysis and image from metadata if present
-    if "analysis" in dream["metadata"]:
-        dream_data["analysis"] = dream["metadata"]["analysis"]
-    if "image" in dream["metadata"]:
-        dream_data["image"] = dream["metadata"]["image"]
+    dream_data = memory_to_dream(dream)
+    dream_cache.set(dream_id, dream_data)
 
     log(
         f"Successfully retrieved dream with id {dream_id}: {dream_data}", type="info")
@@ -118,178 +289,813 @@ def get_dream(dream_id):
 def get_dreams(userEmail):
     """Retrieve all dreams for a specific user.
 
+    The user filter is applied by the storage backend, so the cost of this call
+    scales with the user's own journal rather than the whole collection.
+
     Args:
         userEmail (str): Email of the user.
 
     Returns:
         list: List of dreams for the user.
     """
-    log("Fetching all dreams.", type="info")
-    memories = get_memories("dreams", n_results=2222)
-    dreams = []
-    for memory in memories:
-        if "useremail" in memory["metadata"] and memory["metadata"]["useremail"] == userEmail:
-            dream_data = {
-                "id": memory["id"],
-                "document": memory["document"],
-                "metadata": {
-                    "title": memory["metadata"]["title"],
-                    "date": memory["metadata"]["date"],
-                    "entry": memory["metadata"]["entry"],
-                    "useremail": memory["metadata"]["useremail"],
-                    "symbols": memory["metadata"].get("symbols"),
-                    "lucidity": memory["metadata"].get("lucidity"),
-                    "characters": memory["metadata"].get("characters"),
-                    "emotions": memory["metadata"].get("emotions"),
-                    "setting": memory["metadata"].get("setting")
-                }
-            }
-            # Optionally, extract analysis and image from metadata if present
-            if "analysis" in memory["metadata"]:
-                dream_data["analysis"] = memory["metadata"]["analysis"]
-            if "image" in memory["metadata"]:
-                dream_data["image"] = memory["metadata"]["image"]
-
-            dreams.append(dream_data)
+    log(f"Fetching all dreams for user {userEmail}.", type="info")
+    if userEmail is None:
+        log("No user email provided, returning no dreams.", type="warning")
+        return []
+
+    memories = get_memories(
+        "dreams",
+        filter_metadata={"useremail": userEmail},
+        n_results=sys.maxsize,
+        include_embeddings=False,
+    )
+    dreams = [memory_to_dream(memory) for memory in memories]
 
     log(
         f"Debug: Retrieved dreams for userEmail {userEmail}: {dreams}", type="info")
     return dreams
 
 
-def get_dream_analysis(dream_id, intelligence_level='general', max_retries=5):
+def memory_to_dream(memory):
+    """Convert a raw memory from the dreams collection into a dream object.
+
+    Args:
+        memory (dict): Memory as returned by agentmemory.
+
+    Returns:
+        dict: Dream object with id, document, metadata and optional analysis and image.
+    """
+    dream_data = {
+        "id": memory["id"],
+        "document": memory["document"],
+        "metadata": {
+            "title": memory["metadata"]["title"],
+            "date": memory["metadata"]["date"],
+            "entry": memory["metadata"]["entry"],
+            "useremail": memory["metadata"]["useremail"],
+            "symbols": memory["metadata"].get("symbols"),
+            "lucidity": memory["metadata"].get("lucidity"),
+            "characters": memory["metadata"].get("characters"),
+            "emotions": memory["metadata"].get("emotions"),
+            "setting": memory["metadata"].get("setting")
+        }
+    }
+    # Optionally, extract analysis and image from metadata if present
+    if "analysis" in memory["metadata"]:
+        dream_data["analysis"] = memory["metadata"]["analysis"]
+    if "image" in memory["metadata"]:
+        dream_data["image"] = memory["metadata"]["image"]
+    return dream_data
+
+
+# Fields a journal page can be ordered by, with the value used when a dream lacks it
+DREAM_SORT_FIELDS = {"created_at": 0.0, "date": ""}
+
+
+def encode_dreams_cursor(sort_value, dream_id):
+    """Encode the position after a dream as an opaque pagination cursor."""
+    raw = json.dumps([sort_value, dream_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_dreams_cursor(cursor):
+    """Decode a cursor produced by encode_dreams_cursor.
+
+    Raises:
+        ValueError: If the cursor is malformed.
+    """
+    try:
+        sort_value, dream_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+    return sort_value, dream_id
+
+
+# Per-user lists of (sort value, dream ID) in ascending order, so a journal page is
+# a bisect instead of a scan. Built from the journal's metadata on first use and
+# kept current by this process's writes; the TTL bounds how long another worker's
+# writes go unseen, as for the dream cache.
+dream_sort_index = LRUCache(
+    max_size=int(os.environ.get("DREAM_SORT_INDEX_USERS", 1024)),
+    ttl=float(os.environ.get("DREAM_SORT_INDEX_TTL", 300)),
+    copy_values=False,
+)
+dream_sort_index_lock = threading.Lock()
+# Writes per user, a build that overlapped one is used once but not kept
+dream_sort_index_writes = {}
+dream_sort_index_builds = SingleFlight("dream-sort-index")
+
+
+def dream_sort_values(metadata):
+    """Return the value of each of DREAM_SORT_FIELDS of a dream, or the field's default if it lacks it."""
+    values = {}
+    for field, default in DREAM_SORT_FIELDS.items():
+        value = metadata.get(field)
+        values[field] = default if value is None else value
+    return values
+
+
+def build_dream_sort_index(userEmail):
+    """Read a user's dream metadata a page at a time into a sort index, see dream_sort_index."""
+    with dream_sort_index_lock:
+        writes = dream_sort_index_writes.get(userEmail, 0)
+    index = {"keys": {field: [] for field in DREAM_SORT_FIELDS}, "values": {}}
+    for memories in iter_dream_pages(userEmail, include_documents=False):
+        for memory in memories:
+            values = dream_sort_values(memory["metadata"])
+            index["values"][memory["id"]] = values
+            for field, value in values.items():
+                index["keys"][field].append((value, memory["id"]))
+    for keys in index["keys"].values():
+        keys.sort()
+    with dream_sort_index_lock:
+        if dream_sort_index_writes.get(userEmail, 0) == writes:
+            dream_sort_index.set(userEmail, index)
+    return index
+
+
+def update_dream_sort_index(userEmail, dream_id, metadata=None):
+    """Add, move or, without metadata, remove a dream in its user's sort index, if it is loaded."""
+    with dream_sort_index_lock:
+        dream_sort_index_writes[userEmail] = dream_sort_index_writes.get(userEmail, 0) + 1
+        index = dream_sort_index.get(userEmail)
+        if index is None:
+            return
+        previous = index["values"].pop(dream_id, None)
+        if previous is not None:
+            for field, value in previous.items():
+                keys = index["keys"][field]
+                position = bisect.bisect_left(keys, (value, dream_id))
+                if position < len(keys) and keys[position] == (value, dream_id):
+                    del keys[position]
+        if metadata is not None:
+            values = dream_sort_values(metadata)
+            index["values"][dream_id] = values
+            for field, value in values.items():
+                bisect.insort(index["keys"][field], (value, dream_id))
+
+
+def get_dreams_page(userEmail, limit=50, cursor=None, order_by="created_at", descending=True):
+    """Retrieve one page of a user's dreams in a stable order.
+
+    Dreams are ordered by `order_by` with the dream ID as a tie-breaker, so
+    every dream appears exactly once across pages. Dreams without the field
+    are ordered as if it held DREAM_SORT_FIELDS' value for it, i.e. oldest.
+    The page is looked up in the user's sort index, and only its dreams are
+    read, from the dream cache or in one storage call.
+
+    Args:
+        userEmail (str): Email of the user.
+        limit (int, optional): Maximum number of dreams on the page. Defaults to 50.
+        cursor (str, optional): Cursor returned with the previous page. Defaults to None.
+        order_by (str, optional): "created_at" or "date". Defaults to "created_at".
+        descending (bool, optional): Newest first when True. Defaults to True.
+
+    Returns:
+        dict: {"dreams": list, "next_cursor": str or None}
+
+    Raises:
+        ValueError: If order_by or cursor is invalid.
+    """
+    if order_by not in DREAM_SORT_FIELDS:
+        raise ValueError(f"Cannot order dreams by {order_by}")
+    default = DREAM_SORT_FIELDS[order_by]
+
+    log(f"Fetching page of dreams for user {userEmail} ordered by {order_by}, cursor: {cursor}.", type="info")
+
+    after = decode_dreams_cursor(cursor) if cursor else None
+    if after is not None and not isinstance(after[0], type(default)) and not (
+        isinstance(default, float) and isinstance(after[0], int)
+    ):
+        raise ValueError(f"Cursor does not match ordering by {order_by}")
+    if after is not None:
+        after = tuple(after)
+
+    index = dream_sort_index.get(userEmail)
+    if index is None:
+        index = dream_sort_index_builds.do(userEmail, build_dream_sort_index, userEmail)
+
+    # One more than the page, to know whether another page exists
+    with dream_sort_index_lock:
+        keys = index["keys"][order_by]
+        if descending:
+            end = len(keys) if after is None else bisect.bisect_left(keys, after)
+            selected = keys[max(0, end - limit - 1):end][::-1]
+        else:
+            start = 0 if after is None else bisect.bisect_right(keys, after)
+            selected = keys[start:start + limit + 1]
+
+    page_keys = selected[:limit]
+    next_cursor = None
+    if len(selected) > limit:
+        next_cursor = encode_dreams_cursor(*page_keys[-1])
+
+    # Dreams deleted by another worker since the index was built are left out
+    found = get_dreams_by_id([dream_id for _, dream_id in page_keys])
+    dreams = [found[dream_id] for _, dream_id in page_keys if dream_id in found]
+
+    log(f"Retrieved {len(dreams)} dreams for user {userEmail}, next cursor: {next_cursor}", type="info")
+    return {"dreams": dreams, "next_cursor": next_cursor}
+
+
+def get_dream_analysis(dream_id, intelligence_level='general', max_retries=5, bypass_cache=False):
     """Fetch analysis for a dream.
 
+    Analyses are cached by entry text, intelligence level and model, so repeat
+    views of an unchanged dream don't call the model again.
+
     Args:
         dream_id (str): ID of the dream.
         intelligence_level (str, optional): Level of intelligence for analysis. Defaults to 'general'.
         max_retries (int, optional): Maximum number of retries. Defaults to 5.
+        bypass_cache (bool, optional): Generate a fresh analysis and overwrite the cached one. Defaults to False.
 
     Returns:
-        str: Dream analysis or None if not found.
+        str: Dream analysis or None if not found or generation failed.
+
+    Raises:
+        RateLimitedError: If the caller is over its OpenAI rate limit.
     """
     try:
         log(f"Fetching dream analysis for dream id {dream_id}.", type="info")
         dream = get_dream(dream_id)
-        for _ in range(max_retries):
-            analysis = generate_dream_analysis(
-                dream["metadata"]["entry"], "You are dreaming about", intelligence_level
-            )
-            if analysis:
+        entry = dream["metadata"]["entry"]
+
+        cache = get_analysis_cache()
+        cache_key = analysis_cache_key(entry, intelligence_level)
+        if not bypass_cache:
+            analysis = cache.get(cache_key)
+            if analysis is not None:
+                log(f"Retrieved cached analysis for dream id {dream_id}.", type="info")
                 return analysis
-            time.sleep(5)
+
+        # Retries with backoff happen inside generate_dream_analysis
+        analysis = generate_dream_analysis(
+            entry, "You are dreaming about", intelligence_level, max_attempts=max_retries
+        )
+        if analysis and not analysis.startswith("Error:"):
+            cache.set(cache_key, analysis)
+            return analysis
         log(
-            f"Failed to get dream analysis after {max_retries} attempts.",
+            f"Failed to get dream analysis after up to {max_retries} attempts.",
             type="error",
             color="red",
         )
         return None
+    except RateLimitedError:
+        raise
     except Exception as e:
         log(f"Error in get_dream_analysis: {e}", type="error", color="red")
         return None
 
 
-def get_dream_image(dream_id, style="renaissance", quality="low", max_retries=5):
+def store_generated_image(url):
+    """Download a generated image into the local image store.
+
+    Args:
+        url (str): Temporary URL of the generated image.
+
+    Returns:
+        str: Digest of the stored image, or the original URL if it could not be stored.
+    """
+    try:
+        return image_store.download(url)
+    except Exception as e:
+        log(f"Could not store generated image {url}, keeping its URL: {e}", type="error", color="red")
+        return url
+
+
+def get_dream_image(dream_id, style="renaissance", quality="low", max_retries=5, dream=None, bypass_cache=False):
     """Fetch an image for a dream.
 
+    Generated images are downloaded once into the local image store and served
+    from there. Stored images are cached by entry text, style and quality, so
+    repeat views of an unchanged dream don't generate or download again.
+
     Args:
         dream_id (str): ID of the dream.
         style (str, optional): Style for the image. Defaults to "renaissance".
         quality (str, optional): Quality of the image. Defaults to "low".
         max_retries (int, optional): Maximum number of retries. Defaults to 5.
+        dream (dict, optional): Already loaded dream, skips fetching it again. Defaults to None.
+        bypass_cache (bool, optional): Generate a new image and overwrite the cached one. Defaults to False.
 
     Returns:
-        str: Dream image or None if not found.
+        str: Digest of the stored image, the generated image's URL if it could
+        not be stored, or None if not found or generation failed. See
+        public_image_url for the URL clients load it from.
+
+    Raises:
+        RateLimitedError: If the caller is over its OpenAI rate limit.
     """
     try:
         log(f"Fetching dream image for dream id {dream_id}.", type="info")
-        dream = get_dream(dream_id)
+        if dream is None:
+            dream = get_dream(dream_id)
         log(f"Debug: Retrieved dream object: {dream}", type="info")
 
         # Log the style being used
         log(f"Using image style: {style}", type="info")
 
-        # get useremail from dream metadata, updated line
-        userEmail = dream["metadata"]["useremail"]
-        dreams = get_dreams(userEmail)  # pass userEmail to get_dreams()
-        summary = get_image_summary(dream["metadata"]["entry"])
-        for _ in range(max_retries):
-            image = generate_dream_image(dreams, dream_id, style, quality)
-            if image:
-                return image
-            time.sleep(5)
+        cache = get_analysis_cache()
+        cache_key = image_cache_key(dream["metadata"]["entry"], style, quality)
+        if not bypass_cache:
+            image = cache.get(cache_key)
+            if image is not None and image_store.exists(image_digest(image)):
+                log(f"Retrieved stored image for dream id {dream_id}.", type="info")
+                return image_digest(image)
+
+        # Summarize once, every image attempt reuses it
+        summary = get_dream_image_summary(dream["metadata"]["entry"])
+        if summary.startswith("Error:"):
+            log(f"Could not summarize dream id {dream_id} for its image.", type="error", color="red")
+            return None
+
+        # Retries with backoff happen inside generate_dream_image, and callers
+        # asking for the same image at once share one download of it
+        image = generate_dream_image(dream, style, quality, summary=summary, max_attempts=max_retries,
+                                     store=store_generated_image)
+        if image:
+            if image_digest(image) is not None:
+                cache.set(cache_key, image)
+            return image
         log(
-            f"Failed to get dream image after {max_retries} attempts.",
+            f"Failed to get dream image after up to {max_retries} attempts.",
             type="error",
             color="red",
         )
         return None
+    except RateLimitedError:
+        raise
     except Exception as e:
         log(f"Error in get_dream_image: {e}", type="error", color="red")
         return None
 
 
-def update_dream_analysis_and_image(dream_id, analysis=None, image=None):
-    """Update the analysis and image for a dream.
+# Dream fields a patch may change
+DREAM_PATCH_FIELDS = ("title", "date", "entry", "symbols", "lucidity", "characters", "emotions", "setting", "analysis", "image")
+
+# Fields the document is built from, changing one of them re-embeds the dream
+DREAM_DOCUMENT_FIELDS = ("title", "entry")
+
+# Fields memory_to_dream puts at the top level of a dream rather than in its metadata
+DREAM_TOP_LEVEL_FIELDS = ("analysis", "image")
+
+
+def patch_dream(dream_id, changes):
+    """Write only the changed fields of a dream.
+
+    Fields whose value is None or equal to the stored one are left alone. The
+    storage backend merges the written fields into the stored metadata, and
+    the document is only rewritten, and re-embedded, when the title or entry
+    changes.
 
     Args:
         dream_id (str): ID of the dream.
-        analysis (str, optional): New analysis. Defaults to None.
-        image (str, optional): New image. Defaults to None.
+        changes (dict): New values of DREAM_PATCH_FIELDS.
 
     Returns:
-        dict: Updated dream object or None if not found.
+        dict: Updated dream object or None if not found or the update failed.
+
+    Raises:
+        ValueError: If changes holds a field that cannot be patched.
     """
-    log(
-        f"Initiating update for dream analysis and image for dream id {dream_id}.", type="info")
+    unknown = set(changes) - set(DREAM_PATCH_FIELDS)
+    if unknown:
+        raise ValueError(f"Cannot patch dream fields: {', '.join(sorted(unknown))}")
+    # Stored images are saved by digest, whatever URL of theirs a client sends back
+    if image_digest(changes.get("image")) is not None:
+        changes = {**changes, "image": image_digest(changes["image"])}
 
-    # Fetching the dream
     dream = get_dream(dream_id)
     if dream is None:
         log(f"Dream with id {dream_id} not found.", type="error", color="red")
         return None
 
-    # Validating metadata
     metadata = dream.get("metadata")
     if metadata is None:
         log(f"Metadata for dream with id {dream_id} not found.",
             type="error", color="red")
         return None
 
-    # Ensuring analysis and image are valid
-    if analysis:
-        if isinstance(analysis, str):  # Validate the type or content of analysis as needed
-            metadata["analysis"] = analysis
-        else:
-            log(f"Invalid analysis data for dream id {dream_id}.",
-                type="error", color="red")
-            return None
+    # get_dream exposes analysis and image at the top level, not in metadata
+    def stored(field):
+        return dream.get(field) if field in DREAM_TOP_LEVEL_FIELDS else metadata.get(field)
 
-    if image:
-        if isinstance(image, str):  # Validate the type or content of image as needed
-            metadata["image"] = image
-        else:
-            log(f"Invalid image data for dream id {dream_id}.",
-                type="error", color="red")
-            return None
+    patch = {
+        field: value
+        for field, value in changes.items()
+        if value is not None and stored(field) != value
+    }
+    if not patch:
+        log(f"Nothing to update for dream id {dream_id}.", type="info")
+        return dream
 
-    # Logging the state before the update
-    log(f"Updating dream id {dream_id} with metadata: {metadata}", type="info")
+    document = None
+    if any(field in patch for field in DREAM_DOCUMENT_FIELDS):
+        title = patch.get("title", metadata.get("title"))
+        entry = patch.get("entry", metadata.get("entry"))
+        document = f"{title}\n{entry}"
+
+    log(f"Patching dream id {dream_id} fields: {', '.join(patch)}", type="info")
 
-    # Updating the memory
     try:
-        update_memory("dreams", dream_id, metadata=metadata)
-        log("Dream analysis and image updated successfully.", type="info")
-        return dream
+        # update_memory adds updated_at to the dict it is given
+        if document is None:
+            update_memory("dreams", dream_id, metadata=dict(patch))
+        else:
+            update_memory("dreams", dream_id, text=document, metadata=dict(patch))
     except Exception as e:
         log(f"Failed to update dream id {dream_id}. Error: {str(e)}",
             type="error", color="red")
+        dream_cache.invalidate(dream_id)
         return None
 
+    metadata.update({
+        field: value for field, value in patch.items() if field not in DREAM_TOP_LEVEL_FIELDS
+    })
+    if "date" in patch:
+        update_dream_sort_index(metadata.get("useremail"), dream_id, metadata)
+    if document is not None:
+        dream["document"] = document
+        if dream_index is not None:
+            reindex_dream(metadata.get("useremail"), dream_id)
+    for field in DREAM_TOP_LEVEL_FIELDS:
+        if field in patch:
+            dream[field] = patch[field]
+    dream_cache.set(dream_id, dream)
+    return dream
+
+
+def update_dream_analysis_and_image(dream_id, analysis=None, image=None):
+    """Update the analysis and image for a dream.
+
+    Only the given fields are written, the dream is not re-embedded.
+
+    Args:
+        dream_id (str): ID of the dream.
+        analysis (str, optional): New analysis. Defaults to None.
+        image (str, optional): New image. Defaults to None.
+
+    Returns:
+        dict: Updated dream object or None if not found.
+    """
+    log(
+        f"Initiating update for dream analysis and image for dream id {dream_id}.", type="info")
+
+    # Ensuring analysis and image are valid
+    changes = {}
+    for field, value in (("analysis", analysis), ("image", image)):
+        if not value:
+            continue
+        if not isinstance(value, str):  # Validate the type or content as needed
+            log(f"Invalid {field} data for dream id {dream_id}.",
+                type="error", color="red")
+            return None
+        changes[field] = value
+
+    dream = patch_dream(dream_id, changes)
+    if dream is not None:
+        log("Dream analysis and image updated successfully.", type="info")
+    return dream
+
+
+def stream_dream_analysis(dream_id, intelligence_level='general', bypass_cache=False, dream=None):
+    """Yield a dream's analysis while it is generated, then cache and save it.
+
+    A cached analysis is yielded whole. Otherwise the text is streamed from the
+    model, and once the stream completes the full analysis is cached and saved
+    to the dream with update_dream_analysis_and_image.
+
+    Args:
+        dream_id (str): ID of the dream.
+        intelligence_level (str, optional): Level of intelligence for analysis. Defaults to 'general'.
+        bypass_cache (bool, optional): Generate a fresh analysis and overwrite the cached one. Defaults to False.
+        dream (dict, optional): Already loaded dream, to skip reading it again. Defaults to None.
+
+    Yields:
+        str: Analysis text in order.
+
+    Raises:
+        UpstreamError: If the model stream fails; nothing is cached or saved.
+    """
+    dream = dream or get_dream(dream_id)
+    entry = dream["metadata"]["entry"]
+    cache = get_analysis_cache()
+    cache_key = analysis_cache_key(entry, intelligence_level)
+    if not bypass_cache:
+        analysis = cache.get(cache_key)
+        if analysis is not None:
+            log(f"Streaming cached analysis for dream id {dream_id}.", type="info")
+            yield analysis
+            return
+
+    parts = []
+    for text in stream_dream_analysis_text(entry, intelligence_level):
+        parts.append(text)
+        yield text
+
+    analysis = "".join(parts)
+    cache.set(cache_key, analysis)
+    if update_dream_analysis_and_image(dream_id, analysis=analysis) is None:
+        log(f"Could not save streamed analysis for dream id {dream_id}.", type="error", color="red")
+
+
+def get_dream_image_summary(entry):
+    """Return the image summary of a dream entry, cached alongside the analyses.
+
+    Args:
+        entry (str): Dream entry.
+
+    Returns:
+        str: The summary, or an "Error:" message which is not cached.
+    """
+    cache = get_analysis_cache()
+    cache_key = image_summary_cache_key(entry)
+    summary = cache.get(cache_key)
+    if summary is not None:
+        return summary
+    summary = get_image_summary(entry)
+    if summary and not summary.startswith("Error:"):
+        cache.set(cache_key, summary)
+    return summary
+
 
-def search_dreams(keyword, user_email):
+def generate_dream_image_summary(dream_id):
+    """Summarize a dream for its image ahead of time, so image generation skips that step.
+
+    Meant to run as a background job.
+
+    Args:
+        dream_id (str): ID of the dream.
+
+    Returns:
+        str: The cached summary.
+
+    Raises:
+        RuntimeError: If the summary could not be generated.
+    """
+    dream = get_dream(dream_id)
+    if dream is None:
+        raise RuntimeError(f"Dream with id {dream_id} not found")
+    summary = get_dream_image_summary(dream["metadata"]["entry"])
+    if not summary or summary.startswith("Error:"):
+        raise RuntimeError(f"Could not summarize dream {dream_id} for its image")
+    return summary
+
+
+def queue_dream_pipeline(dream_id, intelligence_level='general', analysis=True, image_summary=False, owner=None):
+    """Queue background generation for a new dream.
+
+    Best effort: when the job queue is full the stage is skipped and happens
+    on demand instead, when the client asks for it.
+
+    Args:
+        dream_id (str): ID of the dream.
+        intelligence_level (str, optional): Level of the analysis. Defaults to 'general'.
+        analysis (bool, optional): Generate and save the analysis. Defaults to True.
+        image_summary (bool, optional): Precompute the image summary. Defaults to False.
+        owner (str, optional): Email of the dream's owner. Defaults to None.
+
+    Returns:
+        list: The queued jobs.
+    """
+    stages = []
+    if analysis:
+        stages.append(("analysis", generate_and_save_dream_analysis, (dream_id, intelligence_level),
+                       {"dream_id": dream_id, "intelligence_level": intelligence_level}))
+    if image_summary:
+        stages.append(("image_summary", generate_dream_image_summary, (dream_id,), {"dream_id": dream_id}))
+
+    jobs = []
+    for kind, fn, args, params in stages:
+        try:
+            jobs.append(job_queue.submit(kind, fn, *args, owner=owner, params=params))
+        except QueueFullError as e:
+            log(f"Skipped eager {kind} for dream id {dream_id}: {e}", type="warning")
+    return jobs
+
+
+def generate_and_save_dream_analysis(dream_id, intelligence_level='general'):
+    """Generate an analysis for a dream and store it on the dream.
+
+    Meant to run as a background job.
+
+    Args:
+        dream_id (str): ID of the dream.
+        intelligence_level (str, optional): Level of intelligence for analysis. Defaults to 'general'.
+
+    Returns:
+        str: The saved analysis.
+
+    Raises:
+        RuntimeError: If the analysis could not be generated or saved.
+    """
+    analysis = get_dream_analysis(dream_id, intelligence_level)
+    if not analysis:
+        raise RuntimeError(f"Could not generate analysis for dream {dream_id}")
+    if update_dream_analysis_and_image(dream_id, analysis=analysis) is None:
+        raise RuntimeError(f"Could not save analysis for dream {dream_id}")
+    return analysis
+
+
+def generate_and_save_dream_image(dream_id, style="renaissance", quality="low"):
+    """Generate an image for a dream and store it on the dream.
+
+    Meant to run as a background job.
+
+    Args:
+        dream_id (str): ID of the dream.
+        style (str, optional): Style for the image. Defaults to "renaissance".
+        quality (str, optional): Quality of the image. Defaults to "low".
+
+    Returns:
+        str: The saved image.
+
+    Raises:
+        RuntimeError: If the image could not be generated or saved.
+    """
+    image = get_dream_image(dream_id, style, quality)
+    if not image:
+        raise RuntimeError(f"Could not generate image for dream {dream_id}")
+    if update_dream_analysis_and_image(dream_id, image=image) is None:
+        raise RuntimeError(f"Could not save image for dream {dream_id}")
+    return image
+
+
+# Metadata returned with each search result
+SEARCH_RESULT_FIELDS = ("date", "title", "entry", "analysis", "symbols", "lucidity", "characters", "emotions", "setting")
+
+
+def embed_search_query(text):
+    """Embed a search query in this process.
+
+    Uses Chroma's default model (all-MiniLM-L6-v2), the model agentmemory's
+    Chroma and Postgres clients embed dreams with, loaded on first use.
+
+    Args:
+        text (str): Query to embed.
+
+    Returns:
+        list: The query's embedding.
+    """
+    global query_embedder
+    embedding = query_embedding_cache.get(text)
+    if embedding is not None:
+        return embedding
+    with query_embedder_lock:
+        if query_embedder is None:
+            from chromadb.utils.embedding_functions import DefaultEmbeddingFunction
+            query_embedder = DefaultEmbeddingFunction()
+    embedding = query_embedder([text])[0]
+    query_embedding_cache.set(text, embedding)
+    return embedding
+
+
+def build_dream_index(userEmail):
+    """Build a user's vector index from the embeddings in storage, a page of dreams at a time."""
+    items = (
+        (memory["id"], memory["embedding"])
+        for page in iter_dream_pages(userEmail, include_embeddings=True)
+        for memory in page
+    )
+    if dream_index.build(userEmail, items):
+        log(f"Built the dream vector index of {userEmail}.", type="info")
+    else:
+        log(f"Discarded the dream vector index of {userEmail}, it was dropped while it was built.", type="warning")
+
+
+def update_dream_index(userEmail, items=(), removed=()):
+    """Apply stored, re-embedded or deleted dreams to a user's vector index, if it is enabled.
+
+    A failed update drops the user's index, so the next search rebuilds it
+    from storage instead of ranking stale rows.
+
+    Args:
+        userEmail (str): Email of the user.
+        items (list, optional): (dream ID, embedding) pairs to add or replace. Defaults to ().
+        removed (list, optional): IDs of deleted dreams. Defaults to ().
+    """
+    if dream_index is None:
+        return
+    try:
+        if items:
+            dream_index.upsert(userEmail, items)
+        if removed:
+            dream_index.remove(userEmail, removed)
+    except Exception as e:
+        log(f"Failed to update the dream vector index of {userEmail}, dropping it: {e}", type="warning")
+        dream_index.drop(userEmail)
+
+
+def reindex_dream(userEmail, dream_id):
+    """Copy the new embedding of a re-embedded dream from storage into the user's vector index."""
+    try:
+        memory = get_memory("dreams", dream_id, include_embeddings=True)
+    except Exception as e:
+        log(f"Could not read the embedding of dream {dream_id}, dropping the vector index of {userEmail}: {e}", type="warning")
+        dream_index.drop(userEmail)
+        return
+    if memory is not None and memory.get("embedding") is not None:
+        update_dream_index(userEmail, items=[(dream_id, memory["embedding"])])
+
+
+def get_dreams_by_id(dream_ids):
+    """Return dreams from the dream cache, reading the missing ones from storage in one call.
+
+    Args:
+        dream_ids (list): IDs of the dreams.
+
+    Returns:
+        dict: Dreams keyed by ID, dreams that do not exist are left out.
+    """
+    dreams = {}
+    missing = []
+    for dream_id in dream_ids:
+        cached = dream_cache.get(dream_id)
+        if cached is not None:
+            dreams[dream_id] = cached
+        else:
+            missing.append(dream_id)
+    if missing:
+        collection = get_client().get_or_create_collection("dreams")
+        page = collection.get(ids=missing, include=["documents", "metadatas"])
+        for memory_id, document, metadata in zip(page["ids"], page["documents"], page["metadatas"]):
+            dream = memory_to_dream({"id": memory_id, "document": document, "metadata": metadata})
+            dream_cache.set(memory_id, dream)
+            dreams[memory_id] = dream
+    return dreams
+
+
+def search_dreams_in_index(keyword, user_email, n_results=100):
+    """Search a user's dreams in the vector index, building the index on first use.
+
+    Ranking the user's dreams needs no storage call, only dreams missing
+    from the dream cache are read, in one call.
+
+    Args:
+        keyword (str): Text to search for.
+        user_email (str): Email of the user whose dreams are searched.
+        n_results (int, optional): Maximum number of dreams to return. Defaults to 100.
+
+    Returns:
+        list: Matching dreams, most similar first, shaped like search_dreams returns them.
+    """
+    query = embed_search_query(keyword)
+    hits = dream_index.search(user_email, query, n_results)
+    if hits is None:
+        dream_index_builds.do(user_email, lambda: build_dream_index(user_email))
+        hits = dream_index.search(user_email, query, n_results)
+        if hits is None:
+            # A write failed during the build and dropped it, search_dreams falls back to storage
+            raise RuntimeError(f"The dream vector index of {user_email} was dropped while it was built")
+
+    dreams = get_dreams_by_id([dream_id for dream_id, _ in hits])
+    results = []
+    for dream_id, _ in hits:
+        dream = dreams.get(dream_id)
+        # Dreams deleted on another host stay in the index until it is rebuilt
+        if dream is None or dream["metadata"]["useremail"] != user_email:
+            continue
+        metadata = {**dream["metadata"], "analysis": dream.get("analysis")}
+        results.append({
+            "id": dream["id"],
+            "document": dream["document"],
+            "metadata": {key: metadata[key] for key in SEARCH_RESULT_FIELDS if metadata.get(key) is not None},
+        })
+    return results
+
+
+def search_dreams(keyword, user_email, n_results=100):
+    """Search a user's dreams by semantic similarity to a keyword.
+
+    The user filter is applied inside the similarity query, so only the user's
+    own dreams are ranked and other users never crowd out their results. With
+    DREAM_VECTOR_INDEX enabled the user's dreams are ranked in this process,
+    falling back to the storage backend if the index fails.
+
+    Args:
+        keyword (str): Text to search for.
+        user_email (str): Email of the user whose dreams are searched.
+        n_results (int, optional): Maximum number of dreams to return. Defaults to 100.
+
+    Returns:
+        list: Matching dreams, most similar first.
+    """
     log(f"Searching dreams for keyword: {keyword} and user email: {user_email}.", type="info")
-    search_results = search_memory("dreams", keyword, n_results=100)
+    if dream_index is not None:
+        try:
+            return search_dreams_in_index(keyword, user_email, n_results)
+        except Exception as e:
+            log(f"Vector index search failed for {user_email}, searching storage instead: {e}", type="warning")
+
+    search_results = search_memory(
+        "dreams",
+        keyword,
+        n_results=n_results,
+        filter_metadata={"useremail": user_email},
+        include_embeddings=False,
+    )
     
     # Adding new fields like symbols, lucidity, characters, emotions to the metadata dictionary
     dreams = [
@@ -298,12 +1104,12 @@ def search_dreams(keyword, user_email):
             "document": memory["document"],
             "metadata": {
                 key: memory["metadata"][key]
-                for key in ["date", "title", "entry", "analysis", "symbols", "lucidity", "characters", "emotions", "setting"]
+                for key in SEARCH_RESULT_FIELDS
                 if key in memory["metadata"]
             },
         }
         for memory in search_results
-        # filter results by user email, using lowercase 'useremail'
+        # guard against backends that ignore the filter, using lowercase 'useremail'
         if memory['metadata']['useremail'] == user_email
     ]
     return dreams
@@ -323,7 +1129,7 @@ def delete_dream(id):
         >>> delete_dream("1")
     """
 
-    dream_to_delete = get_memory(category="dreams", id=id)
+    dream_to_delete = get_dream(id)
 
     if dream_to_delete is None:
         log(
@@ -332,6 +1138,11 @@ def delete_dream(id):
 
     # Delete the dream using agentmemory's delete_memory function
     result = delete_memory(category="dreams", id=id)
+    dream_cache.invalidate(id)
+    if result:
+        update_dream_sort_index(dream_to_delete["metadata"]["useremail"], id)
+    if result and dream_index is not None:
+        update_dream_index(dream_to_delete["metadata"]["useremail"], removed=[id])
 
     if result:
         log(f"Deleted dream with ID {id}")
@@ -350,24 +1161,213 @@ def export_memory_to_json(include_embeddings=True, userEmail=None):
         memories = get_memories(
             collection_name, include_embeddings=include_embeddings)
         for memory in memories:
-            if userEmail is None or memory.get('metadata', {}).get('userEmail') == userEmail:
+            if userEmail is None or memory.get('metadata', {}).get('useremail') == userEmail:
                 collections_dict[collection_name].append(memory)
     return collections_dict
 
 
+# Dreams read from storage per page when exporting
+EXPORT_PAGE_SIZE = int(os.environ.get("EXPORT_PAGE_SIZE", 200))
+
+
+def iter_dream_pages(userEmail=None, page_size=None, include_embeddings=False, include_documents=True):
+    """Yield a user's dreams from storage a page at a time, without loading the whole journal.
+
+    Args:
+        userEmail (str, optional): Email of the user, or None for every user's dreams. Defaults to None.
+        page_size (int, optional): Dreams per page. Defaults to EXPORT_PAGE_SIZE.
+        include_embeddings (bool, optional): Also return each dream's embedding. Defaults to False.
+        include_documents (bool, optional): Return each dream's document, None otherwise. Defaults to True.
+
+    Yields:
+        list: Memories with id, document, metadata and optionally embedding, in storage order.
+    """
+    page_size = page_size or EXPORT_PAGE_SIZE
+    collection = get_client().get_or_create_collection("dreams")
+    where = {"useremail": userEmail} if userEmail is not None else None
+    include = ["metadatas"]
+    if include_documents:
+        include.append("documents")
+    if include_embeddings:
+        include.append("embeddings")
+    offset = 0
+    while True:
+        page = collection.get(where=where, limit=page_size, offset=offset, include=include)
+        documents = page["documents"] if include_documents else [None] * len(page["ids"])
+        memories = [
+            {"id": memory_id, "document": document, "metadata": metadata}
+            for memory_id, document, metadata in zip(page["ids"], documents, page["metadatas"])
+        ]
+        if include_embeddings:
+            for memory, embedding in zip(memories, page["embeddings"]):
+                memory["embedding"] = embedding
+        if memories:
+            yield memories
+        if len(memories) < page_size:
+            return
+        offset += len(memories)
+
+
+def memory_to_ndjson(memory):
+    """Encode a dream memory as one NDJSON line, shaped like the dreams API returns it."""
+    return json.dumps(memory_to_dream(memory)) + "\n"
+
+
+def memory_to_text(memory):
+    """Encode a dream memory as a block of the text export."""
+    title = memory.get('metadata', {}).get('title', '')
+    entry = memory.get('metadata', {}).get('entry', '')
+    analysis = memory.get('metadata', {}).get(
+        'analysis', 'No analysis available.')  # Get analysis if available
+    return f"Title: {title}\nEntry: {entry}\nAnalysis: {analysis}\n\n"
+
+
+# Streaming export formats: encoder of each dream, content type and file extension
+EXPORT_FORMATS = {
+    "ndjson": (memory_to_ndjson, "application/x-ndjson", "ndjson"),
+    "txt": (memory_to_text, "text/plain", "txt"),
+}
+
+
+def iter_dreams_export(userEmail, format="ndjson", compress=False, page_size=None):
+    """Yield a user's journal as encoded chunks, one page of dreams per chunk.
+
+    Memory use stays flat whatever the size of the journal, so the chunks can
+    be streamed straight into an HTTP response or a file.
+
+    Args:
+        userEmail (str): Email of the user, or None for every user's dreams.
+        format (str, optional): "ndjson" or "txt". Defaults to "ndjson".
+        compress (bool, optional): Gzip the output. Defaults to False.
+        page_size (int, optional): Dreams per page. Defaults to EXPORT_PAGE_SIZE.
+
+    Yields:
+        bytes: The next part of the export.
+
+    Raises:
+        ValueError: If the format is unknown.
+    """
+    if format not in EXPORT_FORMATS:
+        raise ValueError(f"Cannot export dreams as {format}")
+    encode = EXPORT_FORMATS[format][0]
+    # wbits=31 writes a gzip header and trailer around the deflate stream
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    for memories in iter_dream_pages(userEmail, page_size):
+        data = "".join(encode(memory) for memory in memories).encode("utf-8")
+        if compressor is not None:
+            data = compressor.compress(data)
+        if data:
+            yield data
+    if compressor is not None:
+        yield compressor.flush()
+
+
+def write_dreams_export(path, userEmail, format="ndjson", compress=False):
+    """Write a user's journal to a file, see iter_dreams_export.
+
+    Returns:
+        int: Number of bytes written.
+    """
+    written = 0
+    with open(path, "wb") as outfile:
+        for chunk in iter_dreams_export(userEmail, format, compress):
+            outfile.write(chunk)
+            written += len(chunk)
+    return written
+
+
+def journal_fingerprint(userEmail):
+    """Hash the IDs and update times of a user's dreams, which changes whenever the journal does.
+
+    Cheaper than an export: only metadata is read, a page at a time, and nothing is rendered.
+
+    Args:
+        userEmail (str): Email of the user.
+
+    Returns:
+        str: Hex digest identifying this version of the journal.
+    """
+    digest = hashlib.sha256()
+    for memories in iter_dream_pages(userEmail, include_documents=False):
+        for memory in memories:
+            digest.update(f"{memory['id']}:{memory['metadata'].get('updated_at')};".encode("utf-8"))
+    return digest.hexdigest()
+
+
 def export_dreams_to_json_file(path="./dreams.json", userEmail=None):
-    collections_dict = export_memory_to_json(include_embeddings=False, userEmail=userEmail)
-    dreams = collections_dict.get('dreams', [])
+    # Written as a JSON list a page at a time, rather than dumped from one big list
     with open(path, "w") as outfile:
-        json.dump(dreams, outfile)
+        outfile.write("[")
+        separator = ""
+        for memories in iter_dream_pages(userEmail):
+            for memory in memories:
+                outfile.write(separator + json.dumps(memory))
+                separator = ", "
+        outfile.write("]")
+
+# Dreams whose PDF flowables are built at a time, bounding memory for large journals
+PDF_BATCH_SIZE = int(os.environ.get("PDF_BATCH_SIZE", 100))
+# Processes rendering PDF exports; 0 renders in the request thread instead
+PDF_EXPORT_WORKERS = int(os.environ.get("PDF_EXPORT_WORKERS", 2))
+# Directory PDF exports are rendered into, defaults to the system temp directory
+EXPORT_TMP_DIR = os.environ.get("EXPORT_TMP_DIR") or None
+
+# Started on first export, see get_pdf_export_pool
+pdf_export_pool = None
+pdf_export_pool_lock = threading.Lock()
+
+
+def get_pdf_export_pool():
+    """Return the process pool rendering PDF exports, starting it on first use."""
+    global pdf_export_pool
+    with pdf_export_pool_lock:
+        if pdf_export_pool is None:
+            # Spawned rather than forked, forking a threaded server can deadlock the child
+            pdf_export_pool = ProcessPoolExecutor(
+                max_workers=PDF_EXPORT_WORKERS, mp_context=multiprocessing.get_context("spawn")
+            )
+        return pdf_export_pool
 
-def export_dreams_to_pdf(path="./dreams.pdf", userEmail=None):
-    # Use get_dreams to fetch dreams for the given userEmail
-    dreams = get_dreams(userEmail)
-    
-    # Initialize PDF document and story
-    doc = SimpleDocTemplate(path, pagesize=letter)
-    Story = []
+
+class BatchedStory(list):
+    """A story that reportlab consumes like a list, refilled one batch of flowables at a time.
+
+    Args:
+        batches (iterable): Lists of flowables, produced only when the previous batch is laid out.
+    """
+
+    def __init__(self, batches):
+        super().__init__()
+        self._batches = iter(batches)
+
+    def _refill(self):
+        while not super().__len__():
+            batch = next(self._batches, None)
+            if batch is None:
+                return
+            self.extend(batch)
+
+    def __len__(self):
+        self._refill()
+        return super().__len__()
+
+    def __getitem__(self, index):
+        self._refill()
+        return super().__getitem__(index)
+
+
+def render_dreams_pdf(dreams, out, batch_size=None):
+    """Render dreams into a PDF, building the flowables of batch_size dreams at a time.
+
+    Args:
+        dreams (iterable): Dream objects, read lazily.
+        out (str or file): Path or binary file to write the PDF to.
+        batch_size (int, optional): Dreams per batch. Defaults to PDF_BATCH_SIZE.
+    """
+    batch_size = batch_size or PDF_BATCH_SIZE
+
+    # Initialize PDF document
+    doc = SimpleDocTemplate(out, pagesize=letter)
 
     # Define some styles
     styles = getSampleStyleSheet()
@@ -376,36 +1376,117 @@ def export_dreams_to_pdf(path="./dreams.pdf", userEmail=None):
     entry_style = styles['BodyText']
     analysis_style = styles['Justify']
 
-    # Populate the PDF content
-    for dream in dreams:
-        metadata = dream.get('metadata', {})
-        title = metadata.get('title', 'No title available.')
-        entry = metadata.get('entry', 'No entry available.')
-        date = metadata.get('date', 'No date available.')  # Inside metadata
-        analysis = dream.get('analysis', 'No analysis available.')  # Outside metadata
-
-        # Add title, entry, date, and analysis to PDF as paragraphs
-        Story.append(Paragraph(f"<strong>Title:</strong> {title}", title_style))
-        Story.append(Spacer(1, 12))
-        Story.append(Paragraph(f"<strong>Date:</strong> {date}", title_style))
-        Story.append(Spacer(1, 12))
-        Story.append(Paragraph(f"<strong>Entry:</strong> {entry}", entry_style))
-        Story.append(Spacer(1, 12))
-        Story.append(Paragraph(f"<strong>Analysis:</strong> {analysis}", analysis_style))
-        Story.append(Spacer(1, 24))
+    def batches():
+        remaining = iter(dreams)
+        while True:
+            batch = list(itertools.islice(remaining, batch_size))
+            if not batch:
+                return
+            story = []
+            for dream in batch:
+                metadata = dream.get('metadata', {})
+                title = metadata.get('title', 'No title available.')
+                entry = metadata.get('entry', 'No entry available.')
+                date = metadata.get('date', 'No date available.')  # Inside metadata
+                analysis = dream.get('analysis', 'No analysis available.')  # Outside metadata
+
+                # Add title, entry, date, and analysis to PDF as paragraphs
+                story.append(Paragraph(f"<strong>Title:</strong> {title}", title_style))
+                story.append(Spacer(1, 12))
+                story.append(Paragraph(f"<strong>Date:</strong> {date}", title_style))
+                story.append(Spacer(1, 12))
+                story.append(Paragraph(f"<strong>Entry:</strong> {entry}", entry_style))
+                story.append(Spacer(1, 12))
+                story.append(Paragraph(f"<strong>Analysis:</strong> {analysis}", analysis_style))
+                story.append(Spacer(1, 24))
+            yield story
 
     # Build the PDF
-    doc.build(Story)
+    doc.build(BatchedStory(batches()))
+
+
+def export_dreams_to_pdf(path="./dreams.pdf", userEmail=None):
+    # Use get_dreams to fetch dreams for the given userEmail
+    render_dreams_pdf(get_dreams(userEmail), path)
+
+
+def render_user_dreams_pdf(path, userEmail):
+    """Render a user's dreams to a PDF file, reading them from storage a page at a time.
+
+    Runs in the export pool, which reads the dreams itself so they are never
+    loaded whole or sent between processes.
+
+    Args:
+        path (str): File to write the PDF to.
+        userEmail (str): Email of the user.
+
+    Returns:
+        int: Number of dreams rendered.
+    """
+    rendered = 0
+
+    def dreams():
+        nonlocal rendered
+        for page in iter_dream_pages(userEmail):
+            for memory in page:
+                rendered += 1
+                yield memory_to_dream(memory)
+
+    render_dreams_pdf(dreams(), path)
+    return rendered
+
+
+def render_dreams_pdf_file(path, userEmail):
+    """Render a user's dreams to a PDF file in the export pool, see render_user_dreams_pdf.
+
+    Args:
+        path (str): File to write the PDF to.
+        userEmail (str): Email of the user.
+    """
+    if PDF_EXPORT_WORKERS > 0:
+        rendered = get_pdf_export_pool().submit(render_user_dreams_pdf, path, userEmail).result()
+    else:
+        rendered = render_user_dreams_pdf(path, userEmail)
+    log(f"Rendered PDF of {rendered} dreams for {userEmail}.", type="info")
+
+
+class TemporaryExportFile(io.FileIO):
+    """A rendered export opened for binary reading, deleted once it is closed.
+
+    Deleting on close rather than right after opening also works on Windows,
+    where an open file cannot be removed.
+    """
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            try:
+                os.remove(self.name)
+            except FileNotFoundError:
+                pass
+
+
+def open_dreams_pdf(userEmail):
+    """Render a user's dreams to a PDF in the export pool and open it for reading.
+
+    Every call renders into its own temporary file, removed when the returned
+    handle is closed.
+
+    Args:
+        userEmail (str): Email of the user.
+
+    Returns:
+        file: The PDF, opened for binary reading.
+    """
+    fd, path = tempfile.mkstemp(prefix="dreams-", suffix=".pdf", dir=EXPORT_TMP_DIR)
+    os.close(fd)
+    try:
+        render_dreams_pdf_file(path, userEmail)
+        return TemporaryExportFile(path, "r")
+    except BaseException:
+        os.remove(path)
+        raise
 
 def export_dreams_to_txt(path="./dreams.txt", userEmail=None):
-    collections_dict = export_memory_to_json(include_embeddings=False, userEmail=userEmail)
-    dreams = collections_dict.get('dreams', [])
-    with open(path, "w") as txtfile:
-        for dream in dreams:
-            title = dream.get('metadata', {}).get('title', '')
-            entry = dream.get('metadata', {}).get('entry', '')
-            analysis = dream.get('metadata', {}).get(
-                'analysis', 'No analysis available.')  # Get analysis if available
-            # Add analysis to TXT
-            txtfile.write(
-                f"Title: {title}\nEntry: {entry}\nAnalysis: {analysis}\n\n")
+    write_dreams_export(path, userEmail, format="txt")
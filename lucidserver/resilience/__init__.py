@@ -0,0 +1,35 @@
+from .main import (
+    UpstreamError,
+    CircuitOpenError,
+    RateLimitedError,
+    CircuitBreaker,
+    RetryPolicy,
+    call_with_retries,
+    is_retryable,
+    is_retryable_status,
+    TokenBucket,
+    RateLimiter,
+    PriorityGate,
+    calling_as,
+    current_caller,
+    INTERACTIVE,
+    BACKGROUND,
+)
+
+__all__ = [
+    "UpstreamError",
+    "CircuitOpenError",
+    "RateLimitedError",
+    "CircuitBreaker",
+    "RetryPolicy",
+    "call_with_retries",
+    "is_retryable",
+    "is_retryable_status",
+    "TokenBucket",
+    "RateLimiter",
+    "PriorityGate",
+    "calling_as",
+    "current_caller",
+    "INTERACTIVE",
+    "BACKGROUND",
+]
@@ -0,0 +1,402 @@
+import time
+import heapq
+import random
+import itertools
+import threading
+import contextvars
+from contextlib import contextmanager
+import requests
+from agentlogger import log
+from lucidserver.cache import LRUCache
+
+# Priorities of calls waiting for upstream capacity, lower numbers go first
+INTERACTIVE = 0
+BACKGROUND = 10
+
+
+class UpstreamError(Exception):
+    """A failed call to an upstream service.
+
+    Args:
+        message (str): What went wrong.
+        retryable (bool, optional): Whether trying again may succeed. Defaults to True.
+        retry_after (float, optional): Seconds the upstream asked us to wait. Defaults to None.
+    """
+
+    def __init__(self, message, retryable=True, retry_after=None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(UpstreamError):
+    """Raised without calling the upstream while its circuit breaker is open."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message, retryable=False, retry_after=retry_after)
+
+
+class RateLimitedError(UpstreamError):
+    """Raised without calling the upstream when the caller is over its rate limit."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message, retryable=False, retry_after=retry_after)
+
+
+def is_retryable(error):
+    """Classify an exception raised by an upstream call.
+
+    Network failures, timeouts, rate limits and 5xx responses are worth retrying;
+    client errors and programming errors are not.
+    """
+    if isinstance(error, UpstreamError):
+        return error.retryable
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        return is_retryable_status(error.response.status_code)
+    return False
+
+
+def is_retryable_status(status_code):
+    """Return True for HTTP statuses that signal a transient upstream problem."""
+    return status_code in (408, 409, 429) or status_code >= 500
+
+
+class CircuitBreaker:
+    """Stops calling an upstream that keeps failing.
+
+    After `failure_threshold` consecutive retryable failures the circuit opens
+    and calls fail immediately for `reset_timeout` seconds. Then a single trial
+    call is let through: success closes the circuit, failure opens it again.
+
+    Args:
+        name (str): Upstream name used in logs and stats.
+        failure_threshold (int, optional): Consecutive failures that open the circuit. Defaults to 5.
+        reset_timeout (float, optional): Seconds the circuit stays open. Defaults to 30.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Close the circuit and clear the counters."""
+        with self._lock:
+            self.state = "closed"
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+            self.times_opened = 0
+            self.rejected = 0
+
+    def before_call(self):
+        """Check whether a call may proceed.
+
+        Raises:
+            CircuitOpenError: If the circuit is open or a trial call is already running.
+        """
+        with self._lock:
+            if self.state == "open":
+                remaining = self.opened_at + self.reset_timeout - time.monotonic()
+                if remaining > 0:
+                    self.rejected += 1
+                    raise CircuitOpenError(f"Circuit for {self.name} is open", retry_after=remaining)
+                self.state = "half_open"
+            if self.state == "half_open":
+                if self.trial_in_flight:
+                    self.rejected += 1
+                    raise CircuitOpenError(f"Circuit for {self.name} is testing the upstream", retry_after=1)
+                self.trial_in_flight = True
+
+    def record_success(self):
+        with self._lock:
+            if self.state != "closed":
+                log(f"Circuit for {self.name} closed", type="info")
+            self.state = "closed"
+            self.consecutive_failures = 0
+            self.trial_in_flight = False
+
+    def record_failure(self, retryable=True):
+        """Record a failed call; only retryable failures count against the upstream.
+
+        A non-retryable failure leaves the circuit as it was: the upstream
+        rejected this particular request, which says nothing about its health.
+        """
+        with self._lock:
+            self.trial_in_flight = False
+            if not retryable:
+                return
+            self.consecutive_failures += 1
+            if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+                if self.state != "open":
+                    self.times_opened += 1
+                    log(f"Circuit for {self.name} opened after {self.consecutive_failures} failures", type="error", color="red")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.consecutive_failures,
+                "times_opened": self.times_opened,
+                "rejected": self.rejected,
+            }
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter, bounded by attempts and an overall deadline.
+
+    Args:
+        max_attempts (int, optional): Total attempts including the first. Defaults to 4.
+        base_delay (float, optional): Backoff before the second attempt. Defaults to 1.
+        max_delay (float, optional): Upper bound of a single backoff. Defaults to 16.
+        deadline (float, optional): Seconds after which no new attempt starts. Defaults to 60.
+    """
+
+    def __init__(self, max_attempts=4, base_delay=1.0, max_delay=16.0, deadline=60.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    def backoff(self, attempt, retry_after=None):
+        """Seconds to wait after the given (1-based) failed attempt."""
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+
+def call_with_retries(fn, *args, breaker=None, policy=None, max_attempts=None, **kwargs):
+    """Call fn, retrying transient failures and honoring a circuit breaker.
+
+    fn signals failure by raising; raise UpstreamError to control whether the
+    failure is retried. Non-retryable failures are raised straight away.
+
+    Args:
+        fn (callable): The upstream call.
+        breaker (CircuitBreaker, optional): Breaker guarding the upstream. Defaults to None.
+        policy (RetryPolicy, optional): Backoff settings. Defaults to RetryPolicy().
+        max_attempts (int, optional): Overrides the policy's attempt count. Defaults to None.
+
+    Returns:
+        The return value of fn.
+
+    Raises:
+        CircuitOpenError: If the breaker refuses the call.
+        Exception: The last error once attempts or the deadline run out.
+    """
+    policy = policy or RetryPolicy()
+    max_attempts = max_attempts or policy.max_attempts
+    started = time.monotonic()
+    attempt = 0
+    while True:
+        attempt += 1
+        if breaker is not None:
+            breaker.before_call()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            retryable = is_retryable(e)
+            if breaker is not None:
+                breaker.record_failure(retryable)
+            if not retryable or attempt >= max_attempts:
+                raise
+            delay = policy.backoff(attempt, getattr(e, "retry_after", None))
+            if time.monotonic() - started + delay > policy.deadline:
+                log(f"Giving up after {attempt} attempts, deadline of {policy.deadline}s reached: {e}", type="error", color="red")
+                raise
+            log(f"Attempt {attempt} failed ({e}), retrying in {delay:.2f}s", type="warning")
+            time.sleep(delay)
+            continue
+        if breaker is not None:
+            breaker.record_success()
+        return result
+
+
+# Who upstream calls on this thread are made for, as (user, priority)
+current_call = contextvars.ContextVar("current_call", default=(None, INTERACTIVE))
+
+
+@contextmanager
+def calling_as(user, priority=INTERACTIVE):
+    """Attribute the upstream calls made inside the block to a user and a priority.
+
+    Args:
+        user (str): Email of the user the calls are made for, or None.
+        priority (int, optional): INTERACTIVE or BACKGROUND. Defaults to INTERACTIVE.
+    """
+    token = current_call.set((user, priority))
+    try:
+        yield
+    finally:
+        current_call.reset(token)
+
+
+def current_caller():
+    """Return (user, priority) of the calls made on this thread, see calling_as."""
+    return current_call.get()
+
+
+class TokenBucket:
+    """Allows `rate` calls per second on average and bursts of up to `capacity` calls.
+
+    Not thread safe, callers hold their own lock.
+
+    Args:
+        rate (float): Tokens added per second.
+        capacity (float): Most tokens the bucket holds; it starts full.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self, tokens=1):
+        """Take tokens if the bucket holds enough.
+
+        Returns:
+            float: 0 if the tokens were taken, otherwise seconds until they will be available.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return 0.0
+        return (tokens - self.tokens) / self.rate
+
+    def give_back(self, tokens=1):
+        """Return tokens taken for a call that was not made."""
+        self.tokens = min(self.capacity, self.tokens + tokens)
+
+
+class RateLimiter:
+    """A token bucket per key, e.g. per user and model, so no single caller uses up an upstream.
+
+    Args:
+        name (str): Limit name used in logs and stats.
+        rate (float): Calls per second each key may make on average.
+        burst (int): Calls each key may make at once.
+        max_keys (int, optional): Buckets kept; the least recently used are dropped and start full again. Defaults to 10000.
+    """
+
+    def __init__(self, name, rate, burst, max_keys=10000):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self._buckets = LRUCache(max_size=max_keys, copy_values=False)
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.rejected = 0
+        self.released = 0
+
+    def acquire(self, key, max_wait=0):
+        """Take a call for key, waiting up to max_wait seconds for one.
+
+        Raises:
+            RateLimitedError: If key has no call left within max_wait.
+        """
+        deadline = time.monotonic() + max_wait
+        while True:
+            with self._lock:
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    bucket = TokenBucket(self.rate, self.burst)
+                    self._buckets.set(key, bucket)
+                wait = bucket.take()
+                if not wait:
+                    self.allowed += 1
+                    return
+                if time.monotonic() + wait > deadline:
+                    self.rejected += 1
+                    raise RateLimitedError(f"Rate limit {self.name} exceeded", retry_after=wait)
+            time.sleep(wait)
+
+    def release(self, key):
+        """Give back a call taken for key that was not made after all, e.g. refused by another limit."""
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.give_back()
+                self.released += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "allowed": self.allowed,
+                "rejected": self.rejected,
+                "released": self.released,
+                "keys": len(self._buckets),
+                "rate": self.rate,
+                "burst": self.burst,
+            }
+
+
+class PriorityGate:
+    """A shared token bucket that hands out calls to waiting callers in priority order.
+
+    Meant for an upstream's overall rate limit: while calls queue up for it,
+    INTERACTIVE ones go before BACKGROUND ones, and equal priorities go in
+    arrival order.
+
+    Args:
+        name (str): Upstream name used in logs and stats.
+        rate (float): Calls per second on average.
+        burst (int): Calls allowed at once.
+    """
+
+    def __init__(self, name, rate, burst):
+        self.name = name
+        self._bucket = TokenBucket(rate, burst)
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._order = itertools.count()
+        self.allowed = 0
+        self.rejected = 0
+
+    def acquire(self, priority=INTERACTIVE, max_wait=0):
+        """Take a call, waiting up to max_wait seconds behind callers of higher priority.
+
+        Raises:
+            RateLimitedError: If no call is handed out within max_wait.
+        """
+        deadline = time.monotonic() + max_wait
+        ticket = (priority, next(self._order))
+        with self._cond:
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while True:
+                    wait = None
+                    if self._waiting[0] == ticket:
+                        wait = self._bucket.take()
+                        if not wait:
+                            self.allowed += 1
+                            return
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or (wait is not None and wait > remaining):
+                        self.rejected += 1
+                        retry_after = max(wait or 0, len(self._waiting) / self._bucket.rate)
+                        raise RateLimitedError(f"{self.name} is over its rate limit", retry_after=retry_after)
+                    self._cond.wait(remaining if wait is None else wait)
+            finally:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "allowed": self.allowed,
+                "rejected": self.rejected,
+                "waiting": len(self._waiting),
+                "rate": self._bucket.rate,
+                "burst": self._bucket.capacity,
+            }
@@ -1,3 +1,11 @@
 from .actions_tests import *
+from .cache_tests import *
 from .endpoints_tests import *
-from .memories_tests import *
\ No newline at end of file
+from .exports_tests import *
+from .history_tests import *
+from .http_tests import *
+from .images_tests import *
+from .jobs_tests import *
+from .memories_tests import *
+from .resilience_tests import *
+from .vectors_tests import *
\ No newline at end of file
@@ -1,10 +1,35 @@
 import sys
 sys.path.append('.')
 
+import json
+import threading
 import pytest
 from lucidserver.memories.main import search_dreams
 from lucidserver.actions.main import get_image_summary, generate_dream_analysis, generate_dream_image, regular_chat, call_function_by_name, search_chat_with_dreams
 from unittest.mock import patch, Mock
+from lucidserver.actions.main import completion_breaker, image_breaker, get_coalescing_stats, stream_dream_analysis_text, stream_regular_chat, stream_search_chat_with_dreams, chat_sessions, load_chat_state, chat_history, record_chat_turn, summarize_chat_history
+from lucidserver.actions.main import openai_gates, get_rate_limit_stats, admit_openai_call
+from lucidserver.resilience import UpstreamError, RateLimitedError, RateLimiter, calling_as, current_caller, BACKGROUND
+import openai
+
+
+# Token counts without downloading the tokenizer
+@pytest.fixture(autouse=True)
+def word_token_counts():
+    with patch('lucidserver.actions.main.count_tokens', side_effect=lambda text, model=None: len(text.split())):
+        yield
+
+
+# Every test starts with closed circuits and without real backoff sleeps
+@pytest.fixture(autouse=True)
+def reset_resilience():
+    completion_breaker.reset()
+    image_breaker.reset()
+    openai_gates.clear()
+    with patch('lucidserver.resilience.main.time.sleep'):
+        yield
+    completion_breaker.reset()
+    image_breaker.reset()
 
 
 # Mock response for text_completion function /////////////////////////////////////////////////////////////////////////////////////////////////////////////
@@ -77,42 +102,251 @@ def test_generate_dream_analysis_exception():
 
 # Mock response for generate image function /////////////////////////////////////////////////////////////////////////////////////////////////////////////  
 def mock_requests_post(*args, **kwargs):
-    response_mock = Mock()
+    response_mock = Mock(status_code=200)
     response_mock.json.return_value = {"data": [{"url": "https://example.com/image.png"}]}
     return response_mock
 
 # Test case for successful dream image generation
 def test_generate_dream_image_success():
     with patch('lucidserver.actions.main.get_image_summary', return_value="Generated Summary"):
-        with patch('requests.post', side_effect=mock_requests_post):
-            dreams = [{"id": "1", "metadata": {"entry": "A mysterious dream about a forest"}}]
-            dream_id = "1"
-            result = generate_dream_image(dreams, dream_id)
+        with patch('lucidserver.actions.main.openai_http.session.request', side_effect=mock_requests_post):
+            dream = {"id": "1", "metadata": {"entry": "A mysterious dream about a forest"}}
+            result = generate_dream_image(dream)
             assert result == "https://example.com/image.png", f"Expected image URL, but got {result}"
 
-# Test case for dream image generation with dream not found
+# Test case for dream image generation reusing a precomputed summary
+def test_generate_dream_image_reuses_summary():
+    with patch('lucidserver.actions.main.get_image_summary') as mock_summary, \
+         patch('lucidserver.actions.main.openai_http.session.request', side_effect=mock_requests_post) as mock_post:
+        dream = {"id": "1", "metadata": {"entry": "A mysterious dream about a forest"}}
+        result = generate_dream_image(dream, "abstract", summary="Precomputed Summary")
+        assert result == "https://example.com/image.png", f"Expected image URL, but got {result}"
+        mock_summary.assert_not_called()
+        assert "Precomputed Summary" in json.loads(mock_post.call_args.kwargs["data"])["prompt"]
+
+# Test case for dream image generation without a dream
 def test_generate_dream_image_dream_not_found():
-    dreams = [{"id": "1", "metadata": {"entry": "A mysterious dream about a forest"}}]
-    dream_id = "2"  # Dream ID not in the list
-    result = generate_dream_image(dreams, dream_id)
+    result = generate_dream_image(None)
     assert result is None, f"Expected None, but got {result}"
 
 # Test case for dream image generation with error in OpenAI API response
 def test_generate_dream_image_api_error():
     with patch('lucidserver.actions.main.get_image_summary', return_value="Generated Summary"):
-        with patch('requests.post', return_value=Mock(json=lambda: {})):  # No 'data' in response
-            dreams = [{"id": "1", "metadata": {"entry": "A mysterious dream about a forest"}}]
-            dream_id = "1"
-            result = generate_dream_image(dreams, dream_id)
+        with patch('lucidserver.actions.main.openai_http.session.request', return_value=Mock(status_code=200, json=lambda: {})):  # No 'data' in response
+            dream = {"id": "1", "metadata": {"entry": "A mysterious dream about a forest"}}
+            result = generate_dream_image(dream)
             assert result is None, f"Expected None, but got {result}"
 
 # Test case for exception handling in dream image generation
 def test_generate_dream_image_exception():
     with patch('lucidserver.actions.main.get_image_summary', side_effect=Exception("An unexpected exception")):
-        dreams = [{"id": "1", "metadata": {"entry": "A mysterious dream about a forest"}}]
-        dream_id = "1"
-        result = generate_dream_image(dreams, dream_id)
+        dream = {"id": "1", "metadata": {"entry": "A mysterious dream about a forest"}}
+        result = generate_dream_image(dream)
+        assert result is None, f"Expected None, but got {result}"
+
+
+# Test case for concurrent identical analyses sharing one completion
+def test_generate_dream_analysis_coalesces_concurrent_calls():
+    release = threading.Event()
+    started = threading.Event()
+
+    def slow_text_completion(*args, **kwargs):
+        started.set()
+        release.wait(5)
+        return {'text': 'Generated Analysis', 'error': None}
+
+    before = get_coalescing_stats()["analysis"]
+    results = []
+    with patch('lucidserver.actions.main.text_completion', side_effect=slow_text_completion) as mock_completion:
+        threads = [threading.Thread(target=lambda: results.append(generate_dream_analysis("A shared dream", "System Content", "expert")))
+                   for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        started.wait(5)
+        while get_coalescing_stats()["analysis"]["coalesced"] - before["coalesced"] < 2:
+            threading.Event().wait(0.01)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+    assert results == ["Generated Analysis"] * 3
+    assert mock_completion.call_count == 1, "Expected identical in-flight analyses to share one completion."
+
+# Test case for callers waiting on a rate-limited leader making their own call
+def test_generate_dream_analysis_does_not_share_rate_limit():
+    release = threading.Event()
+    calls = []
+
+    def limited_text_completion(*args, **kwargs):
+        calls.append(args)
+        if len(calls) == 1:
+            release.wait(5)
+            raise RateLimitedError("Leader is over its rate limit", retry_after=1)
+        return {'text': 'Generated Analysis', 'error': None}
+
+    before = get_coalescing_stats()["analysis"]
+    results = []
+    errors = []
+
+    def analyze():
+        try:
+            results.append(generate_dream_analysis("A limited dream", "System Content", "expert"))
+        except RateLimitedError as e:
+            errors.append(e)
+
+    with patch('lucidserver.actions.main.text_completion', side_effect=limited_text_completion):
+        threads = [threading.Thread(target=analyze) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        while get_coalescing_stats()["analysis"]["coalesced"] - before["coalesced"] < 2:
+            threading.Event().wait(0.01)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+    assert len(errors) == 1
+    assert results == ["Generated Analysis"] * 2
+    assert get_coalescing_stats()["analysis"]["reruns"] - before["reruns"] == 2
+
+# Test case for concurrent identical image requests sharing one images API call
+def test_generate_dream_image_coalesces_concurrent_calls():
+    release = threading.Event()
+
+    def slow_post(*args, **kwargs):
+        release.wait(5)
+        return mock_requests_post()
+
+    dream = {"id": "1", "metadata": {"entry": "A mysterious dream about a forest"}}
+    before = get_coalescing_stats()["image"]
+    results = []
+    with patch('lucidserver.actions.main.openai_http.session.request', side_effect=slow_post) as mock_post:
+        threads = [threading.Thread(target=lambda: results.append(generate_dream_image(dream, "abstract", "high", summary="Summary")))
+                   for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        while get_coalescing_stats()["image"]["coalesced"] - before["coalesced"] < 2:
+            threading.Event().wait(0.01)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+    assert results == ["https://example.com/image.png"] * 3
+    assert mock_post.call_count == 1
+
+# Test case for retrying a rate-limited image request
+def test_generate_dream_image_retries_rate_limit():
+    rate_limited = Mock(status_code=429, text="Rate limit", headers={})
+    with patch('lucidserver.actions.main.openai_http.session.request', side_effect=[rate_limited, mock_requests_post()]) as mock_post:
+        dream = {"id": "1", "metadata": {"entry": "A mysterious dream about a forest"}}
+        result = generate_dream_image(dream, summary="Generated Summary")
+        assert result == "https://example.com/image.png", f"Expected image URL, but got {result}"
+        assert mock_post.call_count == 2
+
+# Test case for not retrying a rejected image request
+def test_generate_dream_image_does_not_retry_client_error():
+    rejected = Mock(status_code=400, text="Content policy violation", headers={})
+    with patch('lucidserver.actions.main.openai_http.session.request', return_value=rejected) as mock_post:
+        dream = {"id": "1", "metadata": {"entry": "A mysterious dream about a forest"}}
+        result = generate_dream_image(dream, summary="Generated Summary")
         assert result is None, f"Expected None, but got {result}"
+        assert mock_post.call_count == 1
+
+# Test case for retrying an analysis after an upstream error response
+def test_generate_dream_analysis_retries_error_response():
+    responses = [{'text': None, 'error': 'Error: Could not get a successful response from OpenAI API'}, {'text': 'Generated Analysis', 'error': None}]
+    with patch('lucidserver.actions.main.text_completion', side_effect=responses) as mock_completion:
+        result = generate_dream_analysis("A profound dream about a journey", "System Content")
+        assert result == "Generated Analysis", f"Expected 'Generated Analysis', but got {result}"
+        assert mock_completion.call_count == 2
+        assert mock_completion.call_args.kwargs["model_failure_retries"] == 1
+
+# Test case for failing fast once the completions circuit is open
+def test_generate_dream_analysis_circuit_open():
+    with patch('lucidserver.actions.main.text_completion', side_effect=mock_text_completion_with_error) as mock_completion:
+        for _ in range(3):
+            generate_dream_analysis("A profound dream about a journey", "System Content")
+        calls_before = mock_completion.call_count
+        result = generate_dream_analysis("A profound dream about a journey", "System Content")
+        assert result == "Error: Unable to generate a response.", f"Expected error message, but got {result}"
+        assert mock_completion.call_count == calls_before, "Expected no upstream call while the circuit is open."
+        assert completion_breaker.stats()["state"] == "open"
+
+
+# Test case for a user over their completion rate limit
+def test_regular_chat_rate_limited_per_user():
+    limiter = RateLimiter("test", rate=0.01, burst=1)
+    with patch('lucidserver.actions.main.user_completion_limiter', limiter), \
+            patch('lucidserver.actions.main.chat_completion', side_effect=mock_chat_completion) as mock_completion:
+        with calling_as("user@example.com"):
+            assert regular_chat("Hi", "user@example.com") == "Generated Chat Response"
+            with pytest.raises(RateLimitedError):
+                regular_chat("Hi again", "user@example.com")
+        with calling_as("other@example.com"):
+            assert regular_chat("Hi", "other@example.com") == "Generated Chat Response"
+    assert mock_completion.call_count == 2
+    assert "gpt-3.5-turbo-16k" in get_rate_limit_stats()["models"]
+
+# Test case for a call refused by the organization's limit not counting against the user
+def test_admit_openai_call_gives_back_user_call():
+    limiter = RateLimiter("test", rate=0.01, burst=1)
+    gate = Mock()
+    gate.acquire.side_effect = [RateLimitedError("organization limit", retry_after=1), None]
+    with patch('lucidserver.actions.main.user_completion_limiter', limiter), \
+            patch('lucidserver.actions.main.get_openai_gate', return_value=gate):
+        with calling_as("user@example.com"):
+            with pytest.raises(RateLimitedError):
+                admit_openai_call("gpt-4")
+            admit_openai_call("gpt-4")
+    assert limiter.stats()["rejected"] == 0
+    assert limiter.stats()["released"] == 1
+
+# Test case for a background call waiting for the user's rate limit instead of failing
+def test_generate_dream_image_waits_in_background():
+    limiter = RateLimiter("test", rate=20, burst=1)
+    mock_response = Mock(status_code=200)
+    mock_response.json.return_value = {'data': [{'url': 'http://example.com/image.jpg'}]}
+    dream = {"id": "1", "metadata": {"entry": "A dream about waiting"}}
+    with patch('lucidserver.actions.main.user_image_limiter', limiter), \
+            patch('lucidserver.actions.main.openai_http.session.request', return_value=mock_response):
+        with calling_as("user@example.com", BACKGROUND):
+            assert generate_dream_image(dream, summary="Summary") == 'http://example.com/image.jpg'
+            assert generate_dream_image(dream, style="modern", summary="Summary") == 'http://example.com/image.jpg'
+    assert limiter.stats()["rejected"] == 0
+
+
+# Streamed completion chunks as returned by openai.ChatCompletion.create(stream=True)
+def mock_stream_chunks(*texts):
+    yield {"choices": [{"delta": {"role": "assistant"}}]}
+    for text in texts:
+        yield {"choices": [{"delta": {"content": text}}]}
+    yield {"choices": [{"delta": {}, "finish_reason": "stop"}]}
+
+# Test case for streaming a dream analysis token by token
+def test_stream_dream_analysis_text():
+    with patch('lucidserver.actions.main.openai.ChatCompletion.create', return_value=mock_stream_chunks("A ", "journey ", "inward.")) as mock_create:
+        result = list(stream_dream_analysis_text("A profound dream about a journey", "expert"))
+        assert result == ["A ", "journey ", "inward."], f"Expected streamed deltas, but got {result}"
+        assert mock_create.call_args.kwargs["stream"] is True
+        assert "expert-level" in mock_create.call_args.kwargs["messages"][0]["content"]
+
+# Test case for retrying a rate-limited stream before any token is sent
+def test_stream_dream_analysis_text_retries_open():
+    with patch('lucidserver.actions.main.openai.ChatCompletion.create',
+               side_effect=[openai.error.RateLimitError("Rate limit"), mock_stream_chunks("Analysis")]) as mock_create:
+        assert list(stream_dream_analysis_text("A profound dream about a journey")) == ["Analysis"]
+        assert mock_create.call_count == 2
+
+# Test case for a stream that breaks off after the first token
+def test_stream_dream_analysis_text_interrupted():
+    def broken_stream():
+        yield {"choices": [{"delta": {"content": "Partial"}}]}
+        raise openai.error.APIConnectionError("Connection reset")
+
+    with patch('lucidserver.actions.main.openai.ChatCompletion.create', return_value=broken_stream()):
+        stream = stream_dream_analysis_text("A profound dream about a journey")
+        assert next(stream) == "Partial"
+        with pytest.raises(UpstreamError):
+            next(stream)
 
 
 # Mock response for regular_chat function /////////////////////////////////////////////////////////////////////////////////////////////////////////////  
@@ -157,6 +391,88 @@ def test_regular_chat_exception():
         
         
         
+# Test case for a failed chat turn leaving the history untouched
+def test_regular_chat_error_keeps_history():
+    chat_sessions.delete("history@example.com")
+    with patch('lucidserver.actions.main.chat_completion', side_effect=mock_chat_completion_with_error):
+        regular_chat("Tell me more about lucid dreaming techniques.", "history@example.com")
+    assert load_chat_state("history@example.com")["messages"] == []
+
+# Test case for summarizing old chat messages in a job, without holding up the turn or the user's state
+def test_record_chat_turn_compacts_in_background():
+    user_email = "compact@example.com"
+    chat_sessions.delete(user_email)
+    release = threading.Event()
+    summarized = []
+
+    def summarize(summary, messages):
+        release.wait(5)
+        summarized.append(messages)
+        return "They dreamt of flying."
+
+    with patch.object(chat_history, "summarize", summarize), \
+         patch.object(chat_history, "history_budget", 40):
+        jobs = [record_chat_turn(user_email, [{"role": "user", "content": f"question {n} " + "word " * 8}])
+                for n in range(4)]
+        started = [job for job in jobs if job is not None]
+        # The turns returned while the summary was pending, and only one compaction was queued
+        assert len(started) == 1 and started[0].status in ("queued", "running")
+        # Another turn of the user is not held up by the pending summary either
+        chat_sessions.update(user_email, lambda state: chat_history.append(state, [{"role": "user", "content": "meanwhile"}]))
+        release.set()
+        assert started[0].wait(5)
+
+    state = load_chat_state(user_email)
+    assert len(summarized) == 1
+    assert state["summary"] == "They dreamt of flying."
+    assert state["messages"][-1]["content"] == "meanwhile"
+    assert not any(message["content"].startswith("question 0") for message in state["messages"])
+    chat_sessions.delete(user_email)
+
+# Test case for summarizing chat history outside the user's own rate limit
+def test_summarize_chat_history_runs_in_background():
+    callers = []
+
+    def completion(**kwargs):
+        callers.append(current_caller())
+        return {"text": "They dreamt of flying."}
+
+    with calling_as("limited@example.com"), \
+         patch('lucidserver.actions.main.text_completion', side_effect=completion), \
+         patch('lucidserver.actions.main.user_completion_limiter.acquire', side_effect=RateLimitedError("over limit", retry_after=30)):
+        summary = summarize_chat_history(None, [{"role": "user", "content": "I was flying"}])
+
+    assert summary == "They dreamt of flying."
+    assert callers == [(None, BACKGROUND)]
+
+# Test case for streaming a chat response and recording the turn once it completes
+def test_stream_regular_chat():
+    user_email = "stream@example.com"
+    chat_sessions.delete(user_email)
+    with patch('lucidserver.actions.main.openai.ChatCompletion.create', return_value=mock_stream_chunks("Lucid ", "dreams.")):
+        stream = stream_regular_chat("Tell me about lucid dreams.", user_email)
+        assert next(stream) == "Lucid "
+        assert load_chat_state(user_email)["messages"] == [], "Expected no history before the stream ends."
+        assert list(stream) == ["dreams."]
+    assert load_chat_state(user_email)["messages"] == [
+        {"role": "user", "content": "Tell me about lucid dreams."},
+        {"role": "assistant", "content": "Lucid dreams."},
+    ]
+
+# Test case for a broken chat stream leaving the history untouched
+def test_stream_regular_chat_interrupted():
+    def broken_stream():
+        yield {"choices": [{"delta": {"content": "Partial"}}]}
+        raise openai.error.APIConnectionError("Connection reset")
+
+    user_email = "broken@example.com"
+    chat_sessions.delete(user_email)
+    with patch('lucidserver.actions.main.openai.ChatCompletion.create', return_value=broken_stream()):
+        with pytest.raises(UpstreamError):
+            list(stream_regular_chat("Tell me about lucid dreams.", user_email))
+    assert load_chat_state(user_email)["messages"] == []
+
+
 # Mock search_chat_with_dream function /////////////////////////////////////////////////////////////////////////////////////////////////////////////  
 def mock_search_memory(*args, **kwargs):
     return [
@@ -210,4 +526,55 @@ def test_search_chat_with_dreams_without_results():
         user_email = "user@example.com"
         result = search_chat_with_dreams(function_name, prompt, user_email)
         assert 'arguments' in result, "Expected 'arguments' in result"
-        assert result.get('search_results') == [], "Unexpected non-empty 'search_results' in result"
\ No newline at end of file
+        assert result.get('search_results') == [], "Unexpected non-empty 'search_results' in result"
+
+# Test case for streaming the function call arguments of a search chat
+def test_stream_search_chat_with_dreams():
+    def function_chunks():
+        for fragment in ['{"emotions": ', '"joy"}']:
+            yield {"choices": [{"delta": {"function_call": {"arguments": fragment}}}]}
+
+    user_email = "user@example.com"
+    chat_sessions.delete(user_email)
+    with patch('lucidserver.memories.search_dreams', side_effect=mock_search_memory), \
+         patch('lucidserver.actions.main.count_tokens', side_effect=mock_count_tokens), \
+         patch('lucidserver.actions.main.openai.ChatCompletion.create', return_value=function_chunks()) as mock_create:
+        events = list(stream_search_chat_with_dreams("discuss_emotions", "Discuss emotions in dreams", user_email))
+
+    assert events[0][0] == "search_results"
+    assert [data["delta"] for event, data in events if event == "arguments"] == ['{"emotions": ', '"joy"}']
+    assert events[-1] == ("done", {"function_name": "discuss_emotions", "arguments": {"emotions": "joy"}})
+    assert mock_create.call_args.kwargs["function_call"] == {"name": "discuss_emotions"}
+    assert load_chat_state(user_email)["messages"] == [
+        {"role": "user", "content": "Discuss emotions in dreams"},
+        {"role": "assistant", "content": '{"emotions": "joy"}'},
+    ], "Expected only the prompt and reply to be kept, not the dream context."
+
+# Test case for sending the standing system prompt once per request instead of once per turn
+def test_regular_chat_sends_system_prompt_once():
+    user_email = "prompt@example.com"
+    chat_sessions.delete(user_email)
+    with patch('lucidserver.actions.main.chat_completion', side_effect=mock_chat_completion) as mock_completion:
+        for message in ["First question", "Second question", "Third question"]:
+            regular_chat(message, user_email)
+    messages = mock_completion.call_args.kwargs["messages"]
+    assert [m["role"] for m in messages] == ["system", "user", "assistant", "user", "assistant", "user"]
+    assert messages[-1]["content"] == "Third question"
+
+# Test case for keeping the topic stack per user instead of sharing it
+def test_search_chat_topics_are_per_user():
+    def function_chunks():
+        yield {"choices": [{"delta": {"function_call": {"arguments": "{}"}}}]}
+
+    chat_sessions.delete("user@example.com")
+    chat_sessions.delete("other@example.com")
+    with patch('lucidserver.memories.search_dreams', side_effect=mock_search_memory), \
+         patch('lucidserver.actions.main.openai.ChatCompletion.create', side_effect=lambda **kwargs: function_chunks()) as mock_create:
+        list(stream_search_chat_with_dreams("discuss_emotions", "Discuss emotions in dreams", "user@example.com"))
+        with patch('lucidserver.memories.search_dreams', return_value=[]):
+            list(stream_search_chat_with_dreams("discuss_emotions", "Discuss emotions in dreams", "other@example.com"))
+
+    assert load_chat_state("user@example.com")["topics"] == ["Some Title"]
+    assert load_chat_state("other@example.com")["topics"] == []
+    other_prompt = " ".join(m["content"] for m in mock_create.call_args.kwargs["messages"])
+    assert "Some Title" not in other_prompt, "Expected no topic to leak into another user's chat."
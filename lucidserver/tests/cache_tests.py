@@ -0,0 +1,178 @@
+import sys
+sys.path.append('.')
+
+import time
+import threading
+from unittest.mock import patch
+from lucidserver.cache.main import *
+
+
+# LRUCache tests ////////////////////////////////////////////////////////////////////////////////////////////////////////////////////////////
+def test_lru_cache_hit_and_miss():
+    cache = LRUCache(max_size=2)
+
+    assert cache.get("a") is None
+    cache.set("a", {"value": 1})
+    assert cache.get("a") == {"value": 1}
+
+    stats = cache.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 1
+    assert stats["size"] == 1
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(max_size=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")  # "b" is now the least recently used
+    cache.set("c", 3)
+
+    assert "a" in cache
+    assert "b" not in cache
+    assert "c" in cache
+    assert cache.stats()["evictions"] == 1
+
+def test_lru_cache_expires_entries():
+    cache = LRUCache(ttl=10)
+    with patch('lucidserver.cache.main.time.monotonic', return_value=100.0):
+        cache.set("a", 1)
+    with patch('lucidserver.cache.main.time.monotonic', return_value=105.0):
+        assert cache.get("a") == 1
+    with patch('lucidserver.cache.main.time.monotonic', return_value=111.0):
+        assert cache.get("a") is None
+    assert len(cache) == 0
+
+def test_lru_cache_returns_copies():
+    cache = LRUCache()
+    value = {"metadata": {"title": "Dream"}}
+    cache.set("a", value)
+    value["metadata"]["title"] = "Changed"
+    cache.get("a")["metadata"]["title"] = "Changed again"
+
+    assert cache.get("a") == {"metadata": {"title": "Dream"}}
+
+def test_lru_cache_invalidate():
+    cache = LRUCache()
+    cache.set("a", 1)
+    cache.invalidate("a")
+    cache.invalidate("missing")
+    assert cache.get("a") is None
+
+
+# PersistentLRUCache tests //////////////////////////////////////////////////////////////////////////////////////////////////////////////////
+def test_persistent_cache_survives_reopen(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = PersistentLRUCache(path)
+    cache.set("a", "analysis")
+
+    reopened = PersistentLRUCache(path)
+    assert reopened.get("a") == "analysis"
+    assert reopened.get("b") is None
+    assert reopened.stats()["hits"] == 1
+    assert reopened.stats()["misses"] == 1
+
+def test_persistent_cache_evicts_least_recently_used():
+    cache = PersistentLRUCache(":memory:", max_size=2)
+    with patch('lucidserver.cache.main.time.time', side_effect=[1.0, 2.0, 3.0, 4.0]):
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")  # "b" is now the least recently used
+        cache.set("c", 3)
+
+    assert "a" in cache
+    assert "b" not in cache
+    assert "c" in cache
+    assert len(cache) == 2
+    assert cache.stats()["evictions"] == 1
+
+
+# SingleFlight tests ////////////////////////////////////////////////////////////////////////////////////////////////////////////////////////
+def run_concurrently(count, fn):
+    results = [None] * count
+    errors = [None] * count
+
+    def worker(index):
+        try:
+            results[index] = fn()
+        except Exception as e:
+            errors[index] = e
+
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, results, errors
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    flight = SingleFlight("test")
+    release = threading.Event()
+    calls = []
+
+    def slow_call(value):
+        calls.append(value)
+        release.wait(5)
+        return f"result {value}"
+
+    threads, results, errors = run_concurrently(5, lambda: flight.do("key", slow_call, 1))
+    while flight.stats()["coalesced"] < 4:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert calls == [1]
+    assert results == ["result 1"] * 5
+    assert flight.stats() == {"calls": 1, "coalesced": 4, "reruns": 0, "in_flight": 0}
+
+
+def test_single_flight_shares_errors_and_forgets_finished_calls():
+    flight = SingleFlight("test")
+    release = threading.Event()
+
+    def failing_call():
+        release.wait(5)
+        raise ValueError("upstream failed")
+
+    threads, results, errors = run_concurrently(3, lambda: flight.do("key", failing_call))
+    while flight.stats()["coalesced"] < 2:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert all(isinstance(error, ValueError) for error in errors)
+
+    # A finished call is not remembered, the next one runs again
+    assert flight.do("key", lambda: "fresh") == "fresh"
+    assert flight.stats()["calls"] == 2
+
+
+def test_single_flight_reruns_private_errors():
+    flight = SingleFlight("test", private_errors=(KeyError,))
+    release = threading.Event()
+    calls = []
+
+    def limited_leader():
+        calls.append(threading.current_thread().name)
+        if len(calls) == 1:
+            release.wait(5)
+            raise KeyError("leader over its limit")
+        return "result"
+
+    threads, results, errors = run_concurrently(3, lambda: flight.do("key", limited_leader))
+    while flight.stats()["coalesced"] < 2:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert sum(isinstance(error, KeyError) for error in errors) == 1
+    assert results.count("result") == 2
+    assert len(calls) == 3
+    assert flight.stats()["reruns"] == 2
+
+
+def test_single_flight_distinct_keys_do_not_wait():
+    flight = SingleFlight("test")
+    assert flight.do(("dream-1", "general"), lambda: "a") == "a"
+    assert flight.do(("dream-1", "expert"), lambda: "b") == "b"
+    assert flight.stats()["coalesced"] == 0
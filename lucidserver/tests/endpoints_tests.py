@@ -1,11 +1,18 @@
 import sys
 sys.path.append('.')
 
-from unittest.mock import patch, mock_open
+from unittest.mock import patch, mock_open, Mock
+from cryptography.hazmat.primitives.asymmetric import rsa
 from app import app
 from lucidserver.endpoints.main import *
+from lucidserver.images import ImageStore
+from lucidserver.exports import ArtifactStore
+from lucidserver.resilience import current_caller
 import pytest
 import json
+import time
+import hashlib
+import threading
 
 # Placeholder for test user email
 test_user_email = "test@example.com"
@@ -64,6 +71,29 @@ def test_get_dreams_endpoint(mock_get_dream, mock_extract_user_email_from_token,
     assert response.json[0]["id"] == 1
 
 
+# Test get dreams endpoint with pagination
+@patch("lucidserver.endpoints.main.get_dreams_page", return_value={"dreams": [{"id": 1}], "next_cursor": "abc"})
+@patch("lucidserver.endpoints.main.extract_user_email_from_token", return_value=test_user_email)
+def test_get_dreams_endpoint_paginated(mock_extract_user_email_from_token, mock_get_dreams_page, client):
+    headers = {"Authorization": test_token}
+    response = client.get("/api/dreams?limit=1000&order_by=date&order=asc", headers=headers)
+    assert response.status_code == 200
+    assert response.json["dreams"][0]["id"] == 1
+    assert response.json["next_cursor"] == "abc"
+    mock_get_dreams_page.assert_called_once_with(
+        test_user_email, limit=MAX_DREAMS_PAGE_SIZE, cursor=None, order_by="date", descending=False)
+
+
+@patch("lucidserver.endpoints.main.get_dreams_page")
+@patch("lucidserver.endpoints.main.extract_user_email_from_token", return_value=test_user_email)
+def test_get_dreams_endpoint_rejects_invalid_paging(mock_extract_user_email_from_token, mock_get_dreams_page, client):
+    headers = {"Authorization": test_token}
+    for query in ("limit=10&order=newest", "limit=abc", "limit=-5", "limit=0", "cursor=", "limit=10&order_by=title"):
+        response = client.get(f"/api/dreams?{query}", headers=headers)
+        assert response.status_code == 400, query
+    mock_get_dreams_page.assert_not_called()
+
+
 # Test update dream endpoint
 @patch("lucidserver.endpoints.main.update_dream_analysis_and_image", return_value={"id": 1, "analysis": "updated_analysis"})
 @patch("lucidserver.endpoints.main.extract_user_email_from_token", return_value=test_user_email)
@@ -97,6 +127,32 @@ def test_get_dream_analysis_endpoint(mock_get_dream, mock_extract_user_email_fro
     assert response.json["analysis"] == "test_analysis"
 
 
+# Test streaming a dream analysis as Server-Sent Events
+@patch("lucidserver.endpoints.main.stream_dream_analysis", return_value=iter(["Streamed ", "analysis"]))
+@patch("lucidserver.endpoints.main.extract_user_email_from_token", return_value=test_user_email)
+@patch("lucidserver.endpoints.main.get_dream", return_value=mocked_dream)
+def test_stream_dream_analysis_endpoint(mock_get_dream, mock_extract_user_email_from_token, mock_stream_dream_analysis, client):
+    headers = {"Authorization": test_token, "Accept": "text/event-stream"}
+    response = client.get("/api/dreams/1/analysis", headers=headers)
+    assert response.status_code == 200
+    assert response.mimetype == "text/event-stream"
+    body = response.get_data(as_text=True)
+    assert 'event: token\ndata: {"text": "Streamed "}\n\n' in body
+    assert body.index("analysis\"}") < body.index("event: done")
+    assert mock_stream_dream_analysis.call_args.kwargs["dream"] == mocked_dream
+
+
+# Test that a failing stream ends with an error event
+@patch("lucidserver.endpoints.main.stream_dream_analysis", side_effect=Exception("OpenAI stream failed"))
+@patch("lucidserver.endpoints.main.extract_user_email_from_token", return_value=test_user_email)
+@patch("lucidserver.endpoints.main.get_dream", return_value=mocked_dream)
+def test_stream_dream_analysis_endpoint_error(mock_get_dream, mock_extract_user_email_from_token, mock_stream_dream_analysis, client):
+    response = client.get("/api/dreams/1/analysis?stream=true", headers={"Authorization": test_token})
+    body = response.get_data(as_text=True)
+    assert "event: error" in body
+    assert "event: done" not in body
+
+
 # Test get dream image endpoint
 @patch("lucidserver.endpoints.main.get_dream_image", return_value="test_image")
 @patch("lucidserver.endpoints.main.extract_user_email_from_token", return_value=test_user_email)
@@ -106,6 +162,73 @@ def test_get_dream_image_endpoint(mock_get_dream, mock_extract_user_email_from_t
     response = client.get("/api/dreams/1/image", headers=headers)
     assert response.status_code == 200
     assert response.json["image"] == "test_image"
+    # The endpoint hands its loaded dream to the image pipeline
+    assert mock_get_dream_image.call_args.kwargs["dream"] == mocked_dream
+
+
+# Test starting an analysis job and polling it to completion
+@patch("lucidserver.endpoints.main.generate_and_save_dream_analysis", return_value="job_analysis")
+@patch("lucidserver.endpoints.main.extract_user_email_from_token", return_value=test_user_email)
+@patch("lucidserver.endpoints.main.get_dream", return_value=mocked_dream)
+def test_dream_analysis_job_endpoint(mock_get_dream, mock_extract_user_email_from_token, mock_generate, client):
+    headers = {"Authorization": test_token}
+    response = client.post("/api/dreams/1/analysis", json={"intelligence_level": "expert"}, headers=headers)
+    assert response.status_code == 202
+    job_id = response.json["job_id"]
+    assert response.headers["Location"] == f"/api/jobs/{job_id}"
+
+    response = client.get(f"/api/jobs/{job_id}?wait=5", headers=headers)
+    assert response.status_code == 200
+    assert response.json["status"] == "succeeded"
+    assert response.json["result"] == "job_analysis"
+    mock_generate.assert_called_once_with("1", "expert")
+
+
+# Test that jobs are only visible to the user who started them
+@patch("lucidserver.endpoints.main.generate_and_save_dream_image", return_value="job_image")
+@patch("lucidserver.endpoints.main.extract_user_email_from_token", return_value=test_user_email)
+@patch("lucidserver.endpoints.main.get_dream", return_value=mocked_dream)
+def test_dream_image_job_endpoint_owner_only(mock_get_dream, mock_extract_user_email_from_token, mock_generate, client):
+    headers = {"Authorization": test_token}
+    response = client.post("/api/dreams/1/image", json={"quality": "high"}, headers=headers)
+    assert response.status_code == 202
+    job_id = response.json["job_id"]
+    assert response.json["params"] == {"dream_id": "1", "style": "renaissance", "quality": "high"}
+
+    mock_extract_user_email_from_token.return_value = "someone@example.com"
+    response = client.get(f"/api/jobs/{job_id}", headers=headers)
+    assert response.status_code == 404
+    assert job_queue.get(job_id).wait(5)
+
+
+# Test that stored images are answered with a URL on the scheme and host the client used
+@patch("lucidserver.endpoints.main.extract_user_email_from_token", return_value=test_user_email)
+@patch("lucidserver.endpoints.main.get_dream", return_value={**mocked_dream, "image": "a" * 64})
+def test_dream_image_urls_use_forwarded_host(mock_get_dream, mock_extract_user_email_from_token, client):
+    # Heroku's router terminates TLS and forwards plain HTTP
+    headers = {"Authorization": test_token, "X-Forwarded-Proto": "https", "X-Forwarded-Host": "lucid.example"}
+    digest = "a" * 64
+    response = client.get("/api/dreams/1", headers=headers)
+    assert response.json["image"] == f"https://lucid.example/api/images/{digest}"
+
+    with patch("lucidserver.endpoints.main.generate_and_save_dream_image", return_value=digest):
+        response = client.post("/api/dreams/1/image", headers=headers)
+        job = job_queue.get(response.json["job_id"])
+        assert job.wait(5)
+    assert job.result == digest
+    response = client.get(f"/api/jobs/{job.id}", headers=headers)
+    assert response.json["result"] == f"https://lucid.example/api/images/{digest}"
+
+
+# Test that a full job queue answers 503 with Retry-After
+@patch("lucidserver.endpoints.main.extract_user_email_from_token", return_value=test_user_email)
+@patch("lucidserver.endpoints.main.get_dream", return_value=mocked_dream)
+def test_dream_analysis_job_endpoint_queue_full(mock_get_dream, mock_extract_user_email_from_token, client):
+    headers = {"Authorization": test_token}
+    with patch("lucidserver.endpoints.main.job_queue.submit", side_effect=QueueFullError("full")):
+        response = client.post("/api/dreams/1/analysis", headers=headers)
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "5"
 
 
 # Test search dreams endpoint
@@ -133,23 +256,331 @@ def test_delete_dream_endpoint(mock_get_dream, mock_extract_user_email_from_toke
     
 # Test export dreams to PDF endpoint
 @patch("lucidserver.endpoints.main.extract_user_email_from_token", return_value=test_user_email)
-@patch("lucidserver.endpoints.main.export_dreams_to_pdf")
-@patch("builtins.open", new_callable=mock_open, read_data=b"Test PDF content")
-@patch("os.remove")
-def test_export_dreams_to_pdf_endpoint(mock_remove, mock_open_file, mock_export_dreams_to_pdf, mock_extract_user_email_from_token, client):
-    path = f"./dreams_{test_user_email}.pdf"
+def test_export_dreams_to_pdf_endpoint(mock_extract_user_email_from_token, client, tmp_path):
+    path = tmp_path / "dreams.pdf"
+    path.write_bytes(b"%PDF Test PDF content" * 10000)
+    pdf_file = open(path, "rb")
+    headers = {"Authorization": test_token}
+    with patch("lucidserver.endpoints.main.open_dreams_pdf", return_value=pdf_file) as mock_open_dreams_pdf:
+        response = client.get("/api/dreams/export/pdf", headers=headers)
+        body = response.get_data()
+        response.close()
+
+    # Verifying that the PDF was rendered for the requesting user
+    mock_open_dreams_pdf.assert_called_once_with(test_user_email)
+
+    assert response.status_code == 200
+    assert response.mimetype == "application/pdf"
+    assert response.headers["Content-Disposition"] == "attachment; filename=dreams.pdf"
+    assert response.content_length == len(body) == path.stat().st_size
+    assert body == path.read_bytes()
+    assert pdf_file.closed
+
+
+# Test that a failed PDF export answers 500
+@patch("lucidserver.endpoints.main.extract_user_email_from_token", return_value=test_user_email)
+@patch("lucidserver.endpoints.main.open_dreams_pdf", side_effect=RuntimeError("render failed"))
+def test_export_dreams_to_pdf_endpoint_error(mock_open_dreams_pdf, mock_extract_user_email_from_token, client):
+    response = client.get("/api/dreams/export/pdf", headers={"Authorization": test_token})
+    assert response.status_code == 500
+
+
+# Local JWKS fixture so token verification is testable offline //////////////////////////////////////////////////////////////////////////////
+@pytest.fixture
+def local_jwks():
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(private_key.public_key()))
+    jwk.update({"kid": "test-kid", "use": "sig", "alg": "RS256"})
+    return {"private_key": private_key, "jwks": {"keys": [jwk]}}
+
+
+def mock_jwks_response(jwks, cache_control="max-age=600"):
+    response = Mock()
+    response.json.return_value = jwks
+    response.headers = {"Cache-Control": cache_control}
+    return response
+
+
+# Test that keys are fetched once and served from the cache afterwards
+def test_jwks_cache_fetches_once(local_jwks):
+    cache = JWKSCache("https://example.com/keys")
+    with patch("lucidserver.endpoints.main.apple_http.session.request", return_value=mock_jwks_response(local_jwks["jwks"])) as mock_get:
+        first = cache.get_key("test-kid")
+        second = cache.get_key("test-kid")
+
+    assert first is second
+    assert mock_get.call_count == 1
+    assert cache.expires_at - cache.fetched_at == pytest.approx(600), "Expected max-age to set the key lifetime."
+
+
+# Test that unknown kids re-fetch at most once per refresh interval and then fail
+def test_jwks_cache_unknown_kid(local_jwks):
+    cache = JWKSCache("https://example.com/keys", min_refresh_interval=60)
+    with patch("lucidserver.endpoints.main.apple_http.session.request", return_value=mock_jwks_response(local_jwks["jwks"])) as mock_get:
+        cache.get_key("test-kid")
+        for _ in range(3):
+            with pytest.raises(Exception):
+                cache.get_key("rotated-kid")
+
+    assert mock_get.call_count == 1
+
+
+# Test that expired keys are still served while a background refresh runs
+def test_jwks_cache_background_refresh(local_jwks):
+    cache = JWKSCache("https://example.com/keys")
+    with patch("lucidserver.endpoints.main.apple_http.session.request", return_value=mock_jwks_response(local_jwks["jwks"], "")) as mock_get:
+        cache.get_key("test-kid")
+        cache.expires_at = 0.0
+        assert cache.get_key("test-kid") is not None
+        cache._background_refresh.join()
+
+    assert mock_get.call_count == 2
+    assert cache.expires_at - cache.fetched_at == pytest.approx(cache.ttl)
+
+
+# Test that concurrent misses share a single fetch
+def test_jwks_cache_single_flight(local_jwks):
+    cache = JWKSCache("https://example.com/keys")
+    release = threading.Event()
+
+    def slow_get(*args, **kwargs):
+        release.wait(5)
+        return mock_jwks_response(local_jwks["jwks"])
+
+    with patch("lucidserver.endpoints.main.apple_http.session.request", side_effect=slow_get) as mock_get:
+        threads = [threading.Thread(target=cache.get_key, args=("test-kid",)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join()
+
+    assert mock_get.call_count == 1
+
+
+
+def sign_test_token(private_key, **claims):
+    payload = {"aud": "com.jamesfeura.lucidjournal", "email": test_user_email, "exp": int(time.time()) + 3600}
+    payload.update(claims)
+    return jwt.encode(payload, private_key, algorithm="RS256", headers={"kid": "test-kid"})
+
+
+# Test that a verified token is served from the cache without repeating the crypto
+def test_decode_and_verify_token_cached(local_jwks):
+    verified_token_cache.clear()
+    token = sign_test_token(local_jwks["private_key"])
+    with patch("lucidserver.endpoints.main.apple_http.session.request", return_value=mock_jwks_response(local_jwks["jwks"])), \
+         patch("lucidserver.endpoints.main.apple_jwks", JWKSCache("https://example.com/keys")), \
+         patch("lucidserver.endpoints.main.jwt.decode", wraps=jwt.decode) as mock_decode:
+        first = decode_and_verify_token(token)
+        second = decode_and_verify_token(token)
+
+    assert first["email"] == second["email"] == test_user_email
+    assert mock_decode.call_count == 1
+
+
+# Test that cached claims are dropped once the token expires
+def test_decode_and_verify_token_cache_expires(local_jwks):
+    verified_token_cache.clear()
+    token = sign_test_token(local_jwks["private_key"], exp=int(time.time()) + 30)
+    with patch("lucidserver.endpoints.main.apple_http.session.request", return_value=mock_jwks_response(local_jwks["jwks"])), \
+         patch("lucidserver.endpoints.main.apple_jwks", JWKSCache("https://example.com/keys")):
+        decode_and_verify_token(token)
+        digest = hashlib.sha256(token.encode("utf-8")).hexdigest()
+        assert digest in verified_token_cache
+        with patch("lucidserver.cache.main.time.monotonic", return_value=time.monotonic() + 60), \
+             patch("lucidserver.endpoints.main.jwt.decode", wraps=jwt.decode) as mock_decode:
+            assert digest not in verified_token_cache
+            decode_and_verify_token(token)
+
+    assert mock_decode.call_count == 1, "Expected an expired cache entry to be verified again."
+
+
+# Test that the stats endpoint reports connection reuse alongside the other counters
+@patch("lucidserver.endpoints.main.extract_user_email_from_token", return_value=test_user_email)
+def test_get_stats_endpoint(mock_extract_user_email_from_token, client):
+    response = client.get("/api/stats", headers={"Authorization": test_token})
+    assert response.status_code == 200
+    assert "connections_reused" in response.json["http"]["openai"]
+    assert "connections_reused" in response.json["http"]["apple"]
+    assert set(response.json) == {"http", "dream_cache", "dream_index", "analysis_cache", "verified_token_cache", "openai_breakers", "chat_sessions", "coalescing", "rate_limits", "images", "exports", "jobs"}
+
+
+# Test streaming the chat endpoint
+@patch("lucidserver.endpoints.main.stream_regular_chat", return_value=iter(["Lucid ", "dreams."]))
+@patch("lucidserver.endpoints.main.extract_user_email_from_token", return_value=test_user_email)
+def test_stream_chat_endpoint(mock_extract_user_email_from_token, mock_stream_regular_chat, client):
+    response = client.post("/api/chat?stream=true", json={"message": "Hi"}, headers={"Authorization": test_token})
+    assert response.status_code == 200
+    assert response.mimetype == "text/event-stream"
+    body = response.get_data(as_text=True)
+    assert body.count("event: token") == 2
+    assert body.rstrip().endswith("event: done\ndata: {}")
+    mock_stream_regular_chat.assert_called_once_with("Hi", test_user_email)
+
+
+# Test streaming the search chat endpoint
+@patch("lucidserver.endpoints.main.stream_search_chat_with_dreams",
+       return_value=iter([("search_results", []), ("arguments", {"delta": "{}"}), ("done", {"function_name": "discuss_emotions", "arguments": {}})]))
+@patch("lucidserver.endpoints.main.extract_user_email_from_token", return_value=test_user_email)
+def test_stream_search_chat_endpoint(mock_extract_user_email_from_token, mock_stream_search_chat, client):
+    response = client.post("/api/dreams/search-chat", json={"function_name": "discuss_emotions", "prompt": "Hi"},
+                           headers={"Authorization": test_token, "Accept": "text/event-stream"})
+    body = response.get_data(as_text=True)
+    assert body.index("event: search_results") < body.index("event: arguments") < body.index("event: done")
+
+
+# Test serving a stored image with long-lived cache headers and ETags
+def test_get_image_endpoint(client, tmp_path):
+    store = ImageStore(str(tmp_path))
+    data = b"png bytes"
+    digest = store.put(data)
+    with patch("lucidserver.endpoints.main.image_store", store):
+        response = client.get(f"/api/images/{digest}")
+        assert response.status_code == 200
+        assert response.data == data
+        assert response.mimetype == "image/png"
+        assert response.headers["ETag"] == f'"{digest}"'
+        assert "immutable" in response.headers["Cache-Control"]
+        assert "max-age=31536000" in response.headers["Cache-Control"]
+
+        revalidated = client.get(f"/api/images/{digest}", headers={"If-None-Match": f'"{digest}"'})
+        assert revalidated.status_code == 304
+
+        # Without a thumbnail of that size the original is served
+        assert client.get(f"/api/images/{digest}?size=128").data == data
+        assert client.get(f"/api/images/{'0' * 64}").status_code == 404
+        assert client.get("/api/images/not-a-digest").status_code == 404
+
+
+# Test that a rate limited user gets 429 with Retry-After
+@patch("lucidserver.endpoints.main.regular_chat", side_effect=RateLimitedError("too fast", retry_after=2.2))
+@patch("lucidserver.endpoints.main.extract_user_email_from_token", return_value=test_user_email)
+def test_chat_endpoint_rate_limited(mock_extract_user_email_from_token, mock_regular_chat, client):
+    response = client.post("/api/chat", json={"message": "Hi"}, headers={"Authorization": test_token})
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "3"
+
+
+# Test that streamed responses are generated for the requesting user and report rate limits
+@patch("lucidserver.endpoints.main.extract_user_email_from_token", return_value=test_user_email)
+def test_stream_chat_endpoint_rate_limited(mock_extract_user_email_from_token, client):
+    callers = []
+
+    def limited_stream(message, user_email):
+        callers.append(current_caller()[0])
+        raise RateLimitedError("too fast", retry_after=0.5)
+        yield
+
+    with patch("lucidserver.endpoints.main.stream_regular_chat", side_effect=limited_stream):
+        response = client.post("/api/chat?stream=true", json={"message": "Hi"}, headers={"Authorization": test_token})
+        body = response.get_data(as_text=True)
+    assert callers == [test_user_email]
+    assert 'event: error\ndata: {"error": "Too many requests, try again later.", "retry_after": 1}' in body
+
+
+# Test importing dreams in bulk from a JSON list
+@patch("lucidserver.endpoints.main.extract_user_email_from_token", return_value=test_user_email)
+def test_bulk_create_dreams_endpoint(mock_extract_user_email_from_token, client):
+    dreams = [
+        {"title": "First", "date": "2022-08-07", "entry": "Entry", "source_app": "other"},
+        {"title": "No entry", "date": "2022-08-07"},
+        {"title": "Second", "date": "2022-08-08", "entry": "Entry", "lucidity": 4},
+    ]
+    created = [{"id": "a", "status": "created"}, {"id": "b", "status": "created"}]
+    with patch("lucidserver.endpoints.main.create_dreams", return_value=created) as mock_create_dreams:
+        response = client.post("/api/dreams/bulk", json=dreams, headers={"Authorization": test_token})
+    assert response.status_code == 200
+    assert response.json["created"] == 2
+    assert response.json["failed"] == 1
+    results = response.json["results"]
+    assert results[0] == {"index": 0, "id": "a", "status": "created"}
+    assert results[1]["status"] == "invalid" and "entry" in results[1]["errors"]
+    assert results[2] == {"index": 2, "id": "b", "status": "created"}
+    stored = mock_create_dreams.call_args[0][0]
+    assert stored == [{"title": "First", "date": "2022-08-07", "entry": "Entry"},
+                      {"title": "Second", "date": "2022-08-08", "entry": "Entry", "lucidity": 4}]
+
+
+# Test importing dreams in bulk from NDJSON
+@patch("lucidserver.endpoints.main.extract_user_email_from_token", return_value=test_user_email)
+def test_bulk_create_dreams_endpoint_ndjson(mock_extract_user_email_from_token, client):
+    body = '{"title": "First", "date": "2022-08-07", "entry": "Entry"}\nnot json\n\n'
+    with patch("lucidserver.endpoints.main.create_dreams", return_value=[{"id": "a", "status": "created"}]):
+        response = client.post("/api/dreams/bulk", data=body, content_type="application/x-ndjson",
+                               headers={"Authorization": test_token})
+    assert [result["status"] for result in response.json["results"]] == ["created", "invalid"]
+
+
+# Test that bulk imports must contain dreams and stay under the limit
+@patch("lucidserver.endpoints.main.extract_user_email_from_token", return_value=test_user_email)
+def test_bulk_create_dreams_endpoint_rejects_bad_bodies(mock_extract_user_email_from_token, client):
+    headers = {"Authorization": test_token}
+    assert client.post("/api/dreams/bulk", json={"title": "Not a list"}, headers=headers).status_code == 400
+    with patch("lucidserver.endpoints.main.BULK_MAX_DREAMS", 1):
+        response = client.post("/api/dreams/bulk", json={"dreams": [{}, {}]}, headers=headers)
+    assert response.status_code == 413
+
+
+
+# Test streaming the journal as gzipped NDJSON
+@patch("lucidserver.endpoints.main.extract_user_email_from_token", return_value=test_user_email)
+def test_export_dreams_endpoint_ndjson_gzip(mock_extract_user_email_from_token, client):
+    with patch("lucidserver.endpoints.main.iter_dreams_export", return_value=iter([b"part1", b"part2"])) as mock_export:
+        response = client.get("/api/dreams/export/ndjson?gzip=true", headers={"Authorization": test_token})
+        assert response.get_data() == b"part1part2"
+    mock_export.assert_called_once_with(test_user_email, "ndjson", compress=True)
+    assert response.mimetype == "application/gzip"
+    assert response.headers["Content-Disposition"] == "attachment; filename=dreams.ndjson.gz"
+
+
+# Test that unknown export formats are not found
+@patch("lucidserver.endpoints.main.extract_user_email_from_token", return_value=test_user_email)
+def test_export_dreams_endpoint_unknown_format(mock_extract_user_email_from_token, client):
+    response = client.get("/api/dreams/export/docx", headers={"Authorization": test_token})
+    assert response.status_code == 404
+
+
+
+# Test starting a background export
+@patch("lucidserver.endpoints.main.extract_user_email_from_token", return_value=test_user_email)
+def test_start_export_job_endpoint(mock_extract_user_email_from_token, client):
     headers = {"Authorization": test_token}
-    response = client.get("/api/dreams/export/pdf", headers=headers)
+    with patch("lucidserver.endpoints.main.create_export", return_value={"artifact_id": "a"}) as mock_create_export:
+        response = client.post("/api/exports", json={"format": "txt", "gzip": True}, headers=headers)
+        assert response.status_code == 202
+        job = job_queue.get(response.json["job_id"])
+        assert job.wait(5)
+    mock_create_export.assert_called_once_with(test_user_email, "txt", True)
+    assert job.result == {"artifact_id": "a"}
+
+    assert client.post("/api/exports", json={"format": "docx"}, headers=headers).status_code == 400
+    assert client.post("/api/exports", json={"format": "pdf", "gzip": True}, headers=headers).status_code == 400
 
-    # Verifying that the export_dreams_to_pdf function was called with the correct path
-    mock_export_dreams_to_pdf.assert_called_once_with(path=path)
 
-    # Verifying that the file was read
-    mock_open_file.assert_called_once_with(path, 'rb')
+# Test downloading an export artifact with Range requests, only by its owner
+@patch("lucidserver.endpoints.main.extract_user_email_from_token", return_value=test_user_email)
+def test_download_export_endpoint(mock_extract_user_email_from_token, client, tmp_path, monkeypatch):
+    store = ArtifactStore(str(tmp_path))
+    monkeypatch.setattr("lucidserver.endpoints.main.artifact_store", store)
+    artifact_id = "ab" * 32
+
+    def write(path):
+        with open(path, "wb") as f:
+            f.write(b"0123456789")
 
-    # Verifying that the file was deleted
-    mock_remove.assert_called_once_with(path)
+    store.put(artifact_id, write, owner=test_user_email, filename="dreams.txt", mimetype="text/plain")
+    headers = {"Authorization": test_token}
 
+    response = client.get(f"/api/exports/{artifact_id}", headers=headers)
     assert response.status_code == 200
-    assert response.mimetype == "application/pdf"
-    assert response.headers["Content-Disposition"] == f"attachment; filename=dreams_{test_user_email}.pdf"
\ No newline at end of file
+    assert response.data == b"0123456789"
+    assert response.headers["Content-Disposition"] == "attachment; filename=dreams.txt"
+
+    response = client.get(f"/api/exports/{artifact_id}", headers={**headers, "Range": "bytes=4-"})
+    assert response.status_code == 206
+    assert response.data == b"456789"
+
+    mock_extract_user_email_from_token.return_value = "someone@example.com"
+    assert client.get(f"/api/exports/{artifact_id}", headers=headers).status_code == 404
+    assert client.get("/api/exports/not-an-id", headers=headers).status_code == 404
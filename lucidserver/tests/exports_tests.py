@@ -0,0 +1,105 @@
+import sys
+sys.path.append('.')
+
+import os
+import time
+import pytest
+from unittest.mock import patch
+from lucidserver.exports.main import *
+
+
+artifact_id = "ab" * 32
+
+
+def write_text(text):
+    def write(path):
+        with open(path, "w") as f:
+            f.write(text)
+    return write
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = ArtifactStore(str(tmp_path), ttl=60)
+    monkeypatch.setattr('lucidserver.exports.main.artifact_store', store)
+    return store
+
+
+# ArtifactStore tests ///////////////////////////////////////////////////////////////////////////////////////////////////////////////////////
+def test_artifact_store_put_and_get(store):
+    artifact = store.put(artifact_id, write_text("export"), owner="user@example.com",
+                         filename="dreams.txt", mimetype="text/plain")
+
+    assert artifact["size"] == 6
+    assert store.get(artifact_id) == artifact
+    assert open(store.path(artifact_id)).read() == "export"
+    assert [name for name in os.listdir(store.root) if name.endswith(".tmp")] == []
+
+def test_artifact_store_expires(store):
+    store.put(artifact_id, write_text("export"), owner="user@example.com", filename="dreams.txt", mimetype="text/plain")
+    with patch('lucidserver.exports.main.time.time', return_value=time.time() + 61):
+        assert store.get(artifact_id) is None
+    assert not os.path.exists(store.path(artifact_id))
+
+def test_artifact_store_cleanup_removes_expired(store):
+    store.put(artifact_id, write_text("old"), owner="user@example.com", filename="dreams.txt", mimetype="text/plain")
+    store._last_cleanup = 0
+    with patch('lucidserver.exports.main.time.time', return_value=time.time() + 61):
+        store.put("cd" * 32, write_text("new"), owner="user@example.com", filename="dreams.txt", mimetype="text/plain")
+    assert not os.path.exists(store.path(artifact_id))
+    assert store.stats()["expired"] == 1
+
+def test_artifact_store_failed_write_leaves_nothing(store):
+    def failing(path):
+        raise RuntimeError("render failed")
+
+    with pytest.raises(RuntimeError):
+        store.put(artifact_id, failing, owner="user@example.com", filename="dreams.pdf", mimetype="application/pdf")
+    assert store.get(artifact_id) is None
+    assert os.listdir(store.root) == []
+
+def test_artifact_store_renew_extends_lifetime(store):
+    store.put(artifact_id, write_text("export"), owner="user@example.com", filename="dreams.txt", mimetype="text/plain")
+    later = time.time() + 50
+    with patch('lucidserver.exports.main.time.time', return_value=later):
+        assert store.renew(artifact_id)["expires_at"] == later + 60
+    with patch('lucidserver.exports.main.time.time', return_value=later + 30):
+        assert store.get(artifact_id) is not None
+    assert store.renew("cd" * 32) is None
+    assert store.stats()["reused"] == 1
+
+def test_artifact_store_rejects_invalid_ids(store):
+    with pytest.raises(ValueError):
+        store.path("../secrets")
+    assert store.get("../secrets") is None
+
+
+# create_export tests ///////////////////////////////////////////////////////////////////////////////////////////////////////////////////////
+def test_create_export_reuses_unchanged_journal(store):
+    with patch('lucidserver.exports.main.journal_fingerprint', return_value="v1"), \
+            patch('lucidserver.exports.main.write_export', side_effect=lambda path, *args: write_text("export")(path)) as mock_write:
+        first = create_export("user@example.com", "txt", compress=True)
+        second = create_export("user@example.com", "txt", compress=True)
+
+    assert mock_write.call_count == 1
+    assert first["reused"] is False and second["reused"] is True
+    assert first["artifact_id"] == second["artifact_id"]
+    assert first["filename"] == "dreams.txt.gz"
+    assert first["download_url"] == f"/api/exports/{first['artifact_id']}"
+    assert store.get(first["artifact_id"])["mimetype"] == "application/gzip"
+
+def test_create_export_after_journal_changes(store):
+    with patch('lucidserver.exports.main.write_export', side_effect=lambda path, *args: write_text("export")(path)) as mock_write:
+        with patch('lucidserver.exports.main.journal_fingerprint', return_value="v1"):
+            first = create_export("user@example.com", "pdf")
+        with patch('lucidserver.exports.main.journal_fingerprint', return_value="v2"):
+            second = create_export("user@example.com", "pdf")
+
+    assert mock_write.call_count == 2
+    assert first["artifact_id"] != second["artifact_id"]
+
+def test_create_export_rejects_bad_formats(store):
+    with pytest.raises(ValueError):
+        create_export("user@example.com", "docx")
+    with pytest.raises(ValueError):
+        create_export("user@example.com", "pdf", compress=True)
@@ -0,0 +1,217 @@
+import sys
+sys.path.append('.')
+
+import time
+import threading
+import pytest
+from unittest.mock import Mock, patch
+from lucidserver.history.main import *
+from lucidserver.resilience import UpstreamError
+
+
+def word_count(text):
+    return len(text.split())
+
+
+def turn(n):
+    return [{"role": "user", "content": f"question {n} " + "word " * 8}, {"role": "assistant", "content": f"answer {n} " + "word " * 8}]
+
+
+# Test that the system prompt is sent once and never stored
+def test_build_messages_system_prompt_not_stored():
+    history = ChatHistory(word_count)
+    state = history.new_state()
+    history.record(state, turn(1))
+    messages = history.build_messages(state, [{"role": "user", "content": "next"}], system_prompt="Be a dream guide.")
+    assert messages[0] == {"role": "system", "content": "Be a dream guide."}
+    assert [m["role"] for m in messages[1:]] == ["user", "assistant", "user"]
+    assert all(m["content"] != "Be a dream guide." for m in state["messages"])
+
+
+# Test that only the newest history that fits the token budget is sent
+def test_build_messages_respects_budget():
+    history = ChatHistory(word_count, token_budget=60, history_budget=1000)
+    state = history.new_state()
+    for n in range(5):
+        history.record(state, turn(n))
+    current = [{"role": "user", "content": "next question"}]
+    messages = history.build_messages(state, current)
+
+    assert sum(history.message_tokens(m) for m in messages) <= 60
+    assert messages[-1] == current[0]
+    assert messages[-2]["content"].startswith("answer 4"), "Expected the newest history to be kept."
+    assert len(messages) < 11
+
+
+# Test that old turns are compacted into a summary that is reused
+def test_record_compacts_into_summary():
+    summarize = Mock(return_value="They dreamt of flying.")
+    history = ChatHistory(word_count, history_budget=60, summarize=summarize)
+    state = history.new_state()
+    for n in range(4):
+        history.record(state, turn(n))
+
+    assert summarize.call_count == 1
+    previous_summary, compacted = summarize.call_args.args
+    assert previous_summary is None
+    assert compacted[0]["content"].startswith("question 0")
+    assert sum(state["tokens"]) <= 60
+    assert state["summary"] == "They dreamt of flying."
+
+    messages = history.build_messages(state, [{"role": "user", "content": "next"}])
+    assert messages[0] == {"role": "system", "content": "Summary of the earlier conversation: They dreamt of flying."}
+    assert summarize.call_count == 1, "Expected the summary to be reused, not regenerated."
+
+
+# Test that a failed summary keeps the old messages for the next compaction
+def test_record_summary_failure_keeps_messages():
+    summarize = Mock(side_effect=UpstreamError("OpenAI down"))
+    history = ChatHistory(word_count, history_budget=60, summarize=summarize)
+    state = history.new_state()
+    for n in range(4):
+        history.record(state, turn(n))
+    assert state["summary"] is None
+    assert state["messages"][0]["content"].startswith("question 0")
+    assert len(state["messages"]) == 8
+
+    summarize.side_effect = None
+    summarize.return_value = "They dreamt of flying."
+    history.record(state, turn(4))
+    assert state["summary"] == "They dreamt of flying."
+    assert summarize.call_args.args[1][0]["content"].startswith("question 0")
+    # The backlog is folded in over the next turns, a budget's worth at a time
+    history.record(state, turn(5))
+    assert sum(state["tokens"]) <= 60
+
+
+# Test that unexpected errors while summarizing are not swallowed
+def test_record_summary_programming_error_raises():
+    history = ChatHistory(word_count, history_budget=60, summarize=Mock(side_effect=KeyError("text")))
+    state = history.new_state()
+    with pytest.raises(KeyError):
+        for n in range(4):
+            history.record(state, turn(n))
+
+
+# Test that a compaction is not applied over one that finished first
+def test_apply_compaction_skipped_when_state_changed():
+    history = ChatHistory(word_count, history_budget=60)
+    state = history.new_state()
+    for n in range(3):
+        history.append(state, turn(n))
+    overflow = history.append(state, turn(3))
+    assert overflow[0]["content"].startswith("question 0")
+
+    assert history.apply_compaction(state, None, overflow, "First summary.") is True
+    assert history.apply_compaction(state, None, overflow, "Second summary.") is False
+    assert state["summary"] == "First summary."
+    assert len(state["messages"]) == len(state["tokens"])
+
+
+# Test that token counts of repeated content are cached
+def test_message_tokens_cached():
+    count = Mock(side_effect=word_count)
+    history = ChatHistory(count)
+    for _ in range(3):
+        assert history.message_tokens({"role": "system", "content": "a standing prompt"}) == 3 + MESSAGE_OVERHEAD_TOKENS
+    assert count.call_count == 1
+
+
+# Test that topics are pushed per turn and capped
+def test_record_topics_capped():
+    history = ChatHistory(word_count)
+    state = history.new_state()
+    for n in range(MAX_TOPICS + 5):
+        history.record(state, [], topic=f"topic {n}")
+    history.record(state, [])
+    assert len(state["topics"]) == MAX_TOPICS
+    assert state["topics"][-1] == f"topic {MAX_TOPICS + 4}"
+
+
+# Session store tests ///////////////////////////////////////////////////////////////////////////////////////////////////////////////////////
+@pytest.fixture(params=["memory", "sqlite"])
+def session_store(request):
+    if request.param == "memory":
+        return MemorySessionStore(max_sessions=2, ttl=60)
+    return SQLiteSessionStore(":memory:", max_sessions=2, ttl=60)
+
+
+# Test that sessions are isolated per user and returned as copies
+def test_session_store_isolation(session_store):
+    state = ChatHistory.new_state()
+    state["topics"].append("flying")
+    session_store.save("a@example.com", state)
+    state["topics"].append("falling")
+
+    assert session_store.load("a@example.com")["topics"] == ["flying"]
+    assert session_store.load("b@example.com") is None
+    session_store.delete("a@example.com")
+    assert session_store.load("a@example.com") is None
+
+
+# Test that the least recently active session is evicted beyond the cap
+def test_session_store_cap(session_store):
+    for n, user in enumerate(["a@example.com", "b@example.com", "c@example.com"]):
+        with patch('lucidserver.history.main.time.time', return_value=1000.0 + n):
+            session_store.save(user, ChatHistory.new_state())
+    with patch('lucidserver.history.main.time.time', return_value=1003.0):
+        assert session_store.load("a@example.com") is None
+        assert session_store.load("c@example.com") is not None
+    assert session_store.stats()["size"] == 2
+
+
+# Test that idle sessions expire
+def test_session_store_idle_ttl(session_store):
+    session_store.save("a@example.com", ChatHistory.new_state())
+    later = time.time() + 61
+    with patch('lucidserver.history.main.time.time', return_value=later), \
+         patch('lucidserver.cache.main.time.monotonic', return_value=time.monotonic() + 61):
+        assert session_store.load("a@example.com") is None
+
+
+# Test that two workers sharing the SQLite file see the same conversation
+def test_sqlite_session_store_shared(tmp_path):
+    path = str(tmp_path / "sessions.db")
+    first, second = SQLiteSessionStore(path), SQLiteSessionStore(path)
+    state = ChatHistory.new_state()
+    state["messages"].append({"role": "user", "content": "I was flying"})
+    first.save("a@example.com", state)
+    assert second.load("a@example.com")["messages"] == state["messages"]
+
+
+# Test that users hold separate locks, released once nobody uses them
+def test_session_store_lock_per_user():
+    store = MemorySessionStore()
+    with store.lock("a@example.com"):
+        acquired = threading.Event()
+        other = threading.Thread(target=lambda: store.update("b@example.com", lambda state: acquired.set()))
+        other.start()
+        other.join(timeout=2)
+        assert acquired.is_set(), "Expected another user's update not to wait."
+    assert store._locks == {}
+
+
+# Test that concurrent updates from two workers sharing the SQLite file are all kept
+def test_sqlite_session_store_update_atomic(tmp_path):
+    path = str(tmp_path / "sessions.db")
+    workers = [SQLiteSessionStore(path), SQLiteSessionStore(path)]
+
+    def add_turns(store, worker):
+        for n in range(20):
+            store.update("a@example.com", lambda state: state["messages"].append({"role": "user", "content": f"{worker}-{n}"}))
+
+    threads = [threading.Thread(target=add_turns, args=(store, worker)) for worker, store in enumerate(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(workers[0].load("a@example.com")["messages"]) == 40
+
+
+# Test that the store is chosen from the environment
+def test_create_session_store(monkeypatch, tmp_path):
+    monkeypatch.delenv("SESSION_STORE", raising=False)
+    assert isinstance(create_session_store(), MemorySessionStore)
+    monkeypatch.setenv("SESSION_STORE", "sqlite")
+    monkeypatch.setenv("SESSION_STORE_PATH", str(tmp_path / "sessions.db"))
+    assert isinstance(create_session_store(), SQLiteSessionStore)
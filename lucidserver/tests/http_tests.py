@@ -0,0 +1,75 @@
+import sys
+sys.path.append('.')
+
+import pytest
+import threading
+import requests
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from lucidserver.http.main import *
+
+
+class SlowHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+
+    def do_GET(self):
+        if self.path == "/slow":
+            self.server.release.wait(5)
+        body = b'{"ok": true}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+# Local keep-alive server so pooling is tested against real sockets
+@pytest.fixture
+def local_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SlowHandler)
+    server.release = threading.Event()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.release.set()
+    server.shutdown()
+    server.server_close()
+
+
+# Test that sequential requests share one kept-alive connection
+def test_http_client_reuses_connections(local_server):
+    client = HTTPClient("test")
+    for _ in range(5):
+        assert client.get(f"{local_server}/fast").json() == {"ok": True}
+
+    stats = client.stats()
+    assert stats["requests"] == 5
+    assert stats["connections_opened"] == 1
+    assert stats["connections_reused"] == 4
+    client.close()
+
+
+# Test that a stalled upstream hits the read timeout instead of hanging
+def test_http_client_read_timeout(local_server):
+    client = HTTPClient("test", read_timeout=0.2)
+    with pytest.raises(requests.exceptions.Timeout):
+        client.get(f"{local_server}/slow")
+    assert client.stats()["errors"] == 1
+    client.close()
+
+
+# Test that an explicit timeout overrides the client default
+def test_http_client_timeout_override(local_server):
+    client = HTTPClient("test", read_timeout=0.2)
+    with pytest.raises(requests.exceptions.Timeout):
+        client.get(f"{local_server}/slow", timeout=(1, 0.1))
+    client.close()
+
+
+# Test that clients are shared per upstream and reported in the stats
+def test_get_http_client_shared():
+    client = get_http_client("test-shared")
+    assert get_http_client("test-shared") is client
+    assert get_http_stats()["test-shared"]["requests"] == 0
@@ -0,0 +1,92 @@
+import sys
+sys.path.append('.')
+
+import io
+import os
+import pytest
+from PIL import Image
+from unittest.mock import patch, Mock
+from lucidserver.images.main import *
+
+
+def png_bytes(size=256, color=(40, 80, 160)):
+    buffer = io.BytesIO()
+    Image.new("RGB", (size, size), color).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+# Test that images are stored under their digest, once
+def test_image_store_put_deduplicates(tmp_path):
+    store = ImageStore(str(tmp_path))
+    data = png_bytes()
+    digest = store.put(data)
+
+    assert digest == hashlib.sha256(data).hexdigest()
+    assert open(store.path(digest), "rb").read() == data
+    assert store.put(data) == digest
+    assert store.stats()["stored"] == 1 and store.stats()["duplicates"] == 1
+
+
+# Test that thumbnails are generated only for sizes smaller than the image
+def test_image_store_thumbnails(tmp_path):
+    store = ImageStore(str(tmp_path), thumbnail_sizes=(64, 512))
+    digest = store.put(png_bytes(256))
+
+    assert Image.open(store.path(digest, 64)).size == (64, 64)
+    assert not store.exists(digest, 512)
+
+
+# Test that unreadable images are still stored, without thumbnails
+def test_image_store_put_unreadable(tmp_path):
+    store = ImageStore(str(tmp_path))
+    digest = store.put(b"not an image")
+    assert store.exists(digest)
+    assert not store.exists(digest, 128)
+
+
+# Test that only real digests map to paths
+def test_image_store_path_validation(tmp_path):
+    store = ImageStore(str(tmp_path))
+    with pytest.raises(ValueError):
+        store.path("../../etc/passwd")
+    assert not store.exists("../../etc/passwd")
+    assert not store.exists(None)
+
+
+# Test that downloads go through the pooled client and are stored
+def test_image_store_download(tmp_path):
+    store = ImageStore(str(tmp_path))
+    response = Mock(status_code=200, content=png_bytes(), raise_for_status=lambda: None)
+    with patch('lucidserver.images.main.image_http.session.request', return_value=response) as mock_request:
+        digest = store.download("https://openai.example/image.png")
+    assert store.exists(digest)
+    assert mock_request.call_args.args == ("GET", "https://openai.example/image.png")
+    assert store.stats()["downloads"] == 1
+
+
+# Test that stored image URLs round-trip to their digest
+def test_image_url_and_digest():
+    digest = "a" * 64
+    assert image_digest(image_url(digest)) == digest
+    assert image_digest("https://openai.example/image.png") is None
+    assert image_digest(f"{IMAGE_BASE_URL}/not-a-digest") is None
+    assert image_digest(None) is None
+
+# Test that stored images, by digest or by their old URL, are served on the request's host
+def test_public_image_url_uses_request_host():
+    digest = "a" * 64
+    expected = f"https://lucid.example{IMAGE_BASE_PATH}/{digest}"
+    assert image_digest(digest) == digest
+    assert public_image_url(digest, "https://lucid.example/") == expected
+    assert public_image_url(f"{IMAGE_BASE_PATH}/{digest}", "https://lucid.example/") == expected
+    assert public_image_url(f"http://old.example{IMAGE_BASE_PATH}/{digest}", "https://lucid.example/") == expected
+    assert public_image_url("https://openai.example/image.png", "https://lucid.example/") == "https://openai.example/image.png"
+    assert public_image_url(digest) == f"{IMAGE_BASE_PATH}/{digest}"
+
+# Test that an absolute IMAGE_BASE_URL wins over the request host
+def test_image_url_absolute_base(monkeypatch):
+    monkeypatch.setattr('lucidserver.images.main.IMAGE_BASE_URL', "https://cdn.example/images/")
+    monkeypatch.setattr('lucidserver.images.main.IMAGE_BASE_PATH', "/images")
+    digest = "b" * 64
+    assert public_image_url(digest, "https://lucid.example/") == f"https://cdn.example/images/{digest}"
+    assert image_digest(f"https://cdn.example/images/{digest}") == digest
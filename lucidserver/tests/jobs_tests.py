@@ -0,0 +1,58 @@
+import sys
+sys.path.append('.')
+
+import threading
+import pytest
+from lucidserver.jobs.main import *
+from lucidserver.resilience import current_caller, BACKGROUND
+
+
+# JobQueue tests ////////////////////////////////////////////////////////////////////////////////////////////////////////////////////////////
+def test_job_queue_runs_job():
+    queue = JobQueue(max_workers=1, max_queue=1)
+    job = queue.submit("analysis", lambda a, b: a + b, 1, 2, owner="user@example.com", params={"dream_id": "1"})
+
+    assert job.wait(5), "Expected the job to finish."
+    assert job.status == "succeeded"
+    assert job.result == 3
+    assert queue.get(job.id) is job
+    assert job.to_dict()["params"] == {"dream_id": "1"}
+    assert queue.stats()["succeeded"] == 1
+
+def test_job_queue_records_failures():
+    def failing():
+        raise RuntimeError("upstream down")
+
+    queue = JobQueue(max_workers=1, max_queue=1)
+    job = queue.submit("image", failing)
+
+    assert job.wait(5)
+    assert job.status == "failed"
+    assert job.error == "upstream down"
+    assert queue.stats()["failed"] == 1
+
+def test_job_queue_runs_jobs_for_owner_in_background():
+    queue = JobQueue(max_workers=1, max_queue=1)
+    job = queue.submit("analysis", current_caller, owner="user@example.com")
+
+    assert job.wait(5)
+    assert job.result == ("user@example.com", BACKGROUND)
+
+def test_job_queue_rejects_when_full():
+    release = threading.Event()
+    queue = JobQueue(max_workers=1, max_queue=1)
+    running = queue.submit("analysis", release.wait, 5)
+    waiting = queue.submit("analysis", release.wait, 5)
+
+    with pytest.raises(QueueFullError):
+        queue.submit("analysis", release.wait, 5)
+    assert queue.stats()["rejected"] == 1
+
+    release.set()
+    assert running.wait(5) and waiting.wait(5)
+    # Slots are freed once jobs finish
+    assert queue.submit("analysis", lambda: None).wait(5)
+
+def test_job_queue_unknown_job():
+    queue = JobQueue()
+    assert queue.get("missing") is None
@@ -1,11 +1,33 @@
 import sys
 sys.path.append('.')
 
+import gzip
 import json
+import hashlib
+import threading
+import requests
+import pytest
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import letter
 
 from lucidserver.memories.main import *
+from lucidserver.cache import PersistentLRUCache
+from lucidserver.images import ImageStore
+from lucidserver.vectors import VectorIndex
+from unittest.mock import Mock
+from concurrent.futures import ThreadPoolExecutor
+from lucidserver.resilience import UpstreamError
+from lucidserver.actions import get_coalescing_stats
+
+
+# Every test starts with empty caches so mocks are not shadowed by earlier tests
+@pytest.fixture(autouse=True)
+def clear_dream_cache(monkeypatch, tmp_path):
+    dream_cache.clear()
+    monkeypatch.setattr('lucidserver.memories.main.analysis_cache', PersistentLRUCache(":memory:"))
+    monkeypatch.setattr('lucidserver.memories.main.image_store', ImageStore(str(tmp_path / "images")))
+    yield
+    dream_cache.clear()
 
 
 # Mocking the create_memory function //////////////////////////////////////////////////////////////////////////////////////////////////////
@@ -53,6 +75,51 @@ def test_create_dream(monkeypatch):
     assert 'updated_at' in result['metadata']
    
     
+# Storage collection that records batched writes
+class MockCollection:
+    def __init__(self, fail_batches=()):
+        self.upserts = []
+        self.stored = []
+        self.fail_batches = fail_batches
+
+    def upsert(self, ids, documents, metadatas):
+        self.upserts.append((ids, documents, metadatas))
+        if len(self.upserts) in self.fail_batches:
+            raise RuntimeError("storage down")
+        self.stored += ids
+
+    def get(self, ids, include):
+        return {"ids": [memory_id for memory_id in ids if memory_id in self.stored]}
+
+# Testing that create_dreams writes and verifies in batches
+def test_create_dreams_in_batches(monkeypatch):
+    collection = MockCollection()
+    monkeypatch.setattr('lucidserver.memories.main.get_client', lambda: Mock(get_or_create_collection=lambda name: collection))
+    dreams = [{"title": f"Dream {i}", "date": "2022-08-07", "entry": f"Entry {i}", "lucidity": 3} for i in range(5)]
+
+    results = create_dreams(dreams, "user@example.com", batch_size=2)
+
+    assert [len(ids) for ids, _, _ in collection.upserts] == [2, 2, 1]
+    assert [result["status"] for result in results] == ["created"] * 5
+    assert [result["id"] for result in results] == collection.stored
+    ids, documents, metadatas = collection.upserts[0]
+    assert documents[0] == "Dream 0\nEntry 0"
+    assert metadatas[0]["useremail"] == "user@example.com"
+    assert metadatas[0]["lucidity"] == 3
+    assert "symbols" not in metadatas[0]
+    assert metadatas[0]["created_at"] < metadatas[1]["created_at"]
+
+# Testing that a failed batch only fails its own dreams
+def test_create_dreams_reports_failed_batch(monkeypatch):
+    collection = MockCollection(fail_batches=(2,))
+    monkeypatch.setattr('lucidserver.memories.main.get_client', lambda: Mock(get_or_create_collection=lambda name: collection))
+    dreams = [{"title": "Dream", "date": "2022-08-07", "entry": "Entry"}] * 3
+
+    results = create_dreams(dreams, "user@example.com", batch_size=2)
+
+    assert [result["status"] for result in results] == ["created", "created", "failed"]
+
+
 # Testing the get_dream function when the dream exists ////////////////////////////////////////////////////////////////////////////////////////////
 def test_get_dream_existing(monkeypatch):
     # Patching the get_memory function with mock function
@@ -114,9 +181,40 @@ def test_get_dream_with_optional_fields(monkeypatch):
     assert result['image'] == "image.png", f"Expected image field, but got {result}"
 
 
+# Testing that repeated get_dream calls are served from the cache
+def test_get_dream_uses_cache(monkeypatch):
+    calls = []
+
+    def counting_get_memory(category, id):
+        calls.append(id)
+        return mock_get_memory(category, id)
+
+    monkeypatch.setattr('lucidserver.memories.main.get_memory', counting_get_memory)
+
+    first = get_dream("memory_id_12345")
+    first["metadata"]["title"] = "Mutated by caller"
+    second = get_dream("memory_id_12345")
+
+    assert calls == ["memory_id_12345"], "Expected a single storage read."
+    assert second["metadata"]["title"] == "Dream Title"
+    assert get_dream_cache_stats()["hits"] == 1
+
+# Testing that updates refresh the cached dream and deletes invalidate it
+def test_dream_cache_refreshed_on_update_and_invalidated_on_delete(monkeypatch):
+    monkeypatch.setattr('lucidserver.memories.main.get_memory', mock_get_memory)
+    monkeypatch.setattr('lucidserver.memories.main.update_memory', lambda category, memory_id, metadata=None: None)
+    monkeypatch.setattr('lucidserver.memories.main.delete_memory', lambda category, id: True)
+
+    update_dream_analysis_and_image("memory_id_12345", analysis="Fresh analysis")
+    assert get_dream("memory_id_12345")["analysis"] == "Fresh analysis"
+
+    delete_dream("memory_id_12345")
+    assert "memory_id_12345" not in dream_cache
+
+
 # Mocking the get_memories function ///////////////////////////////////////////////////////////////////////////////////////////////////////////
-def mock_get_memories(category, n_results=None):
-    return [
+def mock_get_memories(category, filter_metadata=None, n_results=None, include_embeddings=True):
+    memories = [
         {
             "id": "memory_id_12345",
             "document": "Dream Title\nDream Entry",
@@ -140,6 +238,13 @@ def mock_get_memories(category, n_results=None):
             }
         },
     ]
+    # Simulate the backend applying the metadata filter
+    if filter_metadata:
+        memories = [
+            memory for memory in memories
+            if all(memory["metadata"].get(key) == value for key, value in filter_metadata.items())
+        ]
+    return memories
 
 # Testing the get_dreams function when dreams exist for the user
 def test_get_dreams_existing(monkeypatch):
@@ -177,6 +282,146 @@ def test_get_dreams_non_existing(monkeypatch):
     # Asserting that the result is empty
     assert result == [], "Expected an empty list, but got a result."
 
+# Testing that get_dreams pushes the user filter down to storage without a result cap
+def test_get_dreams_filters_in_storage(monkeypatch):
+    calls = []
+
+    def recording_get_memories(category, **kwargs):
+        calls.append(kwargs)
+        return mock_get_memories(category, **kwargs)
+
+    monkeypatch.setattr('lucidserver.memories.main.get_memories', recording_get_memories)
+
+    get_dreams("user@example.com")
+
+    assert calls[0]["filter_metadata"] == {"useremail": "user@example.com"}
+    assert calls[0]["n_results"] > 2222, "get_dreams should not truncate large journals."
+    assert calls[0]["include_embeddings"] is False
+
+# Mocking the dreams collection with a journal of timestamped dreams
+class MockJournalCollection:
+    def __init__(self, count=5):
+        self.memories = [
+            {
+                "id": f"memory_id_{index}",
+                "document": f"Dream {index}",
+                "metadata": {
+                    "title": f"Dream {index}",
+                    "date": f"2022-08-{index + 10:02d}",
+                    "entry": f"Dream Entry {index}",
+                    "useremail": "user@example.com",
+                    "created_at": 1691807200.0 + (index // 2),  # pairs share a timestamp
+                }
+            }
+            for index in range(count)
+        ]
+        self.reads = []
+
+    def get(self, ids=None, where=None, limit=None, offset=0, include=None):
+        self.reads.append({"ids": ids, "include": include})
+        if ids is not None:
+            page = [m for m in self.memories if m["id"] in ids]
+        else:
+            matching = [m for m in self.memories if where is None or m["metadata"]["useremail"] == where["useremail"]]
+            page = matching[offset:offset + limit]
+        return {"ids": [m["id"] for m in page],
+                "documents": [m["document"] for m in page] if "documents" in include else None,
+                "metadatas": [m["metadata"] for m in page]}
+
+def mock_journal(monkeypatch, count=5):
+    collection = MockJournalCollection(count)
+    monkeypatch.setattr('lucidserver.memories.main.get_client', lambda: Mock(get_or_create_collection=lambda name: collection))
+    dream_sort_index.clear()
+    dream_cache.clear()
+    return collection
+
+def walk_dreams_pages(**kwargs):
+    seen = []
+    cursor = None
+    while True:
+        page = get_dreams_page("user@example.com", cursor=cursor, **kwargs)
+        assert len(page["dreams"]) <= kwargs["limit"]
+        seen += [dream["id"] for dream in page["dreams"]]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            return seen
+
+# Testing that paging through get_dreams_page returns every dream once, newest first
+def test_get_dreams_page_walks_journal(monkeypatch):
+    mock_journal(monkeypatch)
+
+    seen = walk_dreams_pages(limit=2)
+
+    assert seen == ["memory_id_4", "memory_id_3", "memory_id_2", "memory_id_1", "memory_id_0"]
+
+# Testing that the journal is scanned once and each page reads only its own dreams
+def test_get_dreams_page_reads_page_only(monkeypatch):
+    collection = mock_journal(monkeypatch, count=20)
+
+    first = get_dreams_page("user@example.com", limit=2)
+    scans = len(collection.reads) - 1
+    assert all(read["include"] == ["metadatas"] for read in collection.reads[:scans])
+    assert collection.reads[-1] == {"ids": ["memory_id_19", "memory_id_18"], "include": ["documents", "metadatas"]}
+    assert first["dreams"][0]["metadata"]["entry"] == "Dream Entry 19"
+
+    get_dreams_page("user@example.com", limit=2, cursor=first["next_cursor"])
+    assert collection.reads[scans + 1:] == [{"ids": ["memory_id_17", "memory_id_16"], "include": ["documents", "metadatas"]}]
+
+# Testing that writes of this process show in the loaded sort index
+def test_get_dreams_page_follows_writes(monkeypatch):
+    collection = mock_journal(monkeypatch)
+    get_dreams_page("user@example.com", limit=2)
+
+    new = {"id": "memory_id_new", "document": "New dream",
+           "metadata": {"title": "New", "date": "2022-09-01", "entry": "New entry",
+                        "useremail": "user@example.com", "created_at": 1791807200.0}}
+    collection.memories.append(new)
+    update_dream_sort_index("user@example.com", new["id"], new["metadata"])
+    update_dream_sort_index("user@example.com", "memory_id_3")
+
+    assert walk_dreams_pages(limit=2) == ["memory_id_new", "memory_id_4", "memory_id_2", "memory_id_1", "memory_id_0"]
+
+# Testing that a build overlapping a write is used but not kept
+def test_dream_sort_index_not_kept_after_concurrent_write(monkeypatch):
+    collection = mock_journal(monkeypatch)
+    get = collection.get
+
+    def get_during_write(**kwargs):
+        update_dream_sort_index("user@example.com", "memory_id_0")
+        return get(**kwargs)
+
+    collection.get = get_during_write
+    build_dream_sort_index("user@example.com")
+    assert dream_sort_index.get("user@example.com") is None
+
+# Testing that dreams without created_at are ordered as oldest instead of dropped
+def test_get_dreams_page_missing_sort_key(monkeypatch):
+    collection = mock_journal(monkeypatch)
+    del collection.memories[3]["metadata"]["created_at"]
+
+    assert walk_dreams_pages(limit=2) == ["memory_id_4", "memory_id_2", "memory_id_1", "memory_id_0", "memory_id_3"]
+    assert walk_dreams_pages(limit=2, descending=False)[0] == "memory_id_3"
+
+# Testing ascending order by dream date
+def test_get_dreams_page_by_date_ascending(monkeypatch):
+    mock_journal(monkeypatch)
+
+    first = get_dreams_page("user@example.com", limit=3, order_by="date", descending=False)
+    second = get_dreams_page("user@example.com", limit=3, cursor=first["next_cursor"], order_by="date", descending=False)
+
+    assert [dream["metadata"]["date"] for dream in first["dreams"]] == ["2022-08-10", "2022-08-11", "2022-08-12"]
+    assert [dream["metadata"]["date"] for dream in second["dreams"]] == ["2022-08-13", "2022-08-14"]
+    assert second["next_cursor"] is None
+
+# Testing that invalid ordering and cursors are rejected
+def test_get_dreams_page_invalid_arguments(monkeypatch):
+    mock_journal(monkeypatch)
+
+    with pytest.raises(ValueError):
+        get_dreams_page("user@example.com", order_by="title")
+    with pytest.raises(ValueError):
+        get_dreams_page("user@example.com", cursor="not-a-cursor")
+
 def mock_get_dream(dream_id):
     return {
         "id": "memory_id_12345",
@@ -193,7 +438,7 @@ def mock_get_dream(dream_id):
 
 
 # Mocking the generate_dream_analysis function ///////////////////////////////////////////////////////////////////////////////////////////////////
-def mock_generate_dream_analysis(entry, prefix):
+def mock_generate_dream_analysis(entry, prefix, intelligence_level='general', max_attempts=None):
     return f"Analysis of: {entry}"
 
 # Testing the get_dream_analysis function when the dream exists
@@ -226,6 +471,91 @@ def test_get_dream_analysis_non_existing(monkeypatch):
     assert result is None, "Expected None, but got a result."
 
 
+# Testing that analyses are cached per entry and intelligence level, with a bypass
+def test_get_dream_analysis_cache(monkeypatch):
+    calls = []
+
+    def counting_generate_dream_analysis(entry, prefix, intelligence_level='general', max_attempts=None):
+        calls.append(intelligence_level)
+        return f"Analysis {len(calls)} of: {entry}"
+
+    monkeypatch.setattr('lucidserver.memories.main.get_dream', mock_get_dream)
+    monkeypatch.setattr('lucidserver.memories.main.generate_dream_analysis', counting_generate_dream_analysis)
+
+    first = get_dream_analysis("memory_id_12345", max_retries=1)
+    repeat = get_dream_analysis("memory_id_12345", max_retries=1)
+    expert = get_dream_analysis("memory_id_12345", "expert", max_retries=1)
+    refreshed = get_dream_analysis("memory_id_12345", max_retries=1, bypass_cache=True)
+    after_refresh = get_dream_analysis("memory_id_12345", max_retries=1)
+
+    assert first == repeat == "Analysis 1 of: Dream Entry"
+    assert expert == "Analysis 2 of: Dream Entry"
+    assert refreshed == after_refresh == "Analysis 3 of: Dream Entry"
+    assert calls == ["general", "expert", "general"]
+
+# Testing that a streamed analysis is cached and saved once the stream completes
+def test_stream_dream_analysis(monkeypatch):
+    saved = []
+    monkeypatch.setattr('lucidserver.memories.main.get_dream', mock_get_dream)
+    monkeypatch.setattr('lucidserver.memories.main.stream_dream_analysis_text', lambda entry, level: iter(["Streamed ", "analysis"]))
+    monkeypatch.setattr('lucidserver.memories.main.update_dream_analysis_and_image',
+                        lambda dream_id, analysis=None, image=None: saved.append((dream_id, analysis)) or {"id": dream_id})
+
+    assert list(stream_dream_analysis("memory_id_12345")) == ["Streamed ", "analysis"]
+    assert saved == [("memory_id_12345", "Streamed analysis")]
+
+    # The next request is served whole from the cache without calling the model
+    monkeypatch.setattr('lucidserver.memories.main.stream_dream_analysis_text',
+                        lambda entry, level: pytest.fail("Should be served from the cache."))
+    assert list(stream_dream_analysis("memory_id_12345")) == ["Streamed analysis"]
+    assert get_dream_analysis("memory_id_12345") == "Streamed analysis"
+
+# Testing that a failed stream is neither cached nor saved
+def test_stream_dream_analysis_failure(monkeypatch):
+    def broken_stream(entry, level):
+        yield "Partial"
+        raise UpstreamError("OpenAI stream interrupted")
+
+    monkeypatch.setattr('lucidserver.memories.main.get_dream', mock_get_dream)
+    monkeypatch.setattr('lucidserver.memories.main.stream_dream_analysis_text', broken_stream)
+    monkeypatch.setattr('lucidserver.memories.main.update_dream_analysis_and_image',
+                        lambda *args, **kwargs: pytest.fail("Should not save a partial analysis."))
+
+    with pytest.raises(UpstreamError):
+        list(stream_dream_analysis("memory_id_12345"))
+    assert get_analysis_cache_stats()["size"] == 0
+
+# Testing that failed analyses are not cached
+def test_get_dream_analysis_does_not_cache_errors(monkeypatch):
+    responses = ["Error: Unable to generate a response.", "Real analysis"]
+
+    monkeypatch.setattr('lucidserver.memories.main.get_dream', mock_get_dream)
+    monkeypatch.setattr('lucidserver.memories.main.generate_dream_analysis', lambda *args, **kwargs: responses.pop(0))
+
+    assert get_dream_analysis("memory_id_12345", max_retries=1) is None
+    assert get_dream_analysis("memory_id_12345", max_retries=1) == "Real analysis"
+
+
+# Testing that background analysis saves the result on the dream
+def test_generate_and_save_dream_analysis(monkeypatch):
+    saved = {}
+    monkeypatch.setattr('lucidserver.memories.main.get_dream_analysis', lambda dream_id, level: f"{level} analysis")
+    monkeypatch.setattr('lucidserver.memories.main.update_dream_analysis_and_image',
+                        lambda dream_id, analysis=None, image=None: saved.update({dream_id: analysis}) or {})
+
+    assert generate_and_save_dream_analysis("memory_id_12345", "expert") == "expert analysis"
+    assert saved == {"memory_id_12345": "expert analysis"}
+
+# Testing that failed background analyses are not saved
+def test_generate_and_save_dream_analysis_failure(monkeypatch):
+    monkeypatch.setattr('lucidserver.memories.main.get_dream_analysis', lambda dream_id, level: None)
+    monkeypatch.setattr('lucidserver.memories.main.update_dream_analysis_and_image',
+                        lambda *args, **kwargs: pytest.fail("Should not save a failed analysis."))
+
+    with pytest.raises(RuntimeError):
+        generate_and_save_dream_analysis("memory_id_12345")
+
+
 # Mocking the get_dreams function /////////////////////////////////////////////////////////////////////////////////////////////////////////////////
 def mock_get_dreams(userEmail):
     return [mock_get_dream("memory_id_12345")]
@@ -235,7 +565,7 @@ def mock_get_image_summary(entry):
     return "Image Summary"
 
 # Mocking the generate_dream_image function
-def mock_generate_dream_image(dreams, dream_id, style, quality):
+def mock_generate_dream_image(dream, style, quality, summary=None, max_attempts=None, store=None):
     return "Generated Image"
 
 def test_get_dream_image_existing(monkeypatch):
@@ -254,16 +584,58 @@ def test_get_dream_image_existing(monkeypatch):
     # Asserting that the image is correct
     assert result == "Generated Image", f"Expected image, but got {result}"
 
+# Testing that the image pipeline loads nothing extra and summarizes exactly once
+def test_get_dream_image_call_counts(monkeypatch):
+    calls = {"get_dream": 0, "get_dreams": 0, "summary": 0, "generate": []}
+
+    def counting_get_dream(dream_id):
+        calls["get_dream"] += 1
+        return mock_get_dream(dream_id)
+
+    def counting_get_dreams(userEmail):
+        calls["get_dreams"] += 1
+        return mock_get_dreams(userEmail)
+
+    def counting_get_image_summary(entry):
+        calls["summary"] += 1
+        return "Image Summary"
+
+    def counting_generate_dream_image(dream, style, quality, summary=None, max_attempts=None, store=None):
+        calls["generate"].append((summary, max_attempts))
+        return "Generated Image"
+
+    monkeypatch.setattr('lucidserver.memories.main.get_dream', counting_get_dream)
+    monkeypatch.setattr('lucidserver.memories.main.get_dreams', counting_get_dreams)
+    monkeypatch.setattr('lucidserver.memories.main.get_image_summary', counting_get_image_summary)
+    monkeypatch.setattr('lucidserver.memories.main.generate_dream_image', counting_generate_dream_image)
+
+    dream = mock_get_dream("memory_id_12345")
+    result = get_dream_image("memory_id_12345", max_retries=2, dream=dream)
+
+    assert result == "Generated Image"
+    assert calls["get_dream"] == 0, "Expected the preloaded dream to be reused."
+    assert calls["get_dreams"] == 0, "Expected no journal scan."
+    assert calls["summary"] == 1, "Expected exactly one summary."
+    assert calls["generate"] == [("Image Summary", 2)], "Expected retries to be delegated with the summary."
+
+# Testing that a failed summary stops the image pipeline before the images API
+def test_get_dream_image_summary_failure(monkeypatch):
+    monkeypatch.setattr('lucidserver.memories.main.get_image_summary', lambda entry: "Error: Unable to generate a summary.")
+    monkeypatch.setattr('lucidserver.memories.main.generate_dream_image',
+                        lambda *args, **kwargs: pytest.fail("Should not request an image without a summary."))
+
+    assert get_dream_image("memory_id_12345", dream=mock_get_dream("memory_id_12345")) is None
+
 # Mocking the generate_dream_image function to simulate failure
-def mock_generate_dream_image_failure(dreams, dream_id, style, quality):
+def mock_generate_dream_image_failure(dream, style, quality, summary=None, max_attempts=None, store=None):
     return None
 
 def test_get_dream_image_failure(monkeypatch):
     # Patching the dependent functions with mock functions
     monkeypatch.setattr('lucidserver.memories.main.get_dream', mock_get_dream) # Assuming existing mock function
     monkeypatch.setattr('lucidserver.memories.main.get_dreams', mock_get_dreams) # Assuming existing mock function
-    monkeypatch.setattr('lucidserver.actions.main.get_image_summary', mock_get_image_summary)
-    monkeypatch.setattr('lucidserver.actions.main.generate_dream_image', mock_generate_dream_image_failure)
+    monkeypatch.setattr('lucidserver.memories.main.get_image_summary', mock_get_image_summary)
+    monkeypatch.setattr('lucidserver.memories.main.generate_dream_image', mock_generate_dream_image_failure)
 
     # Test input
     dream_id = "memory_id_12345"
@@ -279,10 +651,14 @@ def test_get_dream_image_failure(monkeypatch):
 def mock_update_memory(category, memory_id, metadata=None):
     pass
 
+# Mocking get_dream with a stored dream shaped like memory_to_dream makes it, analysis and image at the top level
+def mock_get_stored_dream(dream_id):
+    return memory_to_dream(mock_get_memory_with_optional_fields("dreams", dream_id))
+
 # Testing the successful update of dream analysis and image
 def test_update_dream_analysis_and_image_success(monkeypatch):
     # Patching the dependent functions with mock functions
-    monkeypatch.setattr('lucidserver.memories.main.get_dream', mock_get_dream) # Assuming existing mock function
+    monkeypatch.setattr('lucidserver.memories.main.get_dream', mock_get_stored_dream)
     monkeypatch.setattr('lucidserver.memories.main.update_memory', mock_update_memory)
 
     # Test input
@@ -294,8 +670,9 @@ def test_update_dream_analysis_and_image_success(monkeypatch):
     result = update_dream_analysis_and_image(dream_id, analysis=analysis, image=image)
 
     # Asserting that the update is successful and the new values are present
-    assert result['metadata']['analysis'] == analysis, f"Expected analysis, but got {result}"
-    assert result['metadata']['image'] == image, f"Expected image, but got {result}"
+    assert result['analysis'] == analysis, f"Expected analysis, but got {result}"
+    assert result['image'] == image, f"Expected image, but got {result}"
+    assert 'analysis' not in result['metadata'] and 'image' not in result['metadata']
 
 # Testing the update with invalid analysis type
 def test_update_dream_analysis_and_image_invalid_analysis(monkeypatch):
@@ -348,12 +725,71 @@ def test_update_dream_analysis_and_image_exception(monkeypatch):
     # Asserting that the result is None (failure case)
     assert result is None, "Expected None, but got a result."
 
+# Recording the update_memory calls made by patch_dream
+def recording_update_memory(calls):
+    def update(category, memory_id, text=None, metadata=None):
+        calls.append({"text": text, "metadata": dict(metadata)})
+    return update
+
+# Testing that a patch writes only the changed fields and keeps the document
+def test_patch_dream_writes_only_changed_fields(monkeypatch):
+    calls = []
+    monkeypatch.setattr('lucidserver.memories.main.get_dream', mock_get_stored_dream)
+    monkeypatch.setattr('lucidserver.memories.main.update_memory', recording_update_memory(calls))
+
+    result = patch_dream("memory_id_12345", {"title": "Dream Title", "analysis": "New Analysis", "lucidity": None})
+
+    assert calls == [{"text": None, "metadata": {"analysis": "New Analysis"}}]
+    assert result["analysis"] == "New Analysis"
+    assert "analysis" not in result["metadata"]
+    assert result["document"] == "Dream Title\nDream Entry"
+
+# Testing that changing the entry rewrites the document, so the dream is re-embedded
+def test_patch_dream_rewrites_document_when_entry_changes(monkeypatch):
+    calls = []
+    monkeypatch.setattr('lucidserver.memories.main.get_dream', mock_get_dream)
+    monkeypatch.setattr('lucidserver.memories.main.update_memory', recording_update_memory(calls))
+
+    result = patch_dream("memory_id_12345", {"entry": "A new entry"})
+
+    assert calls == [{"text": "Dream Title\nA new entry", "metadata": {"entry": "A new entry"}}]
+    assert result["document"] == "Dream Title\nA new entry"
+
+# Testing that an unchanged patch does not write at all
+def test_patch_dream_skips_unchanged(monkeypatch):
+    calls = []
+    monkeypatch.setattr('lucidserver.memories.main.get_dream', mock_get_stored_dream)
+    monkeypatch.setattr('lucidserver.memories.main.update_memory', recording_update_memory(calls))
+
+    result = patch_dream("memory_id_12345", {"analysis": "Some analysis", "image": "image.png"})
+
+    assert calls == []
+    assert result["analysis"] == "Some analysis"
+
+# Testing that a stored image sent back as its URL is saved by digest
+def test_patch_dream_saves_image_digest(monkeypatch):
+    calls = []
+    monkeypatch.setattr('lucidserver.memories.main.get_dream', mock_get_stored_dream)
+    monkeypatch.setattr('lucidserver.memories.main.update_memory', recording_update_memory(calls))
+    digest = "c" * 64
+
+    result = patch_dream("memory_id_12345", {"image": f"https://lucid.example/api/images/{digest}"})
+
+    assert calls == [{"text": None, "metadata": {"image": digest}}]
+    assert result["image"] == digest
+
+# Testing that fields outside DREAM_PATCH_FIELDS are rejected
+def test_patch_dream_rejects_unknown_fields(monkeypatch):
+    monkeypatch.setattr('lucidserver.memories.main.get_dream', mock_get_dream)
+    with pytest.raises(ValueError):
+        patch_dream("memory_id_12345", {"useremail": "other@example.com"})
+
 
 # Mocking the search_dreams function /////////////////////////////////////////////////////////////////////////////////////////////////////////
-def mock_search_memory(category, keyword, n_results=100):
+def mock_search_memory(category, keyword, n_results=100, filter_metadata=None, include_embeddings=True):
     if keyword == "NonExisting":
         return []
-    return [
+    memories = [
         {
             "id": "memory_id_12345",
             "document": "Dream Title\nDream Entry",
@@ -376,6 +812,13 @@ def mock_search_memory(category, keyword, n_results=100):
             }
         },
     ]
+    # Simulate the backend applying the metadata filter before ranking
+    if filter_metadata:
+        memories = [
+            memory for memory in memories
+            if all(memory["metadata"].get(key) == value for key, value in filter_metadata.items())
+        ]
+    return memories[:n_results]
 
 # Testing the search_dreams function when there are matching dreams for the given user
 def test_search_dreams_existing(monkeypatch):
@@ -433,6 +876,90 @@ def test_search_dreams_filter_by_email(monkeypatch):
     assert result[0]['metadata']['date'] == "2022-08-08"
     assert result[0]['metadata']['entry'] == "Another Dream Entry"
     assert 'analysis' not in result[0]['metadata'], "Did not expect analysis field, but got one."
+
+# Testing that search_dreams scopes the similarity query to the user
+def test_search_dreams_scoped_to_user(monkeypatch):
+    calls = []
+
+    def recording_search_memory(category, keyword, **kwargs):
+        calls.append(kwargs)
+        return mock_search_memory(category, keyword, **kwargs)
+
+    monkeypatch.setattr('lucidserver.memories.main.search_memory', recording_search_memory)
+
+    result = search_dreams("Dream", "another@example.com", n_results=5)
+
+    assert len(result) == 1
+    assert calls[0]["filter_metadata"] == {"useremail": "another@example.com"}
+    assert calls[0]["n_results"] == 5
+
+
+# Dreams with embeddings, as the storage backend returns them
+class MockVectorCollection:
+    def __init__(self):
+        self.memories = {
+            "dream-a": ("Flying\nOver the sea", {"title": "Flying", "date": "2022-08-07", "entry": "Over the sea", "useremail": "user@example.com", "analysis": "Freedom"}, [1.0, 0.0, 0.0]),
+            "dream-b": ("Falling\nFrom a tower", {"title": "Falling", "date": "2022-08-08", "entry": "From a tower", "useremail": "user@example.com"}, [0.0, 1.0, 0.0]),
+            "dream-c": ("Flying\nOver the city", {"title": "Flying", "date": "2022-08-09", "entry": "Over the city", "useremail": "other@example.com"}, [1.0, 0.0, 0.0]),
+        }
+        self.reads = []
+
+    def get(self, ids=None, where=None, limit=None, offset=None, include=()):
+        self.reads.append("ids" if ids is not None else "where")
+        matching = [
+            (memory_id, memory) for memory_id, memory in self.memories.items()
+            if (ids is None or memory_id in ids) and (where is None or memory[1]["useremail"] == where["useremail"])
+        ]
+        page = matching[offset or 0:(offset or 0) + limit] if limit else matching
+        return {"ids": [memory_id for memory_id, _ in page], "documents": [memory[0] for _, memory in page],
+                "metadatas": [memory[1] for _, memory in page], "embeddings": [memory[2] for _, memory in page]}
+
+@pytest.fixture
+def vector_collection(monkeypatch, tmp_path):
+    collection = MockVectorCollection()
+    monkeypatch.setattr('lucidserver.memories.main.get_client', lambda: Mock(get_or_create_collection=lambda name: collection))
+    monkeypatch.setattr('lucidserver.memories.main.dream_index', VectorIndex(str(tmp_path / "dream_index")))
+    monkeypatch.setattr('lucidserver.memories.main.embed_search_query', lambda text: [0.9, 0.1, 0.0])
+    return collection
+
+# Testing that search_dreams ranks the user's dreams in the vector index
+def test_search_dreams_uses_vector_index(monkeypatch, vector_collection):
+    monkeypatch.setattr('lucidserver.memories.main.search_memory', Mock(side_effect=AssertionError("storage searched")))
+
+    result = search_dreams("flying", "user@example.com", n_results=5)
+
+    assert [dream["id"] for dream in result] == ["dream-a", "dream-b"]
+    assert result[0]["document"] == "Flying\nOver the sea"
+    assert result[0]["metadata"] == {"date": "2022-08-07", "title": "Flying", "entry": "Over the sea", "analysis": "Freedom"}
+    assert vector_collection.reads == ["where", "ids"]
+
+    # The index is built and the dreams are cached, so searching again reads nothing
+    assert [dream["id"] for dream in search_dreams("flying", "user@example.com", n_results=1)] == ["dream-a"]
+    assert vector_collection.reads == ["where", "ids"]
+
+# Testing that search_dreams searches storage when the index fails
+def test_search_dreams_falls_back_to_storage(monkeypatch, vector_collection):
+    monkeypatch.setattr('lucidserver.memories.main.embed_search_query', Mock(side_effect=RuntimeError("no model")))
+    monkeypatch.setattr('lucidserver.memories.main.search_memory', mock_search_memory)
+
+    result = search_dreams("Dream", "user@example.com")
+
+    assert [dream["id"] for dream in result] == ["memory_id_12345"]
+
+# Testing that patching and deleting dreams keep the vector index current
+def test_vector_index_follows_patch_and_delete(monkeypatch, vector_collection):
+    search_dreams("flying", "user@example.com")
+    monkeypatch.setattr('lucidserver.memories.main.update_memory', lambda category, memory_id, text=None, metadata=None: None)
+    monkeypatch.setattr('lucidserver.memories.main.get_memory',
+                        lambda category, id, include_embeddings=True: {"id": id, "embedding": [0.0, 0.0, 1.0]})
+    monkeypatch.setattr('lucidserver.memories.main.embed_search_query', lambda text: [0.0, 0.0, 1.0])
+
+    patch_dream("dream-b", {"entry": "Into the stars"})
+    assert search_dreams("stars", "user@example.com")[0]["id"] == "dream-b"
+
+    monkeypatch.setattr('lucidserver.memories.main.delete_memory', lambda category, id: True)
+    delete_dream("dream-b")
+    assert [dream["id"] for dream in search_dreams("stars", "user@example.com")] == ["dream-a"]
     
     
 # Mocking the delete_memory function to simulate a successful deletion //////////////////////////////////////////////////////////////////////////////////
@@ -509,6 +1036,163 @@ def test_export_dreams_to_pdf(tmp_path, monkeypatch):
     path = tmp_path / "dreams.pdf"
     export_dreams_to_pdf(path=str(path)) # Convert the WindowsPath object to a string
 
+# Storage collection holding dreams of two users, read in pages
+class MockPagedCollection:
+    def __init__(self, count):
+        self.memories = [
+            {"id": f"dream-{i}", "document": f"Dream {i}\nEntry {i}",
+             "metadata": {"title": f"Dream {i}", "date": "2022-08-07", "entry": f"Entry {i}",
+                          "useremail": "user@example.com" if i % 2 == 0 else "other@example.com"}}
+            for i in range(count)
+        ]
+        self.reads = []
+        self.includes = []
+
+    def get(self, where, limit, offset, include):
+        self.reads.append((limit, offset))
+        self.includes.append(include)
+        matching = [m for m in self.memories if where is None or m["metadata"]["useremail"] == where["useremail"]]
+        page = matching[offset:offset + limit]
+        return {"ids": [m["id"] for m in page], "documents": [m["document"] for m in page],
+                "metadatas": [m["metadata"] for m in page]}
+
+def test_iter_dreams_export_ndjson_in_pages(monkeypatch):
+    collection = MockPagedCollection(10)
+    monkeypatch.setattr('lucidserver.memories.main.get_client', lambda: Mock(get_or_create_collection=lambda name: collection))
+
+    chunks = list(iter_dreams_export("user@example.com", "ndjson", page_size=2))
+
+    assert len(chunks) == 3
+    assert collection.reads == [(2, 0), (2, 2), (2, 4)]
+    lines = b"".join(chunks).decode("utf-8").splitlines()
+    dreams = [json.loads(line) for line in lines]
+    assert [dream["id"] for dream in dreams] == ["dream-0", "dream-2", "dream-4", "dream-6", "dream-8"]
+    assert dreams[0]["metadata"]["useremail"] == "user@example.com"
+
+def test_iter_dreams_export_txt_gzip(monkeypatch):
+    collection = MockPagedCollection(4)
+    monkeypatch.setattr('lucidserver.memories.main.get_client', lambda: Mock(get_or_create_collection=lambda name: collection))
+
+    data = gzip.decompress(b"".join(iter_dreams_export("other@example.com", "txt", compress=True, page_size=1)))
+
+    assert data.decode("utf-8") == ("Title: Dream 1\nEntry: Entry 1\nAnalysis: No analysis available.\n\n"
+                                    "Title: Dream 3\nEntry: Entry 3\nAnalysis: No analysis available.\n\n")
+
+def test_export_dreams_to_txt_filters_by_user(tmp_path, monkeypatch):
+    collection = MockPagedCollection(3)
+    monkeypatch.setattr('lucidserver.memories.main.get_client', lambda: Mock(get_or_create_collection=lambda name: collection))
+    path = tmp_path / "dreams.txt"
+    export_dreams_to_txt(path=path, userEmail="other@example.com")
+    assert path.read_text() == "Title: Dream 1\nEntry: Entry 1\nAnalysis: No analysis available.\n\n"
+
+def test_export_dreams_to_json_file_streams_list(tmp_path, monkeypatch):
+    collection = MockPagedCollection(5)
+    monkeypatch.setattr('lucidserver.memories.main.get_client', lambda: Mock(get_or_create_collection=lambda name: collection))
+    monkeypatch.setattr('lucidserver.memories.main.EXPORT_PAGE_SIZE', 2)
+    path = tmp_path / "dreams.json"
+    export_dreams_to_json_file(path=path, userEmail="user@example.com")
+    assert json.loads(path.read_text()) == [collection.memories[i] for i in (0, 2, 4)]
+
+def test_journal_fingerprint_changes_with_journal(monkeypatch):
+    collection = MockPagedCollection(4)
+    monkeypatch.setattr('lucidserver.memories.main.get_client', lambda: Mock(get_or_create_collection=lambda name: collection))
+
+    before = journal_fingerprint("user@example.com")
+    assert journal_fingerprint("user@example.com") == before
+    collection.memories[1]["metadata"]["updated_at"] = 1.0  # another user's dream
+    assert journal_fingerprint("user@example.com") == before
+    collection.memories[2]["metadata"]["updated_at"] = 1.0
+    assert journal_fingerprint("user@example.com") != before
+    assert all(include == ["metadatas"] for include in collection.includes)
+
+def test_iter_dreams_export_unknown_format():
+    with pytest.raises(ValueError):
+        next(iter_dreams_export("user@example.com", "docx"))
+
+# Dreams for PDF rendering tests
+def make_pdf_dreams(count):
+    return [{"metadata": {"title": f"Dream {i}", "date": "2022-08-07", "entry": "A long dream entry. " * 40},
+             "analysis": "An analysis."} for i in range(count)]
+
+def count_pdf_pages(data):
+    return data.count(b"/Type /Page\n") + data.count(b"/Type /Page ")
+
+def test_render_dreams_pdf_in_batches(tmp_path):
+    consumed = []
+
+    def dreams():
+        for dream in make_pdf_dreams(30):
+            consumed.append(dream)
+            yield dream
+
+    batched = tmp_path / "batched.pdf"
+    whole = tmp_path / "whole.pdf"
+    render_dreams_pdf(dreams(), str(batched), batch_size=4)
+    render_dreams_pdf(make_pdf_dreams(30), str(whole), batch_size=1000)
+
+    assert len(consumed) == 30
+    assert batched.read_bytes().startswith(b"%PDF")
+    assert count_pdf_pages(batched.read_bytes()) == count_pdf_pages(whole.read_bytes()) > 1
+
+def test_batched_story_refills_lazily():
+    produced = []
+
+    def batches():
+        for i in range(3):
+            produced.append(i)
+            yield [f"flowable {i}a", f"flowable {i}b"]
+
+    story = BatchedStory(batches())
+    assert produced == []
+    assert story[0] == "flowable 0a"
+    del story[0]
+    del story[0]
+    assert produced == [0]
+    assert len(story) == 2
+    assert produced == [0, 1]
+
+def test_open_dreams_pdf_in_process_pool(tmp_path, monkeypatch):
+    submitted = []
+    pool = ThreadPoolExecutor(max_workers=1)
+
+    def submit(fn, *args):
+        submitted.append((fn, args))
+        return pool.submit(fn, *args)
+
+    collection = MockPagedCollection(6)
+    monkeypatch.setattr('lucidserver.memories.main.get_client', lambda: Mock(get_or_create_collection=lambda name: collection))
+    monkeypatch.setattr('lucidserver.memories.main.get_pdf_export_pool', lambda: Mock(submit=submit))
+    monkeypatch.setattr('lucidserver.memories.main.EXPORT_PAGE_SIZE', 2)
+    monkeypatch.setattr('lucidserver.memories.main.EXPORT_TMP_DIR', str(tmp_path))
+
+    with open_dreams_pdf("user@example.com") as pdf_file:
+        assert pdf_file.read(4) == b"%PDF"
+        # Removed once closed, not while open, which Windows does not allow
+        assert len(list(tmp_path.iterdir())) == 1
+
+    # The worker is sent the user, not the dreams, and reads them a page at a time
+    assert [(fn, args[1]) for fn, args in submitted] == [(render_user_dreams_pdf, "user@example.com")]
+    assert collection.reads == [(2, 0), (2, 2)]
+    assert list(tmp_path.iterdir()) == []
+
+def test_open_dreams_pdf_inline(tmp_path, monkeypatch):
+    collection = MockPagedCollection(0)
+    monkeypatch.setattr('lucidserver.memories.main.get_client', lambda: Mock(get_or_create_collection=lambda name: collection))
+    monkeypatch.setattr('lucidserver.memories.main.PDF_EXPORT_WORKERS', 0)
+    monkeypatch.setattr('lucidserver.memories.main.EXPORT_TMP_DIR', str(tmp_path))
+
+    with open_dreams_pdf("user@example.com") as pdf_file:
+        assert pdf_file.read(4) == b"%PDF"
+    assert list(tmp_path.iterdir()) == []
+
+def test_open_dreams_pdf_removes_file_on_failure(tmp_path, monkeypatch):
+    monkeypatch.setattr('lucidserver.memories.main.render_dreams_pdf_file', Mock(side_effect=RuntimeError("render failed")))
+    monkeypatch.setattr('lucidserver.memories.main.EXPORT_TMP_DIR', str(tmp_path))
+
+    with pytest.raises(RuntimeError):
+        open_dreams_pdf("user@example.com")
+    assert list(tmp_path.iterdir()) == []
+
 def test_export_dreams_to_txt(tmp_path, monkeypatch):
     # Assuming existing mock functions for export_memory_to_json
     path = tmp_path / "dreams.txt"
@@ -516,4 +1200,105 @@ def test_export_dreams_to_txt(tmp_path, monkeypatch):
     with open(path) as file:
         content = file.read()
     assert isinstance(content, str), "TXT file should contain a string."
-    # Additional assertions based on your expected structure
\ No newline at end of file
+    # Additional assertions based on your expected structure
+
+
+# Eager pipeline tests //////////////////////////////////////////////////////////////////////////////////////////////////////////////////////
+# Testing that creating a dream queues the analysis at the user's level when enabled
+def test_create_dream_queues_pipeline(monkeypatch):
+    queued = []
+    monkeypatch.setattr('lucidserver.memories.main.create_memory', mock_create_memory)
+    monkeypatch.setattr('lucidserver.memories.main.get_memory', mock_get_memory)
+    monkeypatch.setattr('lucidserver.memories.main.EAGER_ANALYSIS', True)
+    monkeypatch.setattr('lucidserver.memories.main.queue_dream_pipeline',
+                        lambda *args, **kwargs: queued.append((args, kwargs)) or [])
+
+    result = create_dream("Dream Title", "2022-08-07", "Dream Entry", "user@example.com", intelligence_level="expert")
+
+    assert result["id"] == "memory_id_12345"
+    assert queued == [(("memory_id_12345", "expert"), {"analysis": True, "image_summary": False, "owner": "user@example.com"})]
+
+# Testing that the pipeline saves the analysis and caches the image summary in the background
+def test_queue_dream_pipeline(monkeypatch):
+    saved = []
+    monkeypatch.setattr('lucidserver.memories.main.get_dream', mock_get_dream)
+    monkeypatch.setattr('lucidserver.memories.main.get_dream_analysis', lambda dream_id, level: f"{level} analysis")
+    monkeypatch.setattr('lucidserver.memories.main.update_dream_analysis_and_image',
+                        lambda dream_id, analysis=None, image=None: saved.append((dream_id, analysis)) or {"id": dream_id})
+    summaries = []
+    monkeypatch.setattr('lucidserver.memories.main.get_image_summary', lambda entry: summaries.append(entry) or "Image Summary")
+
+    jobs = queue_dream_pipeline("memory_id_12345", "detailed", image_summary=True, owner="user@example.com")
+    for job in jobs:
+        assert job.wait(5)
+
+    assert [job.kind for job in jobs] == ["analysis", "image_summary"]
+    assert all(job.status == "succeeded" and job.owner == "user@example.com" for job in jobs)
+    assert saved == [("memory_id_12345", "detailed analysis")]
+
+    # Image generation later reuses the precomputed summary
+    monkeypatch.setattr('lucidserver.memories.main.generate_dream_image', mock_generate_dream_image)
+    assert get_dream_image("memory_id_12345") == "Generated Image"
+    assert summaries == ["Dream Entry"]
+
+# Testing that a full job queue skips the eager stages instead of failing dream creation
+def test_queue_dream_pipeline_queue_full(monkeypatch):
+    def reject(*args, **kwargs):
+        raise QueueFullError("Job queue is full")
+
+    monkeypatch.setattr('lucidserver.memories.main.job_queue.submit', reject)
+    assert queue_dream_pipeline("memory_id_12345", image_summary=True) == []
+
+
+# Image store tests /////////////////////////////////////////////////////////////////////////////////////////////////////////////////////////
+# Testing that a generated image is stored locally once and served from the store on repeat views
+def test_get_dream_image_stores_image(monkeypatch):
+    generated = []
+    monkeypatch.setattr('lucidserver.memories.main.get_image_summary', lambda entry: "Image Summary")
+    monkeypatch.setattr('lucidserver.actions.main.request_dream_image',
+                        lambda *args: generated.append(args) or "https://openai.example/image.png")
+    download = Mock(return_value=Mock(status_code=200, content=b"png bytes", raise_for_status=lambda: None))
+    monkeypatch.setattr('lucidserver.images.main.image_http.session.request', download)
+
+    dream = mock_get_dream("memory_id_12345")
+    first = get_dream_image("memory_id_12345", "abstract", "low", dream=dream)
+    repeat = get_dream_image("memory_id_12345", "abstract", "low", dream=dream)
+
+    assert first == repeat
+    assert first == hashlib.sha256(b"png bytes").hexdigest()
+    assert len(generated) == 1 and download.call_count == 1, "Expected no generation or download on a repeat view."
+
+    # A different style is a different image
+    get_dream_image("memory_id_12345", "modern", "low", dream=dream)
+    assert len(generated) == 2
+
+# Testing that a failed download falls back to the generated URL without caching it
+def test_get_dream_image_download_failure(monkeypatch):
+    monkeypatch.setattr('lucidserver.memories.main.get_image_summary', lambda entry: "Image Summary")
+    monkeypatch.setattr('lucidserver.actions.main.request_dream_image', lambda *args: "https://openai.example/image.png")
+    monkeypatch.setattr('lucidserver.images.main.image_http.session.request', Mock(side_effect=requests.exceptions.Timeout()))
+
+    assert get_dream_image("memory_id_12345", dream=mock_get_dream("memory_id_12345")) == "https://openai.example/image.png"
+    assert get_analysis_cache_stats()["size"] == 1, "Expected only the summary to be cached."
+
+# Testing that callers asking for the same image at once share one download of it
+def test_get_dream_image_coalesced_callers_download_once(monkeypatch):
+    release = threading.Event()
+    monkeypatch.setattr('lucidserver.memories.main.get_image_summary', lambda entry: "Image Summary")
+    monkeypatch.setattr('lucidserver.actions.main.request_dream_image',
+                        lambda *args: release.wait(5) and "https://openai.example/image.png")
+    download = Mock(return_value=Mock(status_code=200, content=b"shared png", raise_for_status=lambda: None))
+    monkeypatch.setattr('lucidserver.images.main.image_http.session.request', download)
+
+    dream = mock_get_dream("memory_id_12345")
+    before = get_coalescing_stats()["image"]
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        futures = [executor.submit(get_dream_image, "memory_id_12345", "abstract", "low", dream=dream, bypass_cache=True)
+                   for _ in range(3)]
+        while get_coalescing_stats()["image"]["coalesced"] - before["coalesced"] < 2:
+            threading.Event().wait(0.01)
+        release.set()
+        results = [future.result(5) for future in futures]
+
+    assert results == [hashlib.sha256(b"shared png").hexdigest()] * 3
+    assert download.call_count == 1
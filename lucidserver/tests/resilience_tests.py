@@ -0,0 +1,187 @@
+import sys
+sys.path.append('.')
+
+import time
+import threading
+import pytest
+import requests
+from unittest.mock import patch, Mock
+from lucidserver.resilience.main import *
+
+
+# Every test runs without real backoff sleeps
+@pytest.fixture(autouse=True)
+def no_sleep():
+    with patch('lucidserver.resilience.main.time.sleep') as mock_sleep:
+        yield mock_sleep
+
+
+# Error classification tests ////////////////////////////////////////////////////////////////////////////////////////////////////////////////
+def test_is_retryable():
+    assert is_retryable(requests.exceptions.Timeout())
+    assert is_retryable(requests.exceptions.ConnectionError())
+    assert is_retryable(UpstreamError("rate limited", retryable=True))
+    assert not is_retryable(UpstreamError("bad request", retryable=False))
+    assert not is_retryable(KeyError("text"))
+    assert is_retryable(requests.exceptions.HTTPError(response=Mock(status_code=503)))
+    assert not is_retryable(requests.exceptions.HTTPError(response=Mock(status_code=401)))
+
+
+# Retry tests ///////////////////////////////////////////////////////////////////////////////////////////////////////////////////////////////
+def test_call_with_retries_recovers(no_sleep):
+    fn = Mock(side_effect=[UpstreamError("busy"), UpstreamError("busy"), "ok"])
+    assert call_with_retries(fn, "arg", policy=RetryPolicy(max_attempts=3)) == "ok"
+    assert fn.call_count == 3
+    assert no_sleep.call_count == 2
+
+def test_call_with_retries_does_not_retry_non_retryable():
+    fn = Mock(side_effect=UpstreamError("bad request", retryable=False))
+    with pytest.raises(UpstreamError):
+        call_with_retries(fn, policy=RetryPolicy(max_attempts=5))
+    assert fn.call_count == 1
+
+def test_call_with_retries_gives_up_after_max_attempts():
+    fn = Mock(side_effect=UpstreamError("busy"))
+    with pytest.raises(UpstreamError):
+        call_with_retries(fn, policy=RetryPolicy(max_attempts=5), max_attempts=2)
+    assert fn.call_count == 2
+
+def test_call_with_retries_respects_deadline():
+    fn = Mock(side_effect=UpstreamError("busy", retry_after=30))
+    with pytest.raises(UpstreamError):
+        call_with_retries(fn, policy=RetryPolicy(max_attempts=5, deadline=10))
+    assert fn.call_count == 1, "Expected no retry that would overrun the deadline."
+
+def test_backoff_is_exponential_with_jitter():
+    policy = RetryPolicy(base_delay=1, max_delay=8)
+    with patch('lucidserver.resilience.main.random.uniform', side_effect=lambda low, high: high):
+        assert [policy.backoff(attempt) for attempt in range(1, 6)] == [1, 2, 4, 8, 8]
+        assert policy.backoff(1, retry_after=3) == 3
+
+
+# Circuit breaker tests /////////////////////////////////////////////////////////////////////////////////////////////////////////////////////
+def test_circuit_breaker_opens_and_recovers():
+    breaker = CircuitBreaker("test", failure_threshold=2, reset_timeout=30)
+    fn = Mock(side_effect=UpstreamError("down"))
+
+    with patch('lucidserver.resilience.main.time.monotonic', return_value=100.0):
+        with pytest.raises(UpstreamError):
+            call_with_retries(fn, breaker=breaker, policy=RetryPolicy(max_attempts=5))
+        assert fn.call_count == 2
+        assert breaker.stats()["state"] == "open"
+
+        with pytest.raises(CircuitOpenError):
+            call_with_retries(fn, breaker=breaker)
+        assert fn.call_count == 2
+
+    # After the reset timeout one trial call is let through and closes the circuit
+    with patch('lucidserver.resilience.main.time.monotonic', return_value=131.0):
+        fn.side_effect = None
+        fn.return_value = "ok"
+        assert call_with_retries(fn, breaker=breaker) == "ok"
+        assert breaker.stats()["state"] == "closed"
+
+def test_circuit_breaker_ignores_non_retryable_failures():
+    breaker = CircuitBreaker("test", failure_threshold=1)
+    fn = Mock(side_effect=UpstreamError("bad request", retryable=False))
+    for _ in range(3):
+        with pytest.raises(UpstreamError):
+            call_with_retries(fn, breaker=breaker)
+    assert breaker.stats()["state"] == "closed"
+
+def test_circuit_breaker_non_retryable_failures_do_not_reset():
+    breaker = CircuitBreaker("test", failure_threshold=2, reset_timeout=30)
+    with patch('lucidserver.resilience.main.time.monotonic', return_value=100.0):
+        breaker.record_failure()
+        breaker.record_failure(retryable=False)
+        breaker.record_failure()
+        assert breaker.stats()["state"] == "open"
+
+    # A rejected trial call neither closes nor reopens the circuit, the next call is the trial
+    with patch('lucidserver.resilience.main.time.monotonic', return_value=131.0):
+        breaker.before_call()
+        breaker.record_failure(retryable=False)
+        assert breaker.stats()["state"] == "half_open"
+        breaker.before_call()
+        breaker.record_success()
+        assert breaker.stats()["state"] == "closed"
+
+
+# Rate limit tests //////////////////////////////////////////////////////////////////////////////////////////////////////////////////////////
+@pytest.fixture
+def clock(no_sleep):
+    now = [1000.0]
+
+    def advance(seconds):
+        now[0] += seconds
+
+    no_sleep.side_effect = advance
+    with patch('lucidserver.resilience.main.time.monotonic', side_effect=lambda: now[0]):
+        yield advance
+
+def test_token_bucket_refills(clock):
+    bucket = TokenBucket(rate=2, capacity=2)
+    assert bucket.take() == 0
+    assert bucket.take() == 0
+    assert bucket.take() == pytest.approx(0.5)
+    clock(0.5)
+    assert bucket.take() == 0
+
+def test_rate_limiter_limits_each_key(clock):
+    limiter = RateLimiter("test", rate=1, burst=1)
+    limiter.acquire("a@example.com")
+    with pytest.raises(RateLimitedError) as error:
+        limiter.acquire("a@example.com")
+    assert error.value.retry_after == pytest.approx(1)
+    limiter.acquire("b@example.com")
+    assert limiter.stats()["rejected"] == 1
+    assert limiter.stats()["keys"] == 2
+
+def test_rate_limiter_waits_up_to_max_wait(clock, no_sleep):
+    limiter = RateLimiter("test", rate=1, burst=1)
+    limiter.acquire("a@example.com")
+    limiter.acquire("a@example.com", max_wait=2)
+    no_sleep.assert_called_once_with(pytest.approx(1))
+
+def test_rate_limiter_release_gives_back_a_call(clock):
+    limiter = RateLimiter("test", rate=1, burst=1)
+    limiter.acquire("a@example.com")
+    limiter.release("a@example.com")
+    limiter.release("a@example.com")  # never above the burst
+    limiter.acquire("a@example.com")
+    with pytest.raises(RateLimitedError):
+        limiter.acquire("a@example.com")
+    assert limiter.stats()["released"] == 2
+
+def test_priority_gate_rejects_after_max_wait():
+    gate = PriorityGate("test", rate=0.1, burst=1)
+    gate.acquire()
+    with pytest.raises(RateLimitedError) as error:
+        gate.acquire(max_wait=0.01)
+    assert error.value.retry_after > 1
+    assert gate.stats() == {"allowed": 1, "rejected": 1, "waiting": 0, "rate": 0.1, "burst": 1}
+
+def test_priority_gate_serves_interactive_first():
+    gate = PriorityGate("test", rate=4, burst=1)
+    gate.acquire()
+    order = []
+
+    def wait_for_call(priority):
+        gate.acquire(priority, max_wait=5)
+        order.append(priority)
+
+    background = threading.Thread(target=wait_for_call, args=(BACKGROUND,))
+    background.start()
+    while gate.stats()["waiting"] < 1:
+        time.sleep(0.001)
+    interactive = threading.Thread(target=wait_for_call, args=(INTERACTIVE,))
+    interactive.start()
+    background.join(5)
+    interactive.join(5)
+    assert order == [INTERACTIVE, BACKGROUND]
+
+def test_calling_as():
+    assert current_caller() == (None, INTERACTIVE)
+    with calling_as("a@example.com", BACKGROUND):
+        assert current_caller() == ("a@example.com", BACKGROUND)
+    assert current_caller() == (None, INTERACTIVE)
@@ -0,0 +1,133 @@
+import sys
+sys.path.append('.')
+
+import os
+import time
+import pytest
+import numpy as np
+from unittest.mock import patch
+from lucidserver.vectors.main import *
+
+
+key = "user@example.com"
+
+
+@pytest.fixture
+def index(tmp_path):
+    return VectorIndex(str(tmp_path), ttl=60)
+
+
+def unit(*values):
+    return np.array(values, dtype=np.float32)
+
+
+# VectorIndex tests /////////////////////////////////////////////////////////////////////////////////////////////////////////////////////////
+def test_vector_index_ranks_by_cosine_similarity(index):
+    index.build(key, [("a", unit(1, 0, 0)), ("b", unit(0, 2, 0)), ("c", unit(1, 1, 0))])
+
+    hits = index.search(key, unit(0, 3, 0), k=2)
+
+    assert [item_id for item_id, _ in hits] == ["b", "c"]
+    assert hits[0][1] == pytest.approx(1.0)
+    assert hits[1][1] == pytest.approx(0.7071, abs=1e-4)
+
+def test_vector_index_missing_or_expired(index):
+    assert index.search(key, unit(1, 0, 0)) is None
+    index.build(key, [("a", unit(1, 0, 0))])
+    with patch('lucidserver.vectors.main.time.time', return_value=time.time() + 61):
+        assert index.search(key, unit(1, 0, 0)) is None
+
+def test_vector_index_upsert_grows_and_replaces(index):
+    index.build(key, [])
+    assert index.search(key, unit(1, 0, 0)) == []
+
+    index.upsert(key, [(f"dream-{i}", unit(1, i, 0)) for i in range(MIN_CAPACITY + 1)])
+    index.upsert(key, [("dream-0", unit(0, 0, 1))])
+
+    hits = index.search(key, unit(0, 0, 1), k=MIN_CAPACITY + 5)
+    assert len(hits) == MIN_CAPACITY + 1
+    assert hits[0] == ("dream-0", pytest.approx(1.0))
+
+def test_vector_index_upsert_without_index_is_skipped(index):
+    assert index.upsert(key, [("a", unit(1, 0, 0))]) is False
+    assert index.search(key, unit(1, 0, 0)) is None
+
+def test_vector_index_remove_keeps_rows_contiguous(index):
+    index.build(key, [("a", unit(1, 0, 0)), ("b", unit(0, 1, 0)), ("c", unit(0, 0, 1))])
+
+    assert index.remove(key, ["a", "missing"]) is True
+
+    hits = index.search(key, unit(0, 0, 1), k=5)
+    assert [item_id for item_id, _ in hits] == ["c", "b"]
+    assert hits[0][1] == pytest.approx(1.0)
+
+def test_vector_index_rejects_other_dimensions(index):
+    index.build(key, [("a", unit(1, 0, 0))])
+    with pytest.raises(ValueError):
+        index.search(key, unit(1, 0))
+    with pytest.raises(ValueError):
+        index.upsert(key, [("b", unit(1, 0))])
+
+def test_vector_index_shared_between_instances(tmp_path):
+    # Two instances on one directory stand in for two worker processes
+    first = VectorIndex(str(tmp_path))
+    second = VectorIndex(str(tmp_path))
+    first.build(key, [("a", unit(1, 0, 0))])
+    assert second.search(key, unit(0, 1, 0), k=1)[0][0] == "a"
+
+    first.upsert(key, [("b", unit(0, 1, 0))])
+    assert second.search(key, unit(0, 1, 0), k=1)[0][0] == "b"
+
+    second.drop(key)
+    assert first.search(key, unit(0, 1, 0)) is None
+
+def test_vector_index_keys_are_separate(index):
+    index.build(key, [("a", unit(1, 0, 0))])
+    index.build("another@example.com", [("b", unit(1, 0, 0))])
+
+    assert index.search(key, unit(1, 0, 0)) == [("a", pytest.approx(1.0))]
+    assert index.stats()["builds"] == 2
+
+def test_vector_index_build_reapplies_concurrent_writes(index):
+    index.build(key, [("old", unit(1, 0, 0))])
+
+    def items():
+        # Stands in for storage being read while dreams are written
+        yield ("a", unit(1, 0, 0))
+        index.upsert(key, [("new", unit(0, 1, 0)), ("a", unit(0, 0, 1))])
+        index.remove(key, ["b"])
+        yield ("b", unit(0, 1, 1))
+
+    assert index.build(key, items()) is True
+
+    hits = index.search(key, unit(0, 0, 1), k=5)
+    assert [item_id for item_id, _ in hits] == ["a", "new"]
+    assert hits[0][1] == pytest.approx(1.0)
+    assert [name for name in os.listdir(index._dir(key)) if name.startswith("pending-")] == []
+
+def test_vector_index_first_build_keeps_concurrent_upserts(index):
+    def items():
+        assert index.upsert(key, [("new", unit(0, 1, 0))]) is False
+        yield ("a", unit(1, 0, 0))
+
+    index.build(key, items())
+
+    assert index.search(key, unit(0, 1, 0), k=1)[0][0] == "new"
+
+def test_vector_index_drop_during_build_discards_it(index):
+    def items():
+        yield ("a", unit(1, 0, 0))
+        index.drop(key)
+
+    assert index.build(key, items()) is False
+    assert index.search(key, unit(1, 0, 0)) is None
+    assert index.stats()["builds"] == 0
+
+def test_vector_index_ignores_abandoned_build_logs(index):
+    index.build(key, [("a", unit(1, 0, 0))])
+    abandoned = os.path.join(index._dir(key), f"pending-{time.time() - 61:.6f}-dead.jsonl")
+    open(abandoned, "w").close()
+
+    index.upsert(key, [("b", unit(0, 1, 0))])
+
+    assert not os.path.exists(abandoned)
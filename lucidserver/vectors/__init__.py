@@ -0,0 +1,9 @@
+from .main import (
+    VectorIndex,
+    normalize_rows,
+)
+
+__all__ = [
+    "VectorIndex",
+    "normalize_rows",
+]
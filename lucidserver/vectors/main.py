@@ -0,0 +1,388 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+import tempfile
+import threading
+from contextlib import contextmanager
+from lucidserver.cache import LRUCache
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import fcntl
+except ImportError:
+    # Without file locks the index is only safe to share between threads
+    fcntl = None
+
+# Rows allocated when a matrix file is created, it doubles when full
+MIN_CAPACITY = 64
+
+
+class _Shard:
+    """One key's index as mapped by this process, replaced when the files change.
+
+    Writers copy `ids` and `rows` before changing them, but `vectors` maps the
+    matrix file itself: rows are written into it in place, under the key's
+    exclusive lock, and show in every shard mapping that file.
+    """
+
+    def __init__(self, ids, vectors, dim, built_at, stamp):
+        self.ids = ids
+        self.rows = {item_id: row for row, item_id in enumerate(ids)}
+        self.vectors = vectors
+        self.dim = dim
+        self.built_at = built_at
+        self.stamp = stamp
+
+    def copy(self):
+        """Return a shard whose ids and rows a writer may change."""
+        return _Shard(list(self.ids), self.vectors, self.dim, self.built_at, None)
+
+
+def normalize_rows(matrix):
+    """Scale each row to unit length, so a dot product is the cosine similarity."""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class VectorIndex:
+    """Per-key embedding matrices memory-mapped from local disk, searched by cosine similarity.
+
+    Each key, e.g. a user, gets a directory holding a contiguous float32
+    matrix of unit-length rows and a JSON file listing the ID of each row, so
+    a search is one matrix-vector product with no call to the storage backend.
+    Rows are added, replaced and removed in place; removing a row moves the
+    last row into its slot to keep the matrix contiguous. Processes on the
+    same host share the files: a file lock orders writes against searches and
+    a process remaps a key when its files change.
+
+    A key's index is built with `build` and reported missing by `search` once
+    it is older than `ttl`, which bounds how long changes made on other hosts
+    go unseen. Writes made while a build reads its items are logged next to
+    the index and re-applied before the build is published, so they are not
+    lost to a snapshot taken before them.
+
+    Args:
+        root (str): Directory holding the index files.
+        ttl (float, optional): Seconds before a key's index must be rebuilt. Defaults to 3600.
+        max_keys (int, optional): Keys kept mapped at once. Defaults to 1024.
+
+    Raises:
+        RuntimeError: If numpy is not installed.
+    """
+
+    def __init__(self, root, ttl=3600, max_keys=1024):
+        if np is None:
+            raise RuntimeError("The vector index requires numpy")
+        self.root = root
+        self.ttl = ttl
+        self._shards = LRUCache(max_size=max_keys, copy_values=False)
+        self._thread_lock = threading.RLock()
+        self._lock = threading.Lock()
+        self.searches = 0
+        self.builds = 0
+        self.writes = 0
+
+    def _dir(self, key):
+        return os.path.join(self.root, hashlib.sha256(key.encode("utf-8")).hexdigest())
+
+    @contextmanager
+    def _locked(self, key, exclusive):
+        directory = self._dir(key)
+        os.makedirs(directory, exist_ok=True)
+        if fcntl is None:
+            with self._thread_lock:
+                yield directory
+            return
+        with open(os.path.join(directory, "lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield directory
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _map(self, directory, dim):
+        if dim is None:
+            return None
+        path = os.path.join(directory, "vectors.f32")
+        capacity = os.path.getsize(path) // (4 * dim)
+        return np.memmap(path, dtype=np.float32, mode="r+", shape=(capacity, dim))
+
+    def _load(self, key, directory):
+        """Return the key's shard, remapping it if another writer changed the files. Call with the key locked."""
+        try:
+            stat = os.stat(os.path.join(directory, "index.json"))
+        except FileNotFoundError:
+            self._shards.invalidate(key)
+            return None
+        # index.json is replaced on every write, so a new inode means new contents
+        stamp = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        shard = self._shards.get(key)
+        if shard is not None and shard.stamp == stamp:
+            return shard
+        with open(os.path.join(directory, "index.json")) as f:
+            index = json.load(f)
+        shard = _Shard(index["ids"], self._map(directory, index["dim"]), index["dim"], index["built_at"], stamp)
+        self._shards.set(key, shard)
+        return shard
+
+    def _replace(self, directory, name, data):
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, os.path.join(directory, name))
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+
+    def _write_index(self, directory, ids, dim, built_at):
+        index = {"ids": ids, "dim": dim, "built_at": built_at}
+        self._replace(directory, "index.json", json.dumps(index).encode("utf-8"))
+        with self._lock:
+            self.writes += 1
+
+    def _write_matrix(self, directory, matrix, capacity):
+        """Write a new matrix file with room for capacity rows."""
+        padding = np.zeros((capacity - len(matrix), matrix.shape[1]), dtype=np.float32)
+        self._replace(directory, "vectors.f32", matrix.tobytes() + padding.tobytes())
+
+    def _pending_logs(self, directory):
+        """Return the write logs of builds in progress, removing those of abandoned builds."""
+        paths = []
+        now = time.time()
+        for name in os.listdir(directory):
+            if not (name.startswith("pending-") and name.endswith(".jsonl")):
+                continue
+            path = os.path.join(directory, name)
+            # Named pending-<start time>-<token>.jsonl, a build older than the TTL has died
+            if now - float(name.split("-")[1]) >= self.ttl:
+                os.unlink(path)
+                continue
+            paths.append(path)
+        return paths
+
+    def _log_write(self, directory, write):
+        """Record a write for the builds in progress. Call with the key locked."""
+        line = json.dumps(write) + "\n"
+        for path in self._pending_logs(directory):
+            with open(path, "a") as f:
+                f.write(line)
+
+    def _upsert_rows(self, directory, shard, items):
+        """Add or replace rows of a copied shard, growing its matrix file if needed."""
+        dim = shard.dim or len(items[0][1])
+        if any(len(embedding) != dim for _, embedding in items):
+            raise ValueError(f"Embeddings of this index have {dim} dimensions")
+
+        new_ids = {item_id for item_id, _ in items if item_id not in shard.rows}
+        capacity = 0 if shard.vectors is None else shard.vectors.shape[0]
+        if len(shard.ids) + len(new_ids) > capacity:
+            # Grow into a new file, other processes keep reading the old one until they remap
+            capacity = max(MIN_CAPACITY, capacity * 2, len(shard.ids) + len(new_ids))
+            if shard.vectors is not None:
+                current = np.array(shard.vectors[:len(shard.ids)])
+            else:
+                current = np.zeros((0, dim), dtype=np.float32)
+            self._write_matrix(directory, current, capacity)
+            shard.vectors = self._map(directory, dim)
+        shard.dim = dim
+
+        for item_id, embedding in items:
+            if item_id not in shard.rows:
+                shard.rows[item_id] = len(shard.ids)
+                shard.ids.append(item_id)
+            shard.vectors[shard.rows[item_id]] = normalize_rows(embedding.reshape(1, -1))[0]
+
+    def _remove_rows(self, shard, item_ids):
+        """Remove rows of a copied shard, moving the last row into each freed slot."""
+        removed = False
+        for item_id in item_ids:
+            row = shard.rows.pop(item_id, None)
+            if row is None:
+                continue
+            last = len(shard.ids) - 1
+            if row != last:
+                shard.vectors[row] = shard.vectors[last]
+                shard.ids[row] = shard.ids[last]
+                shard.rows[shard.ids[row]] = row
+            shard.ids.pop()
+            removed = True
+        return removed
+
+    def build(self, key, items):
+        """Replace a key's index.
+
+        Writes made to the key while items are read are re-applied before the
+        new index is published. If the key is dropped meanwhile, e.g. because
+        one of those writes failed, the build is discarded.
+
+        Args:
+            key (str): Key of the index, e.g. a user's email.
+            items (iterable): (id, embedding) pairs, read after the build has started.
+
+        Returns:
+            bool: True if the new index was published.
+        """
+        with self._locked(key, exclusive=True) as directory:
+            log_path = os.path.join(directory, f"pending-{time.time():.6f}-{uuid.uuid4().hex}.jsonl")
+            open(log_path, "w").close()
+
+        try:
+            ids = []
+            embeddings = []
+            for item_id, embedding in items:
+                ids.append(item_id)
+                embeddings.append(np.asarray(embedding, dtype=np.float32))
+            matrix = normalize_rows(np.vstack(embeddings)) if embeddings else None
+
+            with self._locked(key, exclusive=True) as directory:
+                try:
+                    with open(log_path) as f:
+                        writes = [json.loads(line) for line in f]
+                except FileNotFoundError:
+                    return False
+
+                dim = None
+                if matrix is not None:
+                    dim = matrix.shape[1]
+                    self._write_matrix(directory, matrix, max(MIN_CAPACITY, len(ids)))
+                shard = _Shard(ids, self._map(directory, dim), dim, time.time(), None)
+                for write in writes:
+                    if "upsert" in write:
+                        rows = [(item_id, np.asarray(embedding, dtype=np.float32)) for item_id, embedding in write["upsert"]]
+                        self._upsert_rows(directory, shard, rows)
+                    else:
+                        self._remove_rows(shard, write["remove"])
+                self._write_index(directory, shard.ids, shard.dim, shard.built_at)
+        finally:
+            try:
+                os.unlink(log_path)
+            except FileNotFoundError:
+                pass
+
+        with self._lock:
+            self.builds += 1
+        return True
+
+    def upsert(self, key, items):
+        """Add or replace rows of a key's index.
+
+        Does nothing if the key has no index, it is built in full when next
+        needed. A build in progress re-applies the rows when it finishes.
+
+        Args:
+            key (str): Key of the index.
+            items (iterable): (id, embedding) pairs.
+
+        Returns:
+            bool: True if the index was updated.
+
+        Raises:
+            ValueError: If an embedding does not match the index's dimensions.
+        """
+        items = [(item_id, np.asarray(embedding, dtype=np.float32).ravel()) for item_id, embedding in items]
+        if not items:
+            return False
+        with self._locked(key, exclusive=True) as directory:
+            self._log_write(directory, {"upsert": [(item_id, embedding.tolist()) for item_id, embedding in items]})
+            shard = self._load(key, directory)
+            if shard is None:
+                return False
+            shard = shard.copy()
+            self._upsert_rows(directory, shard, items)
+            self._write_index(directory, shard.ids, shard.dim, shard.built_at)
+        return True
+
+    def remove(self, key, item_ids):
+        """Remove rows from a key's index.
+
+        Args:
+            key (str): Key of the index.
+            item_ids (iterable): IDs of the rows to remove.
+
+        Returns:
+            bool: True if the index was updated.
+        """
+        item_ids = list(item_ids)
+        with self._locked(key, exclusive=True) as directory:
+            self._log_write(directory, {"remove": item_ids})
+            shard = self._load(key, directory)
+            if shard is None:
+                return False
+            shard = shard.copy()
+            removed = self._remove_rows(shard, item_ids)
+            if removed:
+                self._write_index(directory, shard.ids, shard.dim, shard.built_at)
+        return removed
+
+    def drop(self, key):
+        """Delete a key's index, e.g. after a write to it failed, and discard builds in progress."""
+        with self._locked(key, exclusive=True) as directory:
+            # Builds in progress lose their write logs and are discarded
+            names = ["index.json", "vectors.f32"] + [os.path.basename(path) for path in self._pending_logs(directory)]
+            for name in names:
+                try:
+                    os.unlink(os.path.join(directory, name))
+                except FileNotFoundError:
+                    pass
+            self._shards.invalidate(key)
+
+    def search(self, key, embedding, k=10):
+        """Return the k rows of a key's index most similar to an embedding.
+
+        Args:
+            key (str): Key of the index.
+            embedding (list): Query embedding.
+            k (int, optional): Number of results. Defaults to 10.
+
+        Returns:
+            list: (id, cosine similarity) pairs, most similar first, or None if
+            the key has no index or it has expired.
+
+        Raises:
+            ValueError: If the embedding does not match the index's dimensions.
+        """
+        query = np.asarray(embedding, dtype=np.float32).ravel()
+        norm = np.linalg.norm(query)
+        if norm:
+            query = query / norm
+
+        with self._locked(key, exclusive=False) as directory:
+            shard = self._load(key, directory)
+            if shard is None or time.time() - shard.built_at >= self.ttl:
+                return None
+            count = len(shard.ids)
+            if count == 0 or k <= 0:
+                return []
+            if len(query) != shard.dim:
+                raise ValueError(f"Embeddings of this index have {shard.dim} dimensions, got {len(query)}")
+
+            scores = shard.vectors[:count] @ query
+            if k < count:
+                top = np.argpartition(scores, count - k)[count - k:]
+            else:
+                top = np.arange(count)
+            top = top[np.argsort(-scores[top], kind="stable")]
+            results = [(shard.ids[row], float(scores[row])) for row in top]
+
+        with self._lock:
+            self.searches += 1
+        return results
+
+    def stats(self):
+        with self._lock:
+            return {
+                "searches": self.searches,
+                "builds": self.builds,
+                "writes": self.writes,
+                "mapped_keys": len(self._shards),
+                "ttl": self.ttl,
+            }